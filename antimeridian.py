@@ -0,0 +1,213 @@
+"""HAND for basins crossing the antimeridian
+
+Basins crossing ±180° are processed in a shifted longitude frame ([0°, 360°)), in which they are contiguous:
+    * `shift_geometry_to_360` moves the western (negative longitude) parts of the basin by +360°
+    * `prepare_fabdem_vrt_antimeridian` builds a VRT in which the western FABDEM tiles are shifted by +360°
+    * HAND is calculated on that contiguous grid with `calculate_hand_for_basins`
+    * `split_antimeridian_output` splits the outputs back into an eastern and a western COG in [-180°, 180°]
+    * `wrap_antimeridian_network` moves the drainage network back to [-180°, 180°], cutting the segments at 180°
+"""
+import json
+import logging
+import os
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import shapely
+from osgeo import gdal, ogr
+from shapely.geometry.base import BaseGeometry
+
+from asf_tools import vector
+from asf_tools.util import GDALConfigManager
+from hand_stats import NODATA_VALUE, hand_statistics, stats_file, write_stats
+
+log = logging.getLogger(__name__)
+
+gdal.UseExceptions()
+ogr.UseExceptions()
+
+FABDEM_GEOJSON = 'data/FABDEM_v1-2_tiles.geojson'
+
+
+def crosses_antimeridian(geometry: BaseGeometry) -> bool:
+    """Same test as `prepare_fabdem_vrt`: the geometry has parts both west of -160° and east of 160°"""
+    min_lon, _, max_lon, _ = geometry.bounds
+    return min_lon < -160. and max_lon > 160.
+
+
+def shift_geometry_to_360(geometry: BaseGeometry) -> BaseGeometry:
+    """Shift all vertices with a negative longitude by +360°, making an antimeridian-crossing basin contiguous"""
+    return shapely.transform(geometry, lambda xy: xy + np.where(xy[:, [0]] < 0, 360., 0.) * [1., 0.])
+
+
+def shifted_bounds(geometries) -> np.ndarray:
+    """Bounds (minx, miny, maxx, maxy) of geometries in the frame they are processed in
+
+    Antimeridian-crossing geometries (see `crosses_antimeridian`) get their bounds in the [0°, 360°) frame, so
+    that their window is the basin and not a band around the globe.
+    """
+    geometries = np.asarray(geometries)
+    bounds = shapely.bounds(geometries)
+    crossing = (bounds[:, 0] < -160.) & (bounds[:, 2] > 160.)
+    if crossing.any():
+        bounds[crossing] = shapely.bounds(shift_geometry_to_360(geometries[crossing]))
+    return bounds
+
+
+def prepare_fabdem_vrt_antimeridian(vrt: Union[str, Path], geometry: BaseGeometry,
+                                    fabdem_path: Union[str, Path] = 'DEM/FABDEM') -> BaseGeometry:
+    """Create a FABDEM mosaic VRT in the [0°, 360°) longitude frame for an antimeridian-crossing geometry
+
+    Tiles west of the antimeridian are wrapped into small VRTs (next to `vrt`) whose bounds are shifted by +360°.
+
+    Args:
+        vrt: Path for the output VRT file
+        geometry: Geometry in EPSG:4326 (lon/lat) projection, as read from HydroBASINS
+        fabdem_path: folder with the extracted FABDEM tiles
+
+    Returns:
+        geometry: `geometry` in the shifted frame, to be used with the returned VRT
+    """
+    vrt = Path(vrt)
+    vrt.parent.mkdir(exist_ok=True, parents=True)
+
+    with GDALConfigManager(GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR'):
+        ogr_geometry = ogr.CreateGeometryFromWkb(geometry.wkb)
+        tile_features = vector.get_features(FABDEM_GEOJSON)
+        dem_file_names = vector.intersecting_feature_properties(ogr_geometry, tile_features, 'file_name')
+        if not dem_file_names:
+            raise ValueError(f'FABDEM does not intersect this geometry: {geometry}')
+
+        dem_file_paths = []
+        for filename in dem_file_names:
+            tile_path = Path(fabdem_path) / filename
+            tile = gdal.Open(str(tile_path))
+            ulx, xres, _, uly, _, yres = tile.GetGeoTransform()
+            lrx, lry = ulx + xres * tile.RasterXSize, uly + yres * tile.RasterYSize
+            tile = None
+
+            if ulx < 0:
+                shifted_tile = vrt.parent / f'{vrt.stem}_{Path(filename).stem}_360.vrt'
+                gdal.Translate(str(shifted_tile), str(tile_path), format='VRT',
+                               outputBounds=[ulx + 360., uly, lrx + 360., lry])
+                dem_file_paths.append(str(shifted_tile))
+            else:
+                dem_file_paths.append(str(tile_path))
+
+        gdal.BuildVRT(str(vrt), dem_file_paths)
+
+    return shift_geometry_to_360(geometry)
+
+
+def antimeridian_output_names(raster: Union[str, Path]) -> Tuple[Path, Path]:
+    """Names of the eastern and western parts, e.g. hand_100_basin5_id_1.tif -> hand_100_basin5e_id_1.tif and
+    hand_100_basin5w_id_1.tif, so that the basin id and the flow_acc naming in `calculate_hand_for_basins` still work"""
+    raster = Path(raster)
+    prefix, suffix = raster.name.split('_id_')
+    return raster.with_name(f'{prefix}e_id_{suffix}'), raster.with_name(f'{prefix}w_id_{suffix}')
+
+
+def _part_statistics(hand: np.ndarray, acc: Optional[np.ndarray], sidecar: dict) -> dict:
+    """Statistics of one part of a split HAND COG from its uint16 HAND and uint16 flow accumulation windows
+
+    The drainage cells are counted with the threshold recorded in the sidecar of the whole basin. A saturated
+    accumulation (65534) only says the maximum is at least that much, the basin maximum is kept then.
+    """
+    acc_thresh = sidecar.get('acc_thresh')
+    if acc is None or acc_thresh is None:
+        return hand_statistics(hand, acc_thresh=acc_thresh)
+
+    stats = hand_statistics(hand, np.where(acc == NODATA_VALUE, np.nan, acc.astype(np.float64)), acc_thresh=acc_thresh)
+    if stats['max_flow_acc'] is not None and stats['max_flow_acc'] >= NODATA_VALUE - 1:
+        stats['max_flow_acc'] = sidecar.get('max_flow_acc', stats['max_flow_acc'])
+    return stats
+
+
+def split_antimeridian_output(raster: Union[str, Path], options: Optional[List[str]] = None,
+                              remove: bool = True, cog_profile: str = 'lzw',
+                              acc_raster: Optional[Union[str, Path]] = None) -> List[Path]:
+    """Split a COG in the [0°, 360°) frame at 180° into COGs with valid longitudes
+
+    If `raster` has a statistics sidecar (see `hand_stats.py`), each part gets its own sidecar computed from its
+    window, with the metadata of the basin's sidecar, and the sidecar of `raster` is removed with it.
+
+    Args:
+        raster: COG written in the shifted frame
+        options: COG creation options of the parts, defaults to those of `cog_profile`
+        remove: delete `raster` after splitting
+        cog_profile: compression profile of the parts, the one `raster` was written with, see `calculate.COG_PROFILES`
+        acc_raster: flow accumulation COG in the grid of `raster`, not split yet; the drainage cells and maximum
+            accumulation of the part sidecars are read from it. Without it the part sidecars only have HAND statistics
+
+    Returns:
+        rasters: the eastern (< 180°) and the shifted western (>= 180°) parts that were written
+    """
+    from calculate import cog_options
+    options = options or cog_options(cog_profile)
+
+    raster = Path(raster)
+    east_raster, west_raster = antimeridian_output_names(raster)
+
+    src = gdal.Open(str(raster))
+    ulx, xres, _, uly, _, yres = src.GetGeoTransform()
+    width, height = src.RasterXSize, src.RasterYSize
+    split_col = int(np.clip(np.round((180. - ulx) / xres), 0, width))
+
+    rasters, windows = [], []
+    if split_col > 0:
+        gdal.Translate(str(east_raster), src, format='COG', creationOptions=options,
+                       srcWin=[0, 0, split_col, height])
+        rasters.append(east_raster)
+        windows.append([0, 0, split_col, height])
+    if split_col < width:
+        west_ulx = ulx + split_col * xres - 360.
+        gdal.Translate(str(west_raster), src, format='COG', creationOptions=options,
+                       srcWin=[split_col, 0, width - split_col, height],
+                       outputBounds=[west_ulx, uly, west_ulx + (width - split_col) * xres, uly + height * yres])
+        rasters.append(west_raster)
+        windows.append([split_col, 0, width - split_col, height])
+
+    sidecar_file = stats_file(raster)
+    if sidecar_file.exists():
+        sidecar = json.loads(sidecar_file.read_text())
+        acc_src = gdal.Open(str(acc_raster)) if acc_raster is not None else None
+        for part, window in zip(rasters, windows):
+            hand = src.GetRasterBand(1).ReadAsArray(*window)
+            acc = acc_src.GetRasterBand(1).ReadAsArray(*window) if acc_src is not None else None
+            stats = _part_statistics(hand, acc, sidecar)
+            metadata = {k: v for k, v in sidecar.items() if k != 'file' and k not in stats}
+            write_stats(part, stats, **metadata)
+        acc_src = None
+        if remove:
+            sidecar_file.unlink()
+    src = None
+
+    if remove:
+        os.remove(raster)
+
+    log.info(f'Split {raster} at the antimeridian into {[str(r) for r in rasters]}')
+    return rasters
+
+
+def wrap_antimeridian_network(network_file: Union[str, Path]) -> Path:
+    """Rewrite a drainage network GeoParquet from the [0°, 360°) frame into valid longitudes, in place
+
+    Segments are cut at 180°; both parts keep the attributes (and `segment_id`) of the segment, so that the
+    `downstream_id` links still hold.
+    """
+    import geopandas as gpd
+    import pandas as pd
+
+    network = gpd.read_parquet(network_file)
+    lines = np.asarray(network.geometry)
+    east = network.set_geometry(shapely.clip_by_rect(lines, -180., -90., 180., 90.), crs=network.crs)
+    west = network.set_geometry(shapely.transform(shapely.clip_by_rect(lines, 180., -90., 540., 90.),
+                                                  lambda xy: xy - [360., 0.]), crs=network.crs)
+
+    parts = pd.concat([east, west])
+    parts = parts[~parts.geometry.is_empty].sort_values('segment_id', kind='stable').reset_index(drop=True)
+    parts.to_parquet(network_file)
+
+    log.info(f'Wrapped the drainage network {network_file} at the antimeridian')
+    return Path(network_file)
@@ -0,0 +1,142 @@
+"""HydroBASINS levels as indexed GeoParquet stores, with id lookup, bbox queries and lazy geometries
+
+Every script used to parse a whole `hybas_*_lev0X_v1c.zip` shapefile with `gpd.read_file` and then select basins
+with `hydroBASIN[hydroBASIN.HYBAS_ID == hybas_id]`, a scan of the whole table per basin. `convert_basins` converts
+a level once into GeoParquet next to the zip (`hybas_eu_lev05_v1c.zip` -> `hybas_eu_lev05_v1c.parquet`):
+    * rows sorted by HYBAS_ID in row groups of `ROW_GROUP_SIZE`, so that a read of a few ids only decodes the row
+      groups whose HYBAS_ID statistics contain them
+    * the bounds of every basin in the columns `minx`, `miny`, `maxx`, `maxy`
+
+`BasinStore` loads only the attribute columns it is asked for, indexed by HYBAS_ID (hash lookup), and reads
+geometries only for the basins selected by id or bbox.
+
+Example:
+    store = open_basins("data/hydroBASIN/hybas_eu_lev05_v1c.zip", columns=['SUB_AREA', 'UP_AREA'])
+    store.attributes(2050012730).SUB_AREA
+    basins = store.select(store.query_bbox((6, 36, 19, 47)))  # GeoDataFrame with geometries
+
+    python basin_store.py data/hydroBASIN/hybas_eu_lev05_v1c.zip data/hydroBASIN/hybas_eu_lev06_v1c.zip
+"""
+import argparse
+import uuid
+from pathlib import Path
+from typing import Iterable, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+ROW_GROUP_SIZE = 1024
+BOUNDS_COLUMNS = ['minx', 'miny', 'maxx', 'maxy']
+
+
+def store_file(basins_file: Union[str, Path]) -> Path:
+    return Path(basins_file).with_suffix('.parquet')
+
+
+def convert_basins(basins_file: Union[str, Path], store: Optional[Union[str, Path]] = None,
+                   overwrite: bool = False) -> Path:
+    """Convert a HydroBASINS file (e.g. the zipped shapefile) into a GeoParquet store, once"""
+    import geopandas as gpd
+
+    store = Path(store) if store is not None else store_file(basins_file)
+    if store.exists() and not overwrite:
+        return store
+
+    basins = gpd.read_file(basins_file).sort_values('HYBAS_ID').reset_index(drop=True)
+    bounds = basins.geometry.bounds
+    for column in BOUNDS_COLUMNS:
+        basins[column] = bounds[column]
+
+    # concurrent conversions (e.g. workers on a shared filesystem) each write their own file
+    temp_store = store.with_name(f'{store.name}.{uuid.uuid4().hex}.tmp')
+    basins.to_parquet(temp_store, index=False, row_group_size=ROW_GROUP_SIZE)
+    temp_store.replace(store)
+    return store
+
+
+def open_basins(basins_file: Union[str, Path], columns: Optional[Sequence[str]] = None) -> 'BasinStore':
+    """`BasinStore` of a HydroBASINS file, converting it on first use; a .parquet store is opened directly"""
+    basins_file = Path(basins_file)
+    store = basins_file if basins_file.suffix == '.parquet' else convert_basins(basins_file)
+    return BasinStore(store, columns=columns)
+
+
+class BasinStore:
+    """Attributes of a GeoParquet HydroBASINS store in memory, geometries read on demand
+
+    Args:
+        store: GeoParquet file from `convert_basins`
+        columns: attribute columns to load besides HYBAS_ID and the bounds, None for all
+    """
+
+    def __init__(self, store: Union[str, Path], columns: Optional[Sequence[str]] = None):
+        self.store = Path(store)
+        schema = pq.read_schema(self.store)
+        self.columns = [name for name in schema.names if name not in ['geometry', *BOUNDS_COLUMNS]] \
+            if columns is None else ['HYBAS_ID', *[c for c in columns if c != 'HYBAS_ID']]
+
+        table = pq.read_table(self.store, columns=list(dict.fromkeys(self.columns + BOUNDS_COLUMNS)))
+        self.table = table.to_pandas().set_index('HYBAS_ID', drop=False, verify_integrity=True)
+        self.table.index.name = None
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, hybas_id):
+        return hybas_id in self.table.index
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self.table.index.to_numpy()
+
+    def attributes(self, hybas_id) -> pd.Series:
+        """Loaded attributes and bounds of one basin"""
+        return self.table.loc[hybas_id]
+
+    def query_bbox(self, bounds) -> np.ndarray:
+        """HYBAS_IDs of the basins whose bounds intersect `bounds` (minx, miny, maxx, maxy)"""
+        minx, miny, maxx, maxy = bounds
+        table = self.table
+        hits = (table.minx.to_numpy() <= maxx) & (table.maxx.to_numpy() >= minx) \
+            & (table.miny.to_numpy() <= maxy) & (table.maxy.to_numpy() >= miny)
+        return self.ids[hits]
+
+    def select(self, hybas_ids: Optional[Iterable] = None, columns: Optional[Sequence[str]] = None):
+        """GeoDataFrame of the basins `hybas_ids` (all if None), in that order, reading only their geometries
+
+        Args:
+            hybas_ids: ids of the basins; unknown ids raise a KeyError
+            columns: attribute columns, defaults to the columns loaded by the store
+        """
+        import geopandas as gpd
+
+        columns = self.columns if columns is None else ['HYBAS_ID', *[c for c in columns if c != 'HYBAS_ID']]
+        filters = None
+        if hybas_ids is not None:
+            hybas_ids = [int(hybas_id) for hybas_id in hybas_ids]
+            missing = [hybas_id for hybas_id in hybas_ids if hybas_id not in self]
+            if missing:
+                raise KeyError(f'Basins not in {self.store.name}: {missing[:10]}')
+            filters = [('HYBAS_ID', 'in', hybas_ids)]
+
+        basins = gpd.read_parquet(self.store, columns=columns + ['geometry'], filters=filters)
+        if hybas_ids is not None:
+            basins = basins.set_index('HYBAS_ID', drop=False).loc[hybas_ids].reset_index(drop=True)
+        return basins
+
+    def geometry(self, hybas_id):
+        """Geometry of one basin"""
+        return self.select([hybas_id], columns=['HYBAS_ID']).geometry.iloc[0]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Convert HydroBASINS files into GeoParquet stores')
+    parser.add_argument('basins_files', nargs='+', help='e.g. data/hydroBASIN/hybas_eu_lev05_v1c.zip')
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+
+    for basins_file in args.basins_files:
+        store = convert_basins(basins_file, overwrite=args.overwrite)
+        print(f'{basins_file} -> {store} ({len(BasinStore(store, columns=[]))} basins)')
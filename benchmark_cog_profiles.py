@@ -0,0 +1,108 @@
+"""Compare COG output profiles (file size, encode time, random window read latency) on sample basins
+
+Example:
+    python benchmark_cog_profiles.py outputs/hand_acc100/hand_100_basin5_id_2050012730.tif --profiles lzw deflate zstd lerc
+"""
+import argparse
+import os
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from osgeo import gdal
+
+from calculate import COG_PROFILES, cog_options
+
+gdal.UseExceptions()
+
+
+def encode_cog(src_file, dst_file, options):
+    """Re-encode `src_file` into a COG with the given creation options, returns the encode time in seconds"""
+    start_time = time.perf_counter()
+    gdal.Translate(str(dst_file), str(src_file), format='COG', creationOptions=options)
+    return time.perf_counter() - start_time
+
+
+def random_window_latency(filename, n_reads=50, window_size=256, seed=0):
+    """Median and 95th percentile latency (ms) of reading random `window_size` windows from a freshly opened file"""
+    rng = np.random.default_rng(seed)
+    latencies = []
+    with rasterio.open(filename) as src:
+        width, height = src.width, src.height
+
+    for _ in range(n_reads):
+        col_off = int(rng.integers(0, max(width - window_size, 0) + 1))
+        row_off = int(rng.integers(0, max(height - window_size, 0) + 1))
+        window = Window(col_off, row_off, min(window_size, width), min(window_size, height))
+
+        start_time = time.perf_counter()
+        with rasterio.open(filename) as src:
+            src.read(1, window=window)
+        latencies.append((time.perf_counter() - start_time) * 1000)
+
+    return np.median(latencies), np.percentile(latencies, 95)
+
+
+def benchmark_profiles(sample_files, profiles=None, blocksize=None, overview_resampling=None, n_reads=50,
+                       window_size=256):
+    """Encode every sample file with every profile and collect size, encode time and read latency
+
+    Returns:
+        results: list of dicts, one per (file, profile)
+    """
+    profiles = profiles or list(COG_PROFILES)
+    results = []
+    with TemporaryDirectory() as temp_dir:
+        for sample_file in sample_files:
+            sample_file = Path(sample_file)
+            for profile in profiles:
+                options = cog_options(profile, blocksize=blocksize, overview_resampling=overview_resampling)
+                dst_file = Path(temp_dir) / f'{sample_file.stem}_{profile}.tif'
+
+                encode_time = encode_cog(sample_file, dst_file, options)
+                read_median, read_p95 = random_window_latency(dst_file, n_reads=n_reads, window_size=window_size)
+                results.append({
+                    'file': sample_file.name,
+                    'profile': profile,
+                    'size_mb': os.path.getsize(dst_file) / 1024 ** 2,
+                    'encode_s': encode_time,
+                    'read_median_ms': read_median,
+                    'read_p95_ms': read_p95,
+                })
+                os.remove(dst_file)
+
+    return results
+
+
+def print_results(results):
+    print(f"{'file':<45} {'profile':<8} {'size (MB)':>10} {'encode (s)':>11} {'read p50 (ms)':>14} {'read p95 (ms)':>14}")
+    for r in results:
+        print(f"{r['file']:<45} {r['profile']:<8} {r['size_mb']:>10.2f} {r['encode_s']:>11.2f} "
+              f"{r['read_median_ms']:>14.2f} {r['read_p95_ms']:>14.2f}")
+
+    print()
+    print('total per profile:')
+    for profile in dict.fromkeys(r['profile'] for r in results):
+        rows = [r for r in results if r['profile'] == profile]
+        print(f"{profile:<8} size (MB): {sum(r['size_mb'] for r in rows):>10.2f}   "
+              f"encode (s): {sum(r['encode_s'] for r in rows):>8.2f}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sample_files', nargs='+', help='HAND / flow_acc COGs of sample basins')
+    parser.add_argument('--profiles', nargs='+', choices=list(COG_PROFILES), default=list(COG_PROFILES))
+    parser.add_argument('--blocksize', type=int, default=None)
+    parser.add_argument('--overview-resampling', default=None)
+    parser.add_argument('--n-reads', type=int, default=50)
+    parser.add_argument('--window-size', type=int, default=256)
+    args = parser.parse_args()
+
+    results = benchmark_profiles(args.sample_files, profiles=args.profiles, blocksize=args.blocksize,
+                                 overview_resampling=args.overview_resampling, n_reads=args.n_reads,
+                                 window_size=args.window_size)
+    print_results(results)
@@ -0,0 +1,104 @@
+"""Per-process pool of work buffers reused across basins
+
+Every basin used to allocate fresh arrays for the DEM window, the basin mask, the drainage mask and the uint16
+outputs, and to free them again. In a long-running worker this fragments the heap and its RSS keeps growing.
+`BufferPool` keeps one raw buffer per role (e.g. 'dem', 'basin_mask', 'hand_uint16'), grown to the high-water
+mark of the basins seen so far, and hands out views of it in the requested shape and dtype:
+    * a request that fits the buffer of its role is a hit and allocates nothing
+    * a larger request replaces the buffer of its role (a miss); with `growth` > 1 it is over-allocated, so that
+      slowly growing basins do not reallocate every time
+    * with `max_bytes`, requests that would take the pool above it get a plain, unpooled array
+
+A view stays valid until the next request for the same role, so a role is only used once per basin. The
+intermediates allocated inside pySHEDS and astropy are not pooled.
+"""
+from typing import Dict, Optional
+
+import numpy as np
+
+
+class BufferPool:
+    """Preallocated arrays per role, sized to the high-water mark of the requests
+
+    Args:
+        growth: over-allocation factor of a buffer that has to grow, e.g. 1.25
+        max_bytes: maximum total size of the pooled buffers, None for no limit
+    """
+
+    def __init__(self, growth: float = 1.0, max_bytes: Optional[int] = None):
+        self.growth = growth
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.unpooled = 0
+        self._buffers: Dict[str, np.ndarray] = {}
+        self._role_hits: Dict[str, int] = {}
+        self._role_misses: Dict[str, int] = {}
+
+    @property
+    def nbytes(self) -> int:
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+    def get(self, role: str, shape, dtype, fill=None) -> np.ndarray:
+        """Array of `shape` and `dtype` backed by the buffer of `role`, uninitialized unless `fill` is given"""
+        dtype = np.dtype(dtype)
+        shape = tuple(int(n) for n in np.atleast_1d(shape))
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+
+        buffer = self._buffers.get(role)
+        if buffer is not None and buffer.nbytes >= nbytes:
+            self.hits += 1
+            self._role_hits[role] = self._role_hits.get(role, 0) + 1
+        else:
+            self.misses += 1
+            self._role_misses[role] = self._role_misses.get(role, 0) + 1
+            capacity = max(nbytes, int(nbytes * self.growth))
+            current = buffer.nbytes if buffer is not None else 0
+            if self.max_bytes is not None and self.nbytes - current + capacity > self.max_bytes:
+                capacity = nbytes
+            if self.max_bytes is not None and self.nbytes - current + capacity > self.max_bytes:
+                self.unpooled += 1
+                array = np.empty(shape, dtype=dtype)
+                if fill is not None:
+                    array.fill(fill)
+                return array
+            # drop the old buffer before allocating the new one
+            self._buffers.pop(role, None)
+            del buffer
+            buffer = np.empty(capacity, dtype=np.uint8)
+            self._buffers[role] = buffer
+
+        array = buffer[:nbytes].view(dtype).reshape(shape)
+        if fill is not None:
+            array.fill(fill)
+        return array
+
+    @property
+    def hit_rate(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.
+
+    def report(self) -> Dict:
+        """Hit rate and buffer size per role, and totals"""
+        roles = {role: {'hits': self._role_hits.get(role, 0), 'misses': self._role_misses.get(role, 0),
+                        'nbytes': self._buffers[role].nbytes if role in self._buffers else 0}
+                 for role in sorted(set(self._role_hits) | set(self._role_misses))}
+        return {'hits': self.hits, 'misses': self.misses, 'unpooled': self.unpooled, 'hit_rate': self.hit_rate,
+                'nbytes': self.nbytes, 'roles': roles}
+
+    def clear(self):
+        self._buffers.clear()
+
+    def __len__(self):
+        return len(self._buffers)
+
+
+_worker_pool = None
+
+
+def get_worker_pool(growth: float = 1.0, max_bytes: Optional[int] = None) -> BufferPool:
+    """Return the `BufferPool` of the current process, creating it on first use"""
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = BufferPool(growth=growth, max_bytes=max_bytes)
+    return _worker_pool
@@ -6,6 +6,8 @@ import argparse
 import logging
 import os, sys
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
 from tempfile import NamedTemporaryFile
 from typing import Optional, Union
@@ -14,12 +16,22 @@ import astropy.convolution
 import fiona
 import numpy as np
 import rasterio.crs
+import rasterio.features
+import rasterio.io
 import rasterio.mask
 from asf_tools.dem import prepare_dem_vrt
 # from asf_tools.raster import write_cog
 from pysheds.sgrid import sGrid
+from pysheds.sview import Raster, ViewFinder
 from shapely.geometry import GeometryCollection, shape
 
+import d8
+from buffer_pool import BufferPool
+from conditioning import condition_dem
+from drainage_network import network_file_name, write_drainage_network
+from float32_to_uint16 import encode_block_uint16
+from hand_stats import drainage_threshold, hand_statistics, write_stats
+
 log = logging.getLogger(__name__)
 
 
@@ -27,8 +39,52 @@ from osgeo import gdal
 from asf_tools.util import epsg_to_wkt
 from typing import List, Literal, Union
 
+# COG creation options per output profile. `lzw` is the historical default; the predictor profiles
+# compress the smooth uint16 HAND/flow_acc rasters considerably better.
+COG_PROFILES = {
+    'lzw': {'COMPRESS': 'LZW', 'OVERVIEW_RESAMPLING': 'AVERAGE'},
+    'deflate': {'COMPRESS': 'DEFLATE', 'PREDICTOR': '2', 'LEVEL': '6', 'OVERVIEW_RESAMPLING': 'AVERAGE'},
+    'zstd': {'COMPRESS': 'ZSTD', 'PREDICTOR': '2', 'LEVEL': '9', 'OVERVIEW_RESAMPLING': 'AVERAGE'},
+    # LERC is lossy up to MAX_Z_ERROR; 0.5 is lossless for integer data such as HAND x 10
+    'lerc': {'COMPRESS': 'LERC_ZSTD', 'MAX_Z_ERROR': '0.5', 'OVERVIEW_RESAMPLING': 'AVERAGE'},
+}
+
+
+def cog_options(profile: str = 'lzw', blocksize: Optional[int] = None, overview_resampling: Optional[str] = None,
+                overviews: Optional[str] = None, max_z_error: Optional[float] = None) -> List[str]:
+    """Build the GDAL COG driver creation options for an output profile
+
+    Args:
+        profile: One of `COG_PROFILES`
+        blocksize: Tile size in pixels (GDAL default: 512)
+        overview_resampling: Resampling method for the overviews, e.g. `NEAREST` or `AVERAGE`
+        overviews: `AUTO` (default), `NONE` or `IGNORE_EXISTING`
+        max_z_error: Maximum error for the `lerc` profile
+
+    Returns:
+        options: creation options, including `NUM_THREADS=ALL_CPUS` and `BIGTIFF=YES`
+    """
+    if profile not in COG_PROFILES:
+        raise ValueError(f'Unknown COG profile {profile}, expected one of {list(COG_PROFILES)}')
+
+    creation_options = dict(COG_PROFILES[profile])
+    if blocksize is not None:
+        creation_options['BLOCKSIZE'] = str(blocksize)
+    if overview_resampling is not None:
+        creation_options['OVERVIEW_RESAMPLING'] = overview_resampling.upper()
+    if overviews is not None:
+        creation_options['OVERVIEWS'] = overviews.upper()
+    if max_z_error is not None:
+        if 'MAX_Z_ERROR' not in creation_options:
+            raise ValueError(f'max_z_error is only supported by the lerc profile, not {profile}')
+        creation_options['MAX_Z_ERROR'] = str(max_z_error)
+    creation_options.update({'NUM_THREADS': 'ALL_CPUS', 'BIGTIFF': 'YES'})
+
+    return [f'{key}={value}' for key, value in creation_options.items()]
+
+
 def write_cog(file_name: Union[str, Path], data: np.ndarray, transform: List[float], epsg_code: int,
-              dtype=gdal.GDT_Float32, nodata_value=None):
+              dtype=gdal.GDT_Float32, nodata_value=None, options: Optional[List[str]] = None):
     """Creates a Cloud Optimized GeoTIFF
 
     Args:
@@ -38,6 +94,7 @@ def write_cog(file_name: Union[str, Path], data: np.ndarray, transform: List[flo
         epsg_code: The integer EPSG code for the output GeoTIFF projection
         dtype: The pixel data type for the output GeoTIFF
         nodata_value: The NODATA value for the output Geotiff
+        options: COG creation options, see `cog_options`. Defaults to the `lzw` profile
 
     Returns:
         file_name: The output file name
@@ -54,30 +111,66 @@ def write_cog(file_name: Union[str, Path], data: np.ndarray, transform: List[flo
       temp_geotiff.SetProjection(epsg_to_wkt(epsg_code))
 
       driver = gdal.GetDriverByName('COG')
-      options = ['COMPRESS=LZW', 'OVERVIEW_RESAMPLING=AVERAGE', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=YES']
+      if options is None:
+          options = cog_options('lzw')
       driver.CreateCopy(str(file_name), temp_geotiff, options=options)
 
       del temp_geotiff  # How to close w/ gdal
 
     return file_name
 
-def fill_nan(array: np.ndarray) -> np.ndarray:
+def _interpolate_tiles(array: np.ndarray, kernel, tile_size: int, n_threads: int) -> np.ndarray:
+    """One `interpolate_replace_nans` pass over the tiles of `array` that contain NaNs, in parallel threads
+
+    Every tile is convolved with a halo of half the kernel size, so the result is the same as a single pass
+    over the whole array.
+    """
+    halo = max(kernel.shape) // 2
+    nrows, ncols = array.shape
+    nan_mask = np.isnan(array)
+    tiles = [(row, col) for row in range(0, nrows, tile_size) for col in range(0, ncols, tile_size)
+             if nan_mask[row:row + tile_size, col:col + tile_size].any()]
+    del nan_mask
+    filled = array.copy()
+
+    def interpolate_tile(tile):
+        row, col = tile
+        row_start, col_start = max(row - halo, 0), max(col - halo, 0)
+        row_stop, col_stop = min(row + tile_size + halo, nrows), min(col + tile_size + halo, ncols)
+        result = astropy.convolution.interpolate_replace_nans(
+            array[row_start:row_stop, col_start:col_stop], kernel, convolve=astropy.convolution.convolve
+        )
+        filled[row:row + tile_size, col:col + tile_size] = result[row - row_start:row - row_start + tile_size,
+                                                                  col - col_start:col - col_start + tile_size]
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(interpolate_tile, tiles))
+
+    return filled
+
+def fill_nan(array: np.ndarray, n_threads: Optional[int] = None, tile_size: int = 2048) -> np.ndarray:
     """Replace NaNs with values interpolated from their neighbors
 
     Replace NaNs with values interpolated from their neighbors using a 2D Gaussian
     kernel, see: https://docs.astropy.org/en/stable/convolution/#using-astropy-s-convolution-to-replace-bad-data
+
+    With `n_threads` > 1, every pass runs over `tile_size` tiles in parallel threads (see `_interpolate_tiles`),
+    which gives the same result and only convolves the tiles that still contain NaNs.
     """
     kernel = astropy.convolution.Gaussian2DKernel(x_stddev=3)  # kernel x_size=8*stddev
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
         while np.any(np.isnan(array)):
-            array = astropy.convolution.interpolate_replace_nans(
-                array, kernel, convolve=astropy.convolution.convolve
-            )
+            if n_threads is not None and n_threads > 1:
+                array = _interpolate_tiles(array, kernel, tile_size, n_threads)
+            else:
+                array = astropy.convolution.interpolate_replace_nans(
+                    array, kernel, convolve=astropy.convolution.convolve
+                )
 
     return array
 
-def fill_hand(hand: np.ndarray, dem: np.ndarray):
+def fill_hand(hand: np.ndarray, dem: np.ndarray, n_threads: Optional[int] = None):
     """Replace NaNs in a HAND array with values interpolated from their neighbor's HOND
 
     Replace NaNs in a HAND array with values interpolated from their neighbor's HOND (height of nearest drainage)
@@ -85,16 +178,43 @@ def fill_hand(hand: np.ndarray, dem: np.ndarray):
     https://docs.astropy.org/en/stable/convolution/#using-astropy-s-convolution-to-replace-bad-data
     """
     hond = dem - hand
-    hond = fill_nan(hond)
+    hond = fill_nan(hond, n_threads=n_threads)
 
     hand_mask = np.isnan(hand)
     hand[hand_mask] = dem[hand_mask] - hond[hand_mask]
-    hand[hand < 0] = 0
+    np.maximum(hand, 0, out=hand)
 
     return hand
 
+def _empty(pool: Optional[BufferPool], role: str, shape, dtype) -> np.ndarray:
+    """Uninitialized array, from `pool` if given"""
+    if pool is None:
+        return np.empty(shape, dtype=dtype)
+    return pool.get(role, shape, dtype)
+
+def basin_geometry_mask(src, geometries, pool: Optional[BufferPool] = None):
+    """`rasterio.mask.raster_geometry_mask` cropped to the geometries with one pixel of padding, all touched
+
+    With a `pool`, the mask is burned into the pooled 'basin_mask' buffer instead of a new array.
+
+    Returns:
+        basin_mask: Array of booleans, True outside of the geometries
+        transform: Affine transform of the window
+        window: Window of the geometries in `src`
+    """
+    if pool is None:
+        return rasterio.mask.raster_geometry_mask(src, geometries, all_touched=True, crop=True, pad=True, pad_width=1)
+
+    window = rasterio.features.geometry_window(src, geometries, pad_x=1, pad_y=1)
+    transform = src.window_transform(window)
+    burned = pool.get('basin_mask', (int(window.height), int(window.width)), np.uint8, fill=1)
+    rasterio.features.rasterize(geometries, out=burned, transform=transform, all_touched=True, default_value=0)
+    return burned.view(bool), transform, window
+
 def calculate_hand(dem_array, dem_affine: rasterio.Affine, dem_crs: rasterio.crs.CRS, basin_mask,
-                   acc_thresh: Optional[int] = 100):
+                   acc_thresh: Optional[int] = 100, conditioning: str = 'pysheds', routing_engine: str = 'pysheds',
+                   n_threads: Optional[int] = None, network_file: Optional[Union[str, Path]] = None,
+                   pool: Optional[BufferPool] = None, tmp_dir: Union[str, Path] = "outputs/tmp_dir"):
     """Calculate the Height Above Nearest Drainage (HAND)
 
      Calculate the Height Above Nearest Drainage (HAND) using pySHEDS library. Because HAND
@@ -122,8 +242,29 @@ def calculate_hand(dem_array, dem_affine: rasterio.Affine, dem_crs: rasterio.crs
         basin_mask: Array of booleans indicating wither an element should be masked out (à la Numpy Masked Arrays:
             https://numpy.org/doc/stable/reference/maskedarray.generic.html#what-is-a-masked-array)
         acc_thresh: Accumulation threshold for determining the drainage mask.
-            If `None`, the mean accumulation value is used
+            If `None`, the mean accumulation inside the basin is used, see `hand_stats.drainage_threshold`
+        conditioning: Engine for filling pits/depressions and resolving flats, one of
+            `conditioning.CONDITIONING_ENGINES`: `pysheds` or the single-pass `priority_flood`
+        routing_engine: Engine for flow direction, accumulation and HAND: `pysheds`, or `numba` for the
+            compiled kernels in `d8` (int16 flow direction, float32 accumulation, int32 topology)
+        n_threads: Number of threads inside the basin: numba kernels and tiles of the NaN filling. With `pysheds`
+            routing only the flow direction and the NaN filling are threaded; with `numba` routing also
+            accumulation and HAND, level by level (`d8.partition_levels`). The thread count is restored on
+            return. `None` keeps the single-threaded code paths of the previous releases for accumulation, HAND
+            and NaN filling
+        network_file: If given, the drainage network inside the basin is written to this GeoParquet file as line
+            segments with Strahler order and accumulation, see `drainage_network.py`
+        pool: Work buffers reused across basins for the nodata and drainage masks, see `buffer_pool.py`
+        tmp_dir: Folder of the temporary DEM GeoTIFF read by pySHEDS, a uniquely named file deleted after reading
     """
+    with d8.threads(n_threads):
+        return _calculate_hand(dem_array, dem_affine, dem_crs, basin_mask, acc_thresh, conditioning, routing_engine,
+                               n_threads, network_file, pool, tmp_dir)
+
+def _calculate_hand(dem_array, dem_affine, dem_crs, basin_mask, acc_thresh, conditioning, routing_engine, n_threads,
+                    network_file, pool, tmp_dir):
+    parallel = n_threads is not None and n_threads > 1
+
     nodata_fill_value = np.finfo(float).eps
     # with NamedTemporaryFile() as temp_file:
     #     write_cog(temp_file.name, dem_array,
@@ -135,48 +276,87 @@ def calculate_hand(dem_array, dem_affine: rasterio.Affine, dem_crs: rasterio.crs
     #     grid = sGrid.from_raster(str(temp_file.name))
     #     dem = grid.read_raster(str(temp_file.name))
 
-    out_path = Path("outputs/tmp_dir")
-    out_name = str(out_path / "fabdem.tif")
-    write_cog(out_name, dem_array,
-                  transform=dem_affine.to_gdal(), epsg_code=dem_crs.to_epsg(),
-                  # Prevents PySheds from assuming using zero as the nodata value
-                  nodata_value=nodata_fill_value)
-
-    # From PySheds; see example usage: http://mattbartos.com/pysheds/
-    grid = sGrid.from_raster(out_name)
-    dem = grid.read_raster(out_name)
-
-    log.info('Fill pits in DEM')
-    pit_filled_dem = grid.fill_pits(dem)
-
-    log.info('Filling depressions')
-    flooded_dem = grid.fill_depressions(pit_filled_dem)
-    del pit_filled_dem
-
-    log.info('Resolving flats')
-    inflated_dem = grid.resolve_flats(flooded_dem)
-    del flooded_dem
-
-    log.info('Obtaining flow direction')
-    flow_dir = grid.flowdir(inflated_dem, apply_mask=True)
-
-    log.info('Calculating flow accumulation')
-    acc = grid.accumulation(flow_dir)
-
-    if acc_thresh is None:
-        acc_thresh = acc.mean()
+    # one file per call, so that workers sharing `tmp_dir` do not overwrite each other's DEM
+    out_path = Path(tmp_dir)
+    out_path.mkdir(exist_ok=True, parents=True)
+    with NamedTemporaryFile(dir=out_path, prefix="fabdem_", suffix=".tif", delete=False) as temp_file:
+        out_name = temp_file.name
+    try:
+        write_cog(out_name, dem_array,
+                      transform=dem_affine.to_gdal(), epsg_code=dem_crs.to_epsg(),
+                      # Prevents PySheds from assuming using zero as the nodata value
+                      nodata_value=nodata_fill_value)
+
+        # From PySheds; see example usage: http://mattbartos.com/pysheds/
+        grid = sGrid.from_raster(out_name)
+        dem = grid.read_raster(out_name)
+    finally:
+        Path(out_name).unlink(missing_ok=True)
+
+    inflated_dem = condition_dem(grid, dem, engine=conditioning)
+
+    if routing_engine == 'numba':
+        inflated_values = np.asarray(inflated_dem)
+        nodata_cells = np.isnan(inflated_values, out=_empty(pool, 'nodata_cells', inflated_values.shape, bool))
+        nodata_cells[inflated_values == inflated_dem.nodata] = True
+
+        log.info('Obtaining flow direction (compiled D8)')
+        flow_dir = d8.flowdir(inflated_values, nodata_cells, abs(dem_affine.a), abs(dem_affine.e))
+        receivers = d8.receivers(flow_dir)
+        order = d8.topological_order(receivers)
+        if parallel:
+            order, starts = d8.partition_levels(receivers, order)
+
+        log.info('Calculating flow accumulation (compiled D8)')
+        if parallel:
+            acc = d8.accumulation_parallel(receivers, order, starts, ~nodata_cells)
+        else:
+            acc = d8.accumulation(receivers, order, ~nodata_cells)
+    elif routing_engine == 'pysheds':
+        log.info('Obtaining flow direction')
+        flow_dir = grid.flowdir(inflated_dem, apply_mask=True)
+
+        log.info('Calculating flow accumulation')
+        acc = grid.accumulation(flow_dir)
+    else:
+        raise ValueError(f"Unknown routing engine {routing_engine}, expected 'pysheds' or 'numba'")
+
+    # the default is the mean inside the basin, as counted in the statistics sidecar
+    acc_thresh = drainage_threshold(acc, acc_thresh, mask=basin_mask)
 
     log.info(f'Calculating HAND using accumulation threshold of {acc_thresh}')
-    hand = grid.compute_hand(flow_dir, inflated_dem, acc > acc_thresh, inplace=False)
+    drainage = np.greater(acc, acc_thresh, out=_empty(pool, 'drainage', acc.shape, bool))
+    if routing_engine == 'numba':
+        if parallel:
+            hand = d8.hand_parallel(inflated_values, receivers, order, starts, drainage)
+            del starts
+        else:
+            hand = d8.hand(inflated_values, receivers, order, drainage)
+    else:
+        drainage_raster = Raster(drainage, viewfinder=ViewFinder(affine=acc.affine, shape=acc.shape, crs=acc.crs,
+                                                                  nodata=False))
+        hand = grid.compute_hand(flow_dir, inflated_dem, drainage_raster, inplace=False)
+        del drainage_raster
+
+    if network_file is not None:
+        if routing_engine != 'numba':
+            # same ESRI codes as the pySHEDS flow directions
+            receivers = d8.receivers(np.asarray(flow_dir).astype(np.int16))
+            order = d8.topological_order(receivers)
+        drainage[basin_mask] = False
+        write_drainage_network(network_file, receivers, order, drainage, acc, dem_affine, crs=dem_crs)
+    if routing_engine == 'numba' or network_file is not None:
+        del receivers, order
+    del drainage
 
     # write acc raster
-    acc[basin_mask] = np.nan
+    np.copyto(acc, np.nan, where=basin_mask)
 
     if np.isnan(hand).any():
         log.info('Filling NaNs in the HAND')
         # mask outside of basin with a not-NaN value to prevent NaN-filling outside of basin (optimization)
         hand[basin_mask] = nodata_fill_value
-        hand = fill_hand(hand, dem_array)
+        hand = fill_hand(hand, dem_array, n_threads=n_threads)
 
     # # TODO: rescale hand by 10 to save space
     # hand = hand * 10
@@ -184,7 +364,7 @@ def calculate_hand(dem_array, dem_affine: rasterio.Affine, dem_crs: rasterio.crs
     # hand[basin_mask] = 65535
 
     # # set pixels outside of basin to nodata
-    hand[basin_mask] = np.nan
+    np.copyto(hand, np.nan, where=basin_mask)
 
     # TODO: also mask ocean pixels here?
 
@@ -192,11 +372,57 @@ def calculate_hand(dem_array, dem_affine: rasterio.Affine, dem_crs: rasterio.crs
 
 def to_uint16(data, nodata_value=65535):
     # convert datatype from float32 into uint16
-    data[np.isnan(data)] = nodata_value
-    return data.astype(np.uint16)
+    return encode_uint16(data, nodata_value=nodata_value)
+
+def encode_uint16(data: np.ndarray, scale: float = 1, nodata_value: int = 65535,
+                  mask: Optional[np.ndarray] = None, block_rows: int = 1024, out: Optional[np.ndarray] = None,
+                  pool: Optional[BufferPool] = None) -> np.ndarray:
+    """Scale, clip and cast a float array into uint16 without full-size temporaries
+
+    The conversion runs over blocks of `block_rows` rows with `out=` ufuncs, so besides the uint16 output
+    only one block-sized float buffer and boolean mask are allocated. Values are scaled by `scale`,
+    clipped to [0, nodata_value - 1] (so e.g. flow accumulation saturates instead of wrapping) and
+    truncated, see `float32_to_uint16.encode_block_uint16`. NaNs and the pixels where `mask` is True are set to
+    `nodata_value`. `data` is not modified.
+
+    Args:
+        data: Float array to encode, e.g. HAND or flow accumulation
+        scale: Multiplier applied before casting, e.g. 10 for HAND
+        nodata_value: The NODATA value of the output
+        mask: Array of booleans indicating which elements are outside of the basin, e.g. `basin_mask`
+        block_rows: Number of rows processed at once
+        out: uint16 array of the same shape as `data` to write into, e.g. from a `BufferPool`
+        pool: Pool of the block-sized buffers, see `buffer_pool.py`
+
+    Returns:
+        encoded: uint16 array of the same shape as `data`
+    """
+    encoded = np.empty(data.shape, dtype=np.uint16) if out is None else out
+    block_shape = (min(block_rows, data.shape[0]),) + data.shape[1:]
+    buffer = _empty(pool, 'encode_block', block_shape, np.float64)
+    invalid = _empty(pool, 'encode_invalid', block_shape, bool)
+
+    for row in range(0, data.shape[0], block_rows):
+        block = np.asarray(data[row:row + block_rows])
+        n_rows = block.shape[0]
+        block_buffer, block_invalid = buffer[:n_rows], invalid[:n_rows]
+
+        np.isnan(block, out=block_invalid)
+        if mask is not None:
+            np.logical_or(block_invalid, mask[row:row + n_rows], out=block_invalid)
+
+        encode_block_uint16(block, encoded[row:row + n_rows], scale=scale, nodata_value=nodata_value,
+                            invalid=block_invalid, buffer=block_buffer)
+
+    return encoded
 
 def calculate_hand_for_basins(out_raster:  Union[str, Path], geometries: GeometryCollection,
-                              dem_file: Union[str, Path], acc_thresh: Optional[int] = 100):
+                              dem_file: Union[str, Path], acc_thresh: Optional[int] = 100,
+                              cog_profile: str = 'lzw', conditioning: str = 'pysheds',
+                              routing_engine: str = 'pysheds', n_threads: Optional[int] = None,
+                              stats: bool = True, network_dir: Optional[Union[str, Path]] = None,
+                              pool: Optional[BufferPool] = None, overwrite_flow_acc: bool = False,
+                              output_dir: Union[str, Path] = "outputs"):
     """Calculate the Height Above Nearest Drainage (HAND) for watershed boundaries (hydrobasins).
 
     For watershed boundaries, see: https://www.hydrosheds.org/page/hydrobasins
@@ -204,32 +430,65 @@ def calculate_hand_for_basins(out_raster:  Union[str, Path], geometries: Geometr
     Args:
         out_raster: HAND GeoTIFF to create
         geometries: watershed boundary (hydrobasin) polygons to calculate HAND over
-        dem_file: DEM raster covering (containing) `geometries`
+        dem_file: DEM raster covering (containing) `geometries`, or an already open rasterio dataset of it
+            (e.g. a global VRT from `dem_cache.DatasetCache`), which is left open
         acc_thresh: Accumulation threshold for determining the drainage mask.
-            If `None`, the mean accumulation value is used
+            If `None`, the mean accumulation inside the basin is used, see `hand_stats.drainage_threshold`
+        cog_profile: Compression profile of the output COGs, one of `COG_PROFILES`
+        conditioning: DEM conditioning engine, see `calculate_hand`
+        routing_engine: Flow direction, accumulation and HAND engine, see `calculate_hand`
+        n_threads: Number of threads inside the basin, see `calculate_hand`
+        stats: Write the HAND statistics sidecar next to `out_raster`, see `hand_stats.py`
+        network_dir: If given, the drainage network is written there as GeoParquet,
+            e.g. hand_100_basin5_id_1.tif -> drainage_100_basin5_id_1.parquet
+        pool: Work buffers reused across basins (DEM window, masks, uint16 outputs), e.g. the pool of a worker
+            from `buffer_pool.get_worker_pool`
+        overwrite_flow_acc: Rewrite the flow accumulation even if it exists, e.g. when the inputs of the basin
+            changed; otherwise it is only written once for all accumulation thresholds
+        output_dir: Output root; the flow accumulation is written to `output_dir`/flow_acc and the temporary DEM
+            to `output_dir`/tmp_dir
     """
 
     nodata_value = 65535
-    with rasterio.open(dem_file) as src:
-        basin_mask, basin_affine_tf, basin_window = rasterio.mask.raster_geometry_mask(
-            src, geometries.geoms, all_touched=True, crop=True, pad=True, pad_width=1
-        )
-        basin_array = src.read(1, window=basin_window)
+    options = cog_options(cog_profile)
+    if isinstance(dem_file, rasterio.io.DatasetReader):
+        dem_context = nullcontext(dem_file)
+    else:
+        dem_context = rasterio.open(dem_file)
 
-        hand, acc = calculate_hand(basin_array, basin_affine_tf, src.crs, basin_mask, acc_thresh=acc_thresh)
+    with dem_context as src:
+        basin_mask, basin_affine_tf, basin_window = basin_geometry_mask(src, geometries.geoms, pool=pool)
+        basin_array = src.read(1, window=basin_window, out=_empty(pool, 'dem', basin_mask.shape, src.dtypes[0]))
 
-        # TODO: Are these lines necessary ?!! Just rescale here?
-        # convert datatype
-        hand = to_uint16(hand * 10, nodata_value=nodata_value) # rescaled by 10
-        flow_acc = to_uint16(acc, nodata_value=nodata_value) 
+        network_file = None
+        if network_dir is not None:
+            network_file = network_file_name(out_raster, network_dir)
+            network_file.parent.mkdir(exist_ok=True, parents=True)
+
+        hand, acc = calculate_hand(basin_array, basin_affine_tf, src.crs, basin_mask, acc_thresh=acc_thresh,
+                                   conditioning=conditioning, routing_engine=routing_engine, n_threads=n_threads,
+                                   network_file=network_file, pool=pool, tmp_dir=Path(output_dir) / "tmp_dir")
+
+        # convert datatype, reusing basin_mask for the pixels outside of the basin
+        hand = encode_uint16(hand, scale=10, nodata_value=nodata_value, mask=basin_mask, # rescaled by 10
+                             out=_empty(pool, 'hand_uint16', hand.shape, np.uint16), pool=pool)
 
         # write hand, note NaN is not compatible with uint16 data type.
         write_cog(
-            out_raster, hand, transform=basin_affine_tf.to_gdal(), epsg_code=src.crs.to_epsg(), nodata_value=nodata_value, dtype=gdal.GDT_UInt16) # np.nan
+            out_raster, hand, transform=basin_affine_tf.to_gdal(), epsg_code=src.crs.to_epsg(), nodata_value=nodata_value, dtype=gdal.GDT_UInt16, options=options) # np.nan
+
+        # statistics sidecar from the arrays still in memory
+        if stats:
+            write_stats(out_raster, hand_statistics(hand, acc, acc_thresh=acc_thresh, mask=basin_mask),
+                        conditioning=conditioning, routing_engine=routing_engine)
 
         # write accumlation if not exists
         filename = os.path.basename(out_raster) # hand_[100/1000]_basin5_id_6050942390.tif
-        flow_acc_url = Path(f"outputs/flow_acc/flow_acc_basin{filename.split('basin')[-1]}") # flow_acc_basin5_id_6050942390.tif
-        if not flow_acc_url.exists():
-            write_cog(flow_acc_url, flow_acc, transform=basin_affine_tf.to_gdal(), epsg_code=src.crs.to_epsg(), nodata_value=nodata_value, dtype=gdal.GDT_UInt16)
+        flow_acc_url = Path(output_dir) / "flow_acc" / f"flow_acc_basin{filename.split('basin')[-1]}" # flow_acc_basin5_id_6050942390.tif
+        if overwrite_flow_acc or not flow_acc_url.exists():
+            flow_acc_url.parent.mkdir(exist_ok=True, parents=True)
+            flow_acc = encode_uint16(acc, nodata_value=nodata_value, mask=basin_mask,
+                                     out=_empty(pool, 'acc_uint16', acc.shape, np.uint16), pool=pool)
+            del acc
+            write_cog(flow_acc_url, flow_acc, transform=basin_affine_tf.to_gdal(), epsg_code=src.crs.to_epsg(), nodata_value=nodata_value, dtype=gdal.GDT_UInt16, options=options)
         
\ No newline at end of file
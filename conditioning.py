@@ -0,0 +1,176 @@
+"""DEM conditioning engines for `calculate.calculate_hand`
+
+A conditioning engine turns the raw DEM into a DEM without depressions and flats, from which the D8 flow
+direction can be derived:
+    * `pysheds`: pySHEDS `fill_pits`, `fill_depressions` and `resolve_flats`
+    * `priority_flood`: a compiled Priority-Flood+ε (Barnes et al., 2014, https://doi.org/10.1016/j.cageo.2013.04.024),
+      which fills depressions and imposes a minimal gradient on flats in a single pass
+
+Both engines take the pySHEDS grid and DEM raster and return the conditioned DEM as a pySHEDS raster.
+"""
+import logging
+
+import numpy as np
+from numba import njit
+
+log = logging.getLogger(__name__)
+
+
+def condition_dem_pysheds(grid, dem):
+    log.info('Fill pits in DEM')
+    pit_filled_dem = grid.fill_pits(dem)
+
+    log.info('Filling depressions')
+    flooded_dem = grid.fill_depressions(pit_filled_dem)
+    del pit_filled_dem
+
+    log.info('Resolving flats')
+    inflated_dem = grid.resolve_flats(flooded_dem)
+    del flooded_dem
+
+    return inflated_dem
+
+
+# D8 neighbour offsets
+_DROW = np.array([-1, -1, 0, 1, 1, 1, 0, -1], dtype=np.int64)
+_DCOL = np.array([0, 1, 1, 1, 0, -1, -1, -1], dtype=np.int64)
+
+
+@njit(cache=True, nogil=True)
+def _heap_push(keys, cells, size, key, cell):
+    # binary min-heap on the elevation
+    i = size
+    keys[i], cells[i] = key, cell
+    while i > 0:
+        parent = (i - 1) // 2
+        if keys[parent] <= keys[i]:
+            break
+        keys[parent], keys[i] = keys[i], keys[parent]
+        cells[parent], cells[i] = cells[i], cells[parent]
+        i = parent
+    return size + 1
+
+
+@njit(cache=True, nogil=True)
+def _heap_pop(keys, cells, size):
+    cell = cells[0]
+    size -= 1
+    keys[0], cells[0] = keys[size], cells[size]
+    i = 0
+    while True:
+        left, right, smallest = 2 * i + 1, 2 * i + 2, i
+        if left < size and keys[left] < keys[smallest]:
+            smallest = left
+        if right < size and keys[right] < keys[smallest]:
+            smallest = right
+        if smallest == i:
+            break
+        keys[smallest], keys[i] = keys[i], keys[smallest]
+        cells[smallest], cells[i] = cells[i], cells[smallest]
+        i = smallest
+    return cell, size
+
+
+@njit(cache=True, nogil=True)
+def priority_flood_epsilon(dem, nodata_mask):
+    """Priority-Flood+ε on a float64 DEM, in place
+
+    Cells on the raster edge and next to nodata cells drain out of the raster and seed the flood. Cells
+    reached from a lower or equal cell are raised to the next representable float64 value above it and
+    processed through a plain FIFO queue (the "pit" queue) instead of the heap, which is what makes the
+    algorithm fast on large flats. The heap is keyed on the elevation only: flats are ordered by the pit queue
+    and a cell whose elevation equals the top of the heap is taken from the heap first, as in Barnes et al.
+
+    Memory is the DEM itself plus 17 bytes per cell: float64 heap keys, int32 heap and pit cells and the
+    closed flags.
+
+    Args:
+        dem: float64 array, modified in place
+        nodata_mask: boolean array, True for nodata cells, which are left unchanged
+
+    Returns:
+        dem
+    """
+    nrows, ncols = dem.shape
+    n = nrows * ncols
+    if n > np.iinfo(np.int32).max:
+        raise ValueError('DEM too large for int32 cell indices')
+    closed = nodata_mask.copy().ravel()
+    flat = dem.ravel()
+    inf = np.inf
+
+    keys = np.empty(n, dtype=np.float64)
+    cells = np.empty(n, dtype=np.int32)
+    heap_size = 0
+
+    pit = np.empty(n, dtype=np.int32)
+    pit_head = 0
+    pit_tail = 0
+
+    # seeds: edge cells and cells next to nodata
+    for row in range(nrows):
+        for col in range(ncols):
+            cell = row * ncols + col
+            if closed[cell]:
+                continue
+            is_seed = row == 0 or col == 0 or row == nrows - 1 or col == ncols - 1
+            if not is_seed:
+                for k in range(8):
+                    if nodata_mask[row + _DROW[k], col + _DCOL[k]]:
+                        is_seed = True
+                        break
+            if is_seed:
+                closed[cell] = True
+                heap_size = _heap_push(keys, cells, heap_size, flat[cell], cell)
+
+    while heap_size > 0 or pit_head < pit_tail:
+        if pit_head < pit_tail and not (heap_size > 0 and keys[0] == flat[pit[pit_head]]):
+            cell = np.int64(pit[pit_head])
+            pit_head += 1
+        else:
+            popped, heap_size = _heap_pop(keys, cells, heap_size)
+            cell = np.int64(popped)
+
+        row, col = cell // ncols, cell % ncols
+        raised = np.nextafter(flat[cell], inf)
+        for k in range(8):
+            nrow, ncol = row + _DROW[k], col + _DCOL[k]
+            if nrow < 0 or nrow >= nrows or ncol < 0 or ncol >= ncols:
+                continue
+            neighbour = nrow * ncols + ncol
+            if closed[neighbour]:
+                continue
+            closed[neighbour] = True
+            if flat[neighbour] <= raised:
+                flat[neighbour] = raised
+                pit[pit_tail] = neighbour
+                pit_tail += 1
+            else:
+                heap_size = _heap_push(keys, cells, heap_size, flat[neighbour], neighbour)
+
+    return dem
+
+
+def condition_dem_priority_flood(grid, dem):
+    from pysheds.sview import Raster
+
+    log.info('Filling depressions and resolving flats (Priority-Flood+ε)')
+    nodata_mask = np.isnan(dem) | (dem == dem.nodata)
+    # float64 so the ε increments on large flats stay far below the DEM precision: in float32 they are rounded to
+    # its spacing at high elevations, raising a 400 x 400 flat at 3800 m by about 0.1 m, one uint16 HAND unit
+    conditioned = priority_flood_epsilon(np.array(dem, dtype=np.float64), np.asarray(nodata_mask))
+
+    return Raster(conditioned, viewfinder=dem.viewfinder)
+
+
+CONDITIONING_ENGINES = {
+    'pysheds': condition_dem_pysheds,
+    'priority_flood': condition_dem_priority_flood,
+}
+
+
+def condition_dem(grid, dem, engine='pysheds'):
+    """Condition `dem` with the given engine, one of `CONDITIONING_ENGINES`"""
+    if engine not in CONDITIONING_ENGINES:
+        raise ValueError(f'Unknown conditioning engine {engine}, expected one of {list(CONDITIONING_ENGINES)}')
+    return CONDITIONING_ENGINES[engine](grid, dem)
@@ -0,0 +1,200 @@
+"""Co-register HAND and flow accumulation with EarthView samples
+
+For a stream of EarthView items, the HAND / flow_acc pixels under every item are looked up in the per-basin
+outputs of `calculate_hand_for_basins` and attached to the item as extra channels, on the item's own grid:
+    * `HandIndex` indexes the bounds of the per-basin HAND COGs in an STRtree
+    * `coregister_batch` computes the pixel centres of all items of a batch, transforms them into lon/lat with
+      one transformer call per CRS, reads every intersecting basin window once for the whole batch and samples
+      it (nearest neighbour) for all item pixels at once
+
+Example:
+    index = HandIndex.from_folder("outputs/hand_acc100", "outputs/flow_acc")
+    for item in coregister_stream(ev.load_dataset("satellogic", shards=[10]), index, subset="satellogic"):
+        item["hand"], item["flow_acc"]  # uint16, HAND x 10, nodata 65535
+"""
+import json
+from functools import lru_cache
+from itertools import islice
+from pathlib import Path
+
+import numpy as np
+import rasterio
+import shapely
+from pyproj import Transformer
+from rasterio.windows import Window, from_bounds as window_from_bounds
+from shapely import STRtree
+
+from dem_cache import DatasetCache
+
+NODATA_VALUE = 65535
+
+# field whose last two dimensions define the item grid
+GRID_FIELDS = {
+    "satellogic": "rgb",
+    "sentinel_1": "10m",
+    "neon": "rgb",
+}
+
+
+@lru_cache(maxsize=None)
+def get_lonlat_transformer(crs):
+    return Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
+
+
+class HandIndex:
+    """
+    Spatial index of per-basin HAND COGs and their flow_acc COGs
+
+    hand_files: list of HAND COGs, e.g. outputs/hand_acc100/hand_100_basin5_id_2050012730.tif
+    flow_acc_dir: folder of the flow_acc COGs, named as in `calculate_hand_for_basins`
+    bounds: optional lon/lat bounds of `hand_files`; read from the files if not given
+    """
+
+    def __init__(self, hand_files, flow_acc_dir="outputs/flow_acc", bounds=None, max_open=64):
+        self.hand_files = [Path(f) for f in hand_files]
+        self.flow_acc_dir = Path(flow_acc_dir)
+        if bounds is None:
+            bounds = []
+            for hand_file in self.hand_files:
+                with rasterio.open(hand_file) as src:
+                    if src.crs is not None and src.crs.to_epsg() != 4326:
+                        raise ValueError(f"Expected HAND in EPSG:4326, got {src.crs} for {hand_file}")
+                    bounds.append(tuple(src.bounds))
+        self.bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+        self.tree = STRtree(shapely.box(*self.bounds.T))
+        self.datasets = DatasetCache(maxsize=max_open)
+
+    @classmethod
+    def from_folder(cls, hand_dir, flow_acc_dir="outputs/flow_acc", cache_file=None, **kwargs):
+        """Index all hand_*.tif of a folder; with `cache_file`, the bounds are stored there and reused"""
+        hand_files = sorted(Path(hand_dir).glob("hand_*.tif"))
+        if cache_file is not None and Path(cache_file).exists():
+            cached = json.loads(Path(cache_file).read_text())
+            if cached["files"] == [str(f) for f in hand_files]:
+                return cls(hand_files, flow_acc_dir, bounds=cached["bounds"], **kwargs)
+
+        index = cls(hand_files, flow_acc_dir, **kwargs)
+        if cache_file is not None:
+            Path(cache_file).write_text(json.dumps({"files": [str(f) for f in hand_files],
+                                                    "bounds": index.bounds.tolist()}))
+        return index
+
+    def flow_acc_file(self, hand_file):
+        # hand_[100/1000]_basin5_id_6050942390.tif -> flow_acc_basin5_id_6050942390.tif
+        return self.flow_acc_dir / f"flow_acc_basin{hand_file.name.split('basin')[-1]}"
+
+    def query(self, lonlat_boxes):
+        """(box index, file index) pairs of the HAND files intersecting the given lon/lat shapely boxes"""
+        return self.tree.query(lonlat_boxes, predicate="intersects")
+
+    def close(self):
+        self.datasets.close()
+
+
+def _item_grid(item, grid_field=None, shape=None):
+    metadata = item["metadata"]
+    if isinstance(metadata, str):
+        metadata = json.loads(metadata)
+    x_min, y_min, x_max, y_max = metadata["bounds"][0]
+    crs = metadata["crs"][0]
+    if shape is None:
+        shape = np.shape(item[grid_field])[-2:]
+    return (x_min, y_min, x_max, y_max), crs, tuple(shape)
+
+
+def _sample(dataset, window, lon, lat, out, band=1):
+    """Nearest neighbour sampling of `dataset` at lon/lat into `out`, only where `out` is still nodata"""
+    col_start, row_start = max(int(np.floor(window.col_off)), 0), max(int(np.floor(window.row_off)), 0)
+    col_stop = min(int(np.ceil(window.col_off + window.width)) + 1, dataset.width)
+    row_stop = min(int(np.ceil(window.row_off + window.height)) + 1, dataset.height)
+    if col_stop <= col_start or row_stop <= row_start:
+        return
+    window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+    data = dataset.read(band, window=window)
+    transform = dataset.window_transform(window)
+    cols, rows = ~transform * (lon, lat)
+    cols, rows = np.floor(cols).astype(np.int64), np.floor(rows).astype(np.int64)
+
+    inside = (rows >= 0) & (rows < data.shape[0]) & (cols >= 0) & (cols < data.shape[1]) & (out == NODATA_VALUE)
+    values = data[rows[inside], cols[inside]]
+    target = out[inside]
+    valid = values != NODATA_VALUE
+    target[valid] = values[valid]
+    out[inside] = target
+
+
+def coregister_batch(items, index, subset="satellogic", grid_field=None, shape=None):
+    """
+    Attaches "hand" and "flow_acc" (uint16 arrays on the item grid, nodata 65535) to a batch of items
+
+    items: list of EarthView items; their metadata bounds are [x_min, y_min, x_max, y_max] in metadata crs
+    index: `HandIndex` of the per-basin outputs
+    subset: used to pick the field that defines the item grid, see `GRID_FIELDS`
+    grid_field: field whose last two dimensions are the grid (height, width), overrides `subset`
+    shape: explicit (height, width) of the grid, overrides `grid_field`
+
+    returns the items, with the channels added in place
+    """
+    grid_field = grid_field or GRID_FIELDS[subset]
+    grids = [_item_grid(item, grid_field, shape) for item in items]
+
+    # pixel centres of all items in lon/lat, one transformer call per CRS
+    lons, lats = [None] * len(items), [None] * len(items)
+    crs_groups = {}
+    for i, (_, crs, _) in enumerate(grids):
+        crs_groups.setdefault(crs, []).append(i)
+    for crs, idx in crs_groups.items():
+        xs, ys = [], []
+        for i in idx:
+            (x_min, y_min, x_max, y_max), _, (height, width) = grids[i]
+            x = x_min + (np.arange(width) + 0.5) * (x_max - x_min) / width
+            y = y_max - (np.arange(height) + 0.5) * (y_max - y_min) / height
+            x, y = np.meshgrid(x, y)
+            xs.append(x.ravel())
+            ys.append(y.ravel())
+        lon, lat = get_lonlat_transformer(crs).transform(np.concatenate(xs), np.concatenate(ys))
+        offsets = np.cumsum([0] + [len(x) for x in xs])
+        for n, i in enumerate(idx):
+            height, width = grids[i][2]
+            lons[i] = lon[offsets[n]:offsets[n + 1]].reshape(height, width)
+            lats[i] = lat[offsets[n]:offsets[n + 1]].reshape(height, width)
+
+    hands = [np.full(grid[2], NODATA_VALUE, dtype=np.uint16) for grid in grids]
+    accs = [np.full(grid[2], NODATA_VALUE, dtype=np.uint16) for grid in grids]
+
+    item_boxes = shapely.box([lon.min() for lon in lons], [lat.min() for lat in lats],
+                             [lon.max() for lon in lons], [lat.max() for lat in lats])
+    item_idx, file_idx = index.query(item_boxes)
+
+    for f in np.unique(file_idx):
+        hits = item_idx[file_idx == f]
+        hand_file = index.hand_files[f]
+        lon = np.concatenate([lons[i].ravel() for i in hits])
+        lat = np.concatenate([lats[i].ravel() for i in hits])
+        offsets = np.cumsum([0] + [lons[i].size for i in hits])
+
+        # one window per file, covering all items of the batch that intersect it
+        for channels, filename in ((hands, hand_file), (accs, index.flow_acc_file(hand_file))):
+            if not filename.exists():
+                continue
+            dataset = index.datasets.get(filename)
+            window = window_from_bounds(lon.min(), lat.min(), lon.max(), lat.max(), transform=dataset.transform)
+            out = np.concatenate([channels[i].ravel() for i in hits])
+            _sample(dataset, window, lon, lat, out)
+            for n, i in enumerate(hits):
+                channels[i] = out[offsets[n]:offsets[n + 1]].reshape(channels[i].shape)
+
+    for item, hand, acc in zip(items, hands, accs):
+        item["hand"] = hand
+        item["flow_acc"] = acc
+    return items
+
+
+def coregister_stream(items, index, batch_size=64, **kwargs):
+    """Yields the items of a stream with "hand" and "flow_acc" attached, see `coregister_batch`"""
+    items = iter(items)
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            break
+        yield from coregister_batch(batch, index, **kwargs)
@@ -0,0 +1,286 @@
+"""Compiled D8 flow direction, accumulation and HAND kernels
+
+Alternative to pySHEDS `flowdir`, `accumulation` and `compute_hand` with a compact memory layout:
+    * `flowdir`: one parallel sweep over the rows, int16 output with the pySHEDS ESRI codes
+      (64, 128, 1, 2, 4, 8, 16, 32 for N, NE, E, SE, S, SW, W, NW; 0 nodata, -1 flats, -2 pits)
+    * `receivers` / `topological_order`: int32 index of the downstream cell of every cell, and an int32
+      upstream-to-downstream ordering of the cells
+    * `accumulation`: number of upstream cells (including the cell itself) by one pass in topological order
+    * `hand`: height above the nearest downstream drainage cell, by one pass in reverse topological order
+    * `partition_levels` / `accumulation_parallel` / `hand_parallel`: the same passes level by level, the cells
+      of a level (cells at the same longest distance from a source) in parallel, also within single-outlet
+      basins; the thread count is set with `set_threads`, or for a block with `threads`
+
+The results match pySHEDS on the same conditioned DEM, see `conditioning.py`.
+"""
+import math
+from contextlib import contextmanager
+
+import numpy as np
+from numba import njit, prange
+
+DIRMAP = np.array([64, 128, 1, 2, 4, 8, 16, 32], dtype=np.int16)
+_DROW = np.array([-1, -1, 0, 1, 1, 1, 0, -1], dtype=np.int64)
+_DCOL = np.array([0, 1, 1, 1, 0, -1, -1, -1], dtype=np.int64)
+
+NODATA, FLAT, PIT = 0, -1, -2
+
+
+@njit(parallel=True, cache=True, nogil=True)
+def flowdir(dem, nodata_cells, dx, dy):
+    """D8 flow direction of the steepest descent, same rules as pySHEDS `flowdir`
+
+    Args:
+        dem: conditioned DEM (no depressions, no flats)
+        nodata_cells: boolean array, True for nodata cells
+        dx, dy: cell size in x and y
+
+    Returns:
+        fdir: int16 array of `DIRMAP` codes, `NODATA`, `FLAT` or `PIT`
+    """
+    nrows, ncols = dem.shape
+    fdir = np.zeros(dem.shape, dtype=np.int16)
+    dd = math.sqrt(dx ** 2 + dy ** 2)
+    distances = np.array([dy, dd, dx, dd, dy, dd, dx, dd])
+    for row in prange(nrows):
+        for col in range(ncols):
+            if nodata_cells[row, col]:
+                continue
+            elev = dem[row, col]
+            max_slope = -np.inf
+            for k in range(8):
+                nrow, ncol = row + _DROW[k], col + _DCOL[k]
+                if nrow < 0 or nrow >= nrows or ncol < 0 or ncol >= ncols or nodata_cells[nrow, ncol]:
+                    continue
+                slope = (elev - dem[nrow, ncol]) / distances[k]
+                if slope > max_slope:
+                    fdir[row, col] = DIRMAP[k]
+                    max_slope = slope
+            if max_slope == 0:
+                fdir[row, col] = FLAT
+            elif max_slope < 0:
+                fdir[row, col] = PIT
+    return fdir
+
+
+@njit(parallel=True, cache=True, nogil=True)
+def receivers(fdir):
+    """Flat int32 index of the downstream cell of every cell, -1 for nodata, flats, pits and outlets"""
+    nrows, ncols = fdir.shape
+    receiver = np.full(nrows * ncols, -1, dtype=np.int32)
+    for row in prange(nrows):
+        for col in range(ncols):
+            code = fdir[row, col]
+            for k in range(8):
+                if code == DIRMAP[k]:
+                    nrow, ncol = row + _DROW[k], col + _DCOL[k]
+                    if 0 <= nrow < nrows and 0 <= ncol < ncols:
+                        receiver[row * ncols + col] = nrow * ncols + ncol
+                    break
+    return receiver
+
+
+@njit(cache=True, nogil=True)
+def topological_order(receiver):
+    """int32 order of the cells in which every cell comes before its receiver (Kahn's algorithm)
+
+    Cells on a cycle, which do not occur in a conditioned DEM, are left out.
+    """
+    n = receiver.size
+    indegree = np.zeros(n, dtype=np.uint8)
+    for cell in range(n):
+        if receiver[cell] >= 0:
+            indegree[receiver[cell]] += 1
+
+    order = np.empty(n, dtype=np.int32)
+    tail = 0
+    for cell in range(n):
+        if indegree[cell] == 0:
+            order[tail] = cell
+            tail += 1
+
+    head = 0
+    while head < tail:
+        cell = order[head]
+        head += 1
+        downstream = receiver[cell]
+        if downstream >= 0:
+            indegree[downstream] -= 1
+            if indegree[downstream] == 0:
+                order[tail] = downstream
+                tail += 1
+    return order[:tail]
+
+
+@njit(cache=True, nogil=True)
+def accumulation(receiver, order, valid):
+    """float32 number of upstream cells (including the cell itself), 0 for cells that are not `valid`"""
+    acc = np.zeros(receiver.size, dtype=np.float32)
+    flat_valid = valid.ravel()
+    for cell in range(receiver.size):
+        if flat_valid[cell]:
+            acc[cell] = 1
+    for i in range(order.size):
+        cell = order[i]
+        if receiver[cell] >= 0:
+            acc[receiver[cell]] += acc[cell]
+    return acc.reshape(valid.shape)
+
+
+@njit(cache=True, nogil=True)
+def nearest_drainage(receiver, order, drainage):
+    """int32 flat index of the nearest downstream drainage cell of every cell, -1 if none is reached
+
+    As in pySHEDS, the outer rim of the raster is neither drainage nor drains anywhere.
+    """
+    nrows, ncols = drainage.shape
+    nearest = np.full(receiver.size, -1, dtype=np.int32)
+    flat_drainage = drainage.ravel()
+    for i in range(order.size - 1, -1, -1):
+        cell = order[i]
+        row, col = cell // ncols, cell % ncols
+        if row == 0 or col == 0 or row == nrows - 1 or col == ncols - 1:
+            continue
+        if flat_drainage[cell]:
+            nearest[cell] = cell
+        elif receiver[cell] >= 0:
+            nearest[cell] = nearest[receiver[cell]]
+    return nearest
+
+
+@njit(parallel=True, cache=True, nogil=True)
+def _height_above(dem, nearest):
+    flat_dem = dem.ravel()
+    hand = np.empty(flat_dem.size, dtype=dem.dtype)
+    for cell in prange(flat_dem.size):
+        if nearest[cell] >= 0:
+            hand[cell] = flat_dem[cell] - flat_dem[nearest[cell]]
+        else:
+            hand[cell] = np.nan
+    return hand.reshape(dem.shape)
+
+
+def hand(dem, receiver, order, drainage):
+    """Height Above Nearest Drainage, NaN where no drainage cell is reached, same as pySHEDS `compute_hand`"""
+    return _height_above(np.ascontiguousarray(dem), nearest_drainage(receiver, order, np.asarray(drainage)))
+
+
+def set_threads(n_threads):
+    """Number of threads of the parallel kernels (also used by the pySHEDS numba kernels), None for all cores
+
+    This holds for the calling thread until changed again, see `threads` for a scoped setting. Returns the
+    previous number of threads.
+    """
+    import numba
+
+    previous = numba.get_num_threads()
+    if n_threads is None:
+        n_threads = numba.config.NUMBA_NUM_THREADS
+    numba.set_num_threads(max(1, min(int(n_threads), numba.config.NUMBA_NUM_THREADS)))
+    return previous
+
+
+@contextmanager
+def threads(n_threads):
+    """Runs the block with `set_threads(n_threads)` and restores the previous thread count afterwards"""
+    import numba
+
+    previous = numba.get_num_threads()
+    if n_threads is not None:
+        set_threads(n_threads)
+    try:
+        yield
+    finally:
+        numba.set_num_threads(previous)
+
+
+@njit(cache=True, nogil=True)
+def _group_by_level(receiver, order):
+    # level of a cell: length of the longest path from a source; its receiver has a higher level
+    level = np.zeros(receiver.size, dtype=np.int32)
+    n_levels = 0
+    for i in range(order.size):
+        cell = order[i]
+        if level[cell] + 1 > n_levels:
+            n_levels = level[cell] + 1
+        downstream = receiver[cell]
+        if downstream >= 0 and level[cell] + 1 > level[downstream]:
+            level[downstream] = level[cell] + 1
+
+    # counting sort of the cells of `order` by level
+    starts = np.zeros(n_levels + 1, dtype=np.int64)
+    for i in range(order.size):
+        starts[level[order[i]] + 1] += 1
+    for l in range(n_levels):
+        starts[l + 1] += starts[l]
+    tail = starts[:-1].copy()
+    level_order = np.empty(order.size, dtype=np.int32)
+    for i in range(order.size):
+        cell = order[i]
+        level_order[tail[level[cell]]] = cell
+        tail[level[cell]] += 1
+    return level_order, starts
+
+
+def partition_levels(receiver, order):
+    """Groups the cells of the topological order into levels of cells that do not depend on each other
+
+    The level of a cell is the length of the longest flow path from a source down to it, so all donors of a cell
+    are on lower levels and its receiver is on a higher level. Unlike a split into catchments (one per outlet),
+    this also parallelizes basins that drain through a single outlet.
+
+    Returns:
+        level_order: int32 cells grouped by level, itself a topological order
+        starts: int64 offsets of the levels in `level_order`, with the total length appended
+    """
+    return _group_by_level(receiver, order)
+
+
+@njit(parallel=True, cache=True, nogil=True)
+def accumulation_parallel(receiver, level_order, starts, valid):
+    """`accumulation` over the levels of `partition_levels`, the cells of a level in parallel
+
+    Every cell pulls the accumulation of its donors (the neighbours draining into it), so there are no
+    concurrent writes. The sums equal those of `accumulation` up to float32 rounding beyond 2**24 cells.
+    """
+    nrows, ncols = valid.shape
+    acc = np.zeros(receiver.size, dtype=np.float32)
+    flat_valid = valid.ravel()
+    for l in range(starts.size - 1):
+        for i in prange(starts[l], starts[l + 1]):
+            cell = level_order[i]
+            row, col = cell // ncols, cell % ncols
+            total = np.float32(1) if flat_valid[cell] else np.float32(0)
+            for k in range(8):
+                nrow, ncol = row + _DROW[k], col + _DCOL[k]
+                if 0 <= nrow < nrows and 0 <= ncol < ncols:
+                    donor = nrow * ncols + ncol
+                    if receiver[donor] == cell:
+                        total += acc[donor]
+            acc[cell] = total
+    return acc.reshape(valid.shape)
+
+
+@njit(parallel=True, cache=True, nogil=True)
+def nearest_drainage_parallel(receiver, level_order, starts, drainage):
+    """`nearest_drainage` over the levels of `partition_levels` from the highest down, a level in parallel"""
+    nrows, ncols = drainage.shape
+    nearest = np.full(receiver.size, -1, dtype=np.int32)
+    flat_drainage = drainage.ravel()
+    for l in range(starts.size - 2, -1, -1):
+        for i in prange(starts[l], starts[l + 1]):
+            cell = level_order[i]
+            row, col = cell // ncols, cell % ncols
+            if row == 0 or col == 0 or row == nrows - 1 or col == ncols - 1:
+                continue
+            if flat_drainage[cell]:
+                nearest[cell] = cell
+            elif receiver[cell] >= 0:
+                nearest[cell] = nearest[receiver[cell]]
+    return nearest
+
+
+def hand_parallel(dem, receiver, level_order, starts, drainage):
+    """`hand` over the levels of `partition_levels`, a level in parallel"""
+    nearest = nearest_drainage_parallel(receiver, level_order, starts, np.asarray(drainage))
+    return _height_above(np.ascontiguousarray(dem), nearest)
@@ -0,0 +1,128 @@
+"""Per-process cache of open FABDEM dataset handles and a global VRT over all tiles
+
+Building a VRT per basin (`prepare_fabdem_vrt`) re-opens and re-parses every tile header for every basin.
+A worker can instead keep its handles open across basins with `DatasetCache`, and read the basin windows
+from a single VRT over all tiles (`build_global_vrt`), whose tile handles are then kept open by GDAL's
+dataset pool.
+"""
+import logging
+import os
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Union
+
+import rasterio
+from osgeo import gdal
+
+log = logging.getLogger(__name__)
+
+gdal.UseExceptions()
+
+
+def configure_gdal_cache(cachemax_mb: Optional[int] = None, max_dataset_pool_size: Optional[int] = None):
+    """Set the GDAL block cache size (in MB) and the number of datasets GDAL keeps open behind a VRT"""
+    if cachemax_mb is not None:
+        gdal.SetCacheMax(int(cachemax_mb) * 1024 * 1024)
+    if max_dataset_pool_size is not None:
+        gdal.SetConfigOption('GDAL_MAX_DATASET_POOL_SIZE', str(max_dataset_pool_size))
+
+
+def build_global_vrt(vrt: Union[str, Path], fabdem_path: Union[str, Path], pattern: str = '*_FABDEM_V1-2.tif',
+                     overwrite: bool = False):
+    """Build one VRT over all FABDEM tiles in `fabdem_path`
+
+    Args:
+        vrt: Path for the output VRT file
+        fabdem_path: folder with the extracted FABDEM tiles
+        pattern: glob pattern of the tile files
+        overwrite: rebuild the VRT if it already exists
+
+    Returns:
+        vrt: Path of the VRT file
+    """
+    vrt = Path(vrt)
+    if vrt.exists() and not overwrite:
+        return vrt
+
+    tile_paths = sorted(str(tile) for tile in Path(fabdem_path).glob(pattern))
+    if not tile_paths:
+        raise ValueError(f'No FABDEM tiles matching {pattern} in {fabdem_path}')
+
+    vrt.parent.mkdir(exist_ok=True, parents=True)
+    log.info(f'Building global VRT {vrt} over {len(tile_paths)} tiles')
+    # built under a unique name and moved into place, so that concurrent workers never read a partial VRT
+    temp_vrt = vrt.with_name(f'{vrt.stem}.{os.getpid()}.{uuid.uuid4().hex}.vrt')
+    try:
+        gdal.BuildVRT(str(temp_vrt), tile_paths)
+        os.replace(temp_vrt, vrt)
+    finally:
+        temp_vrt.unlink(missing_ok=True)
+    return vrt
+
+
+class DatasetCache:
+    """LRU cache of open rasterio datasets
+
+    Args:
+        maxsize: maximum number of datasets kept open; the least recently used one is closed first
+        cachemax_mb: GDAL block cache size in MB, see `configure_gdal_cache`
+        max_dataset_pool_size: number of tiles GDAL keeps open behind a VRT, see `configure_gdal_cache`
+    """
+
+    def __init__(self, maxsize: int = 64, cachemax_mb: Optional[int] = None,
+                 max_dataset_pool_size: Optional[int] = None):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._datasets = OrderedDict()
+        configure_gdal_cache(cachemax_mb=cachemax_mb, max_dataset_pool_size=max_dataset_pool_size)
+
+    def get(self, filename: Union[str, Path]):
+        """Return an open dataset for `filename`, opening it if it is not cached yet"""
+        key = str(Path(filename).resolve())
+        if key in self._datasets:
+            self.hits += 1
+            self._datasets.move_to_end(key)
+            return self._datasets[key]
+
+        self.misses += 1
+        dataset = rasterio.open(key)
+        self._datasets[key] = dataset
+        while len(self._datasets) > self.maxsize:
+            _, evicted = self._datasets.popitem(last=False)
+            evicted.close()
+        return dataset
+
+    def evict(self, filename: Union[str, Path]):
+        """Close and drop the dataset of `filename`, e.g. before deleting or rewriting the file"""
+        dataset = self._datasets.pop(str(Path(filename).resolve()), None)
+        if dataset is not None:
+            dataset.close()
+
+    def close(self):
+        for dataset in self._datasets.values():
+            dataset.close()
+        self._datasets.clear()
+
+    def __len__(self):
+        return len(self._datasets)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_worker_cache = None
+
+
+def get_worker_cache(maxsize: int = 64, cachemax_mb: Optional[int] = None,
+                     max_dataset_pool_size: Optional[int] = None) -> DatasetCache:
+    """Return the `DatasetCache` of the current process, creating it on first use"""
+    global _worker_cache
+    if _worker_cache is None:
+        _worker_cache = DatasetCache(maxsize=maxsize, cachemax_mb=cachemax_mb,
+                                     max_dataset_pool_size=max_dataset_pool_size)
+    return _worker_cache
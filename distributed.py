@@ -0,0 +1,427 @@
+"""Distribute the basin loop over several machines through a SQLite job queue
+
+A coordinator submits one job per basin (hybas_id, thresholds, FABDEM tiles) into a SQLite database on a
+filesystem shared by the workers (with working file locks, e.g. a local disk for a single machine or a cluster
+filesystem). Workers claim jobs under a lease, which they renew with heartbeats while the basin is processed.
+Jobs whose lease expires, because the worker died or hung, go back to the queue and are handed out again, up to
+`max_attempts` times.
+
+Example:
+    python distributed.py submit outputs/jobs.db --region eu --level 5 --acc-thresh 100 1000
+    python distributed.py worker outputs/jobs.db           # on every node
+    python distributed.py status outputs/jobs.db
+
+`run_local` runs the workers as local processes, as a stand-in for a cluster.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional
+
+log = logging.getLogger(__name__)
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+# heartbeat processes are spawned, forking a worker whose numba threads are running is not safe
+_PROCESSES = multiprocessing.get_context('spawn')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    hybas_id INTEGER PRIMARY KEY,
+    payload TEXT NOT NULL,
+    priority REAL NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, priority);
+"""
+
+
+class JobQueue:
+    """
+    SQLite queue of basin jobs with leases
+
+    db: database file, created if missing
+    lease_seconds: how long a claimed job stays with its worker without a heartbeat
+    max_attempts: a job that failed or lost its lease this many times is marked failed
+    """
+
+    def __init__(self, db, lease_seconds=600, max_attempts=3):
+        self.db = str(db)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        Path(self.db).parent.mkdir(exist_ok=True, parents=True)
+        with self._connect() as connection:
+            connection.executescript(_SCHEMA)
+
+    def _connect(self):
+        # autocommit mode; write transactions are opened explicitly with BEGIN IMMEDIATE
+        return _Connection(sqlite3.connect(self.db, timeout=60, isolation_level=None))
+
+    def submit(self, jobs: Iterable[Dict], replace=False):
+        """Adds jobs, dicts with at least a hybas_id and optionally a priority (higher is claimed first)
+
+        Jobs already in the queue are kept as they are, unless `replace`.
+        """
+        verb = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+        rows = [(int(job['hybas_id']), json.dumps(job), float(job.get('priority', 0)), time.time()) for job in jobs]
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany(f'{verb} INTO jobs (hybas_id, payload, priority, updated) VALUES (?, ?, ?, ?)',
+                                   rows)
+            connection.execute('COMMIT')
+        return len(rows)
+
+    def _requeue_expired(self, connection, now):
+        connection.execute(
+            'UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL, '
+            "error = 'lease expired', updated = ? WHERE status = ? AND lease_until < ?",
+            (self.max_attempts, FAILED, PENDING, now, RUNNING, now))
+
+    def requeue_expired(self):
+        """Puts the running jobs whose lease expired back into the queue, returns their number"""
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            before = connection.total_changes
+            self._requeue_expired(connection, time.time())
+            connection.execute('COMMIT')
+            return connection.total_changes - before
+
+    def claim(self, worker, max_memory=None) -> Optional[Dict]:
+        """Leases the pending job with the highest priority to `worker`, None if there is none
+
+        With `max_memory` (bytes), only jobs whose estimated `memory` fits are considered.
+        """
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            self._requeue_expired(connection, now)
+            if max_memory is None:
+                row = connection.execute('SELECT hybas_id, payload FROM jobs WHERE status = ? '
+                                         'ORDER BY priority DESC, hybas_id LIMIT 1', (PENDING,)).fetchone()
+            else:
+                row = connection.execute("SELECT hybas_id, payload FROM jobs WHERE status = ? "
+                                         "AND IFNULL(json_extract(payload, '$.memory'), 0) <= ? "
+                                         "ORDER BY priority DESC, hybas_id LIMIT 1",
+                                         (PENDING, max_memory)).fetchone()
+            if row is not None:
+                connection.execute('UPDATE jobs SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1, '
+                                   'updated = ? WHERE hybas_id = ?',
+                                   (RUNNING, worker, now + self.lease_seconds, now, row[0]))
+            connection.execute('COMMIT')
+        return json.loads(row[1]) if row is not None else None
+
+    def heartbeat(self, worker, hybas_id) -> bool:
+        """Renews the lease of a job, False if the worker lost it (the job was handed out again)"""
+        now = time.time()
+        with self._connect() as connection:
+            cursor = connection.execute('UPDATE jobs SET lease_until = ?, updated = ? '
+                                        'WHERE hybas_id = ? AND worker = ? AND status = ?',
+                                        (now + self.lease_seconds, now, hybas_id, worker, RUNNING))
+            return cursor.rowcount == 1
+
+    def complete(self, worker, hybas_id) -> bool:
+        with self._connect() as connection:
+            cursor = connection.execute('UPDATE jobs SET status = ?, lease_until = NULL, error = NULL, updated = ? '
+                                        'WHERE hybas_id = ? AND worker = ? AND status = ?',
+                                        (DONE, time.time(), hybas_id, worker, RUNNING))
+            return cursor.rowcount == 1
+
+    def fail(self, worker, hybas_id, error) -> bool:
+        """Gives a job back after an error; it is retried until it failed `max_attempts` times"""
+        with self._connect() as connection:
+            cursor = connection.execute(
+                'UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL, '
+                'lease_until = NULL, error = ?, updated = ? WHERE hybas_id = ? AND worker = ? AND status = ?',
+                (self.max_attempts, FAILED, PENDING, str(error), time.time(), hybas_id, worker, RUNNING))
+            return cursor.rowcount == 1
+
+    def fail_oversized(self, max_memory) -> int:
+        """Marks the pending jobs whose estimated `memory` exceeds `max_memory` (bytes) failed, returns their number"""
+        with self._connect() as connection:
+            cursor = connection.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated = ? WHERE status = ? "
+                "AND IFNULL(json_extract(payload, '$.memory'), 0) > ?",
+                (FAILED, f'estimated memory above the largest worker ({max_memory} bytes)', time.time(), PENDING,
+                 max_memory))
+            return cursor.rowcount
+
+    def counts(self, max_memory=None) -> Dict[str, int]:
+        """Number of jobs per status; with `max_memory` (bytes), only of the jobs whose estimated `memory` fits"""
+        with self._connect() as connection:
+            if max_memory is None:
+                rows = connection.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+            else:
+                rows = connection.execute("SELECT status, COUNT(*) FROM jobs "
+                                          "WHERE IFNULL(json_extract(payload, '$.memory'), 0) <= ? GROUP BY status",
+                                          (max_memory,)).fetchall()
+        counts = {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        counts.update(dict(rows))
+        return counts
+
+    def jobs(self, status=None):
+        """(hybas_id, status, worker, attempts, error) of all jobs, or of the jobs with `status`"""
+        query = 'SELECT hybas_id, status, worker, attempts, error FROM jobs'
+        with self._connect() as connection:
+            if status is None:
+                return connection.execute(query + ' ORDER BY hybas_id').fetchall()
+            return connection.execute(query + ' WHERE status = ? ORDER BY hybas_id', (status,)).fetchall()
+
+
+class _Connection:
+    """sqlite3 connection that is closed (not only committed) at the end of a with block"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is not None and self.connection.in_transaction:
+            self.connection.execute('ROLLBACK')
+        self.connection.close()
+
+
+def worker_name():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class LeaseLost(RuntimeError):
+    """The lease of a job expired and the job was handed out to another worker"""
+
+
+class _Heartbeat(_PROCESSES.Process):
+    """Renews the lease of a job every `interval` seconds until stopped
+
+    Runs in its own process: the numba kernels (and pySHEDS) of a basin hold the GIL for minutes, which starved
+    a heartbeat thread until the lease expired and the job was handed out a second time.
+    """
+
+    def __init__(self, queue, worker, hybas_id, interval):
+        super().__init__(daemon=True)
+        self.queue, self.worker, self.hybas_id, self.interval = queue, worker, hybas_id, interval
+        self.stopped = _PROCESSES.Event()
+        self._lost = _PROCESSES.Event()
+
+    @property
+    def lost(self):
+        return self._lost.is_set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if not self.queue.heartbeat(self.worker, self.hybas_id):
+                log.warning(f'{self.worker} lost the lease of basin {self.hybas_id}')
+                self._lost.set()
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def _read_basins(basins_file):
+    from basin_store import open_basins
+    return open_basins(basins_file, columns=['SUB_AREA', 'UP_AREA'])
+
+
+def process_basin_job(job, lease=None):
+    """Default job function: HAND for one basin and all thresholds of the job, see `step2_fabdem_to_hand`
+
+    Raises instead of returning when the basin ran out of memory or its FABDEM tiles are missing on this worker,
+    so that the job goes back to the queue, and `LeaseLost` as soon as `lease` (the `_Heartbeat` of the job)
+    lost the job to another worker, between thresholds and around every basin.
+    """
+    hybas_id = job['hybas_id']
+    missing = [name for name in job.get('tiles', []) if not (Path(job['fabdem_path']) / name).exists()]
+    if missing:
+        raise FileNotFoundError(f"FABDEM tiles of basin {hybas_id} missing in {job['fabdem_path']}: {missing}")
+
+    from step2_fabdem_to_hand import process_basins
+
+    def lost():
+        return lease is not None and lease.lost
+
+    # only the geometry of this basin is read from the store
+    basin = _read_basins(job['basins_file']).select([hybas_id])
+    for acc_thresh in job['acc_threshs']:
+        if lost():
+            raise LeaseLost(f'basin {hybas_id}')
+        process_basins(basin, [hybas_id], acc_thresh=acc_thresh, fabdem_path=job['fabdem_path'],
+                       hand_path=Path(job['output_dir']) / f"hand_acc{acc_thresh}",
+                       only_changed=job.get('only_changed', False), n_threads=job.get('n_threads'),
+                       conditioning=job.get('conditioning', 'pysheds'),
+                       routing_engine=job.get('routing_engine', 'pysheds'),
+                       raise_errors=True, should_stop=lost, output_dir=job['output_dir'])
+    if lost():
+        raise LeaseLost(f'basin {hybas_id}')
+
+
+def run_worker(queue: JobQueue, process_job: Callable = process_basin_job, worker=None, heartbeat_seconds=60,
+               poll_seconds=10, exit_when_empty=True, max_memory=None):
+    """Claims and processes jobs until the queue is empty (or forever, polling, if not `exit_when_empty`)
+
+    Jobs are claimed largest first (by their priority); with `max_memory` (bytes), only the jobs that fit.
+    `process_job(job, lease)` is called with the `_Heartbeat` of the job, whose `lost` turns True when the job
+    was handed out to another worker; it then stops and raises `LeaseLost`.
+
+    Returns:
+        processed: hybas_ids of the jobs completed by this worker
+    """
+    worker = worker or worker_name()
+    processed = []
+    while True:
+        job = queue.claim(worker, max_memory=max_memory)
+        if job is None:
+            # jobs too large for this worker are left to others; running jobs that fit may still come back if
+            # their worker dies or fails them
+            counts = queue.counts(max_memory=max_memory)
+            if exit_when_empty and counts[RUNNING] == 0:
+                return processed
+            time.sleep(poll_seconds)
+            continue
+
+        hybas_id = job['hybas_id']
+        log.info(f'{worker} processing basin {hybas_id}')
+        heartbeat = _Heartbeat(queue, worker, hybas_id, heartbeat_seconds)
+        heartbeat.start()
+        try:
+            process_job(job, heartbeat)
+        except LeaseLost:
+            heartbeat.stop()
+            log.warning(f'{worker} stopped basin {hybas_id}, its lease went to another worker')
+            continue
+        except Exception as e:
+            heartbeat.stop()
+            log.error(f'{worker} failed on basin {hybas_id}: {e!r}')
+            queue.fail(worker, hybas_id, repr(e))
+            continue
+        heartbeat.stop()
+        if queue.complete(worker, hybas_id):
+            processed.append(hybas_id)
+
+
+def _local_worker(db, lease_seconds, max_attempts, process_job, worker, heartbeat_seconds, poll_seconds):
+    queue = JobQueue(db, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    return run_worker(queue, process_job, worker=worker, heartbeat_seconds=heartbeat_seconds,
+                      poll_seconds=poll_seconds)
+
+
+def run_local(queue: JobQueue, n_workers=2, process_job: Callable = process_basin_job, heartbeat_seconds=60,
+              poll_seconds=1):
+    """Runs `n_workers` worker processes on this machine until the queue is drained, returns {worker: hybas_ids}"""
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {
+            f'{worker_name()}-local{i}': executor.submit(_local_worker, queue.db, queue.lease_seconds,
+                                                         queue.max_attempts, process_job, f'{worker_name()}-local{i}',
+                                                         heartbeat_seconds, poll_seconds)
+            for i in range(n_workers)
+        }
+        return {worker: future.result() for worker, future in futures.items()}
+
+
+def basin_jobs(basins, acc_threshs, basins_file, fabdem_path='data/FABDEM/tiles', output_dir='outputs',
+               tiles_geojson='data/FABDEM_v1-2_tiles.geojson', cost='pixels', **options):
+    """One job per basin of the GeoDataFrame `basins`, with the FABDEM tiles it needs (checked by the worker)
+
+    The estimated pixel count of a basin (see `scheduling.basin_costs`, by `cost`) is its priority, so that
+    workers start with the largest basins, and its estimated memory is matched against `run_worker(max_memory)`.
+    """
+    import geopandas as gpd
+    from scheduling import basin_costs
+
+    costs = basin_costs(basins, by=cost)
+
+    tiles = gpd.read_file(tiles_geojson)
+    intersecting = gpd.sjoin(basins[['HYBAS_ID', 'geometry']], tiles[['file_name', 'geometry']], how='left',
+                             predicate='intersects')
+    basin_tiles = intersecting.groupby('HYBAS_ID').file_name.apply(lambda names: sorted(names.dropna()))
+
+    return [{'hybas_id': int(hybas_id), 'acc_threshs': list(acc_threshs), 'tiles': basin_tiles.get(hybas_id, []),
+             'basins_file': str(basins_file), 'fabdem_path': str(fabdem_path), 'output_dir': str(output_dir),
+             'priority': float(costs.pixels[hybas_id]), 'memory': int(costs.memory[hybas_id]),
+             **options}
+            for hybas_id in costs.index]
+
+
+def coordinate(queue: JobQueue, poll_seconds=60, max_memory=None):
+    """Re-dispatches the jobs of dead workers and reports progress until all jobs are done or failed
+
+    With `max_memory` (bytes, the limit of the largest worker), jobs estimated above it are marked failed, as no
+    worker would ever claim them.
+    """
+    while True:
+        if max_memory is not None:
+            oversized = queue.fail_oversized(max_memory)
+            if oversized:
+                log.error(f'{oversized} jobs need more than {max_memory} bytes, marked failed')
+        requeued = queue.requeue_expired()
+        counts = queue.counts()
+        print(f"{time.strftime('%H:%M:%S')} {counts}" + (f', {requeued} requeued' if requeued else ''))
+        if counts[PENDING] == 0 and counts[RUNNING] == 0:
+            return counts
+        time.sleep(poll_seconds)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Distributed HAND runs through a SQLite job queue')
+    parser.add_argument('command', choices=['submit', 'worker', 'local', 'coordinate', 'status'])
+    parser.add_argument('db', help='job database on a filesystem shared by all workers')
+    parser.add_argument('--region')
+    parser.add_argument('--level', type=int, default=5)
+    parser.add_argument('--acc-thresh', type=int, nargs='+', default=[100])
+    parser.add_argument('--basins-file')
+    parser.add_argument('--fabdem-path', default='data/FABDEM/tiles')
+    parser.add_argument('--output-dir', default='outputs')
+    parser.add_argument('--n-threads', type=int, help='threads inside a basin')
+    parser.add_argument('--conditioning', choices=['pysheds', 'priority_flood'], default='pysheds')
+    parser.add_argument('--routing-engine', choices=['pysheds', 'numba'], default='pysheds',
+                        help='numba also threads accumulation and HAND')
+    parser.add_argument('--n-workers', type=int, default=2, help='worker processes of the local command')
+    parser.add_argument('--lease-seconds', type=float, default=600)
+    parser.add_argument('--heartbeat-seconds', type=float, default=60)
+    parser.add_argument('--max-memory', type=float, help='GB; the worker only claims basins estimated to fit, '
+                                                          'the coordinator fails the basins above it')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    queue = JobQueue(args.db, lease_seconds=args.lease_seconds)
+
+    if args.command == 'submit':
+        from basin_store import open_basins
+        from pipeline import basins_file
+
+        filename = args.basins_file or basins_file(args.region, args.level)
+        jobs = basin_jobs(open_basins(filename).select(), args.acc_thresh, filename, fabdem_path=args.fabdem_path,
+                          output_dir=args.output_dir, n_threads=args.n_threads, conditioning=args.conditioning,
+                          routing_engine=args.routing_engine)
+        print(f'{queue.submit(jobs)} jobs submitted')
+    elif args.command == 'worker':
+        max_memory = args.max_memory * 1024 ** 3 if args.max_memory is not None else None
+        processed = run_worker(queue, heartbeat_seconds=args.heartbeat_seconds, max_memory=max_memory)
+        print(f'{len(processed)} basins processed')
+    elif args.command == 'local':
+        for worker, processed in run_local(queue, args.n_workers, heartbeat_seconds=args.heartbeat_seconds).items():
+            print(f'{worker}: {len(processed)} basins processed')
+    elif args.command == 'coordinate':
+        coordinate(queue, max_memory=args.max_memory * 1024 ** 3 if args.max_memory is not None else None)
+    else:
+        print(queue.counts())
+        for hybas_id, status, worker, attempts, error in queue.jobs(FAILED):
+            print(f'{hybas_id}: {attempts} attempts, {error}')
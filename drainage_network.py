@@ -0,0 +1,155 @@
+"""Vectorize the D8 drainage network of a basin into line segments with Strahler order and accumulation
+
+Computed in `calculate_hand` from the flow directions and accumulation still in memory, and written as GeoParquet:
+    * `strahler_order`: Strahler order of every drainage cell, by one pass in topological order
+    * `trace_segments`: splits the network at sources and confluences into segments; every segment ends on the
+      first cell of its downstream segment, so that the lines connect
+    * `drainage_network`: one line per segment with its Strahler order, the accumulation at its downstream end,
+      its length in cells and the id of its downstream segment (-1 at outlets)
+"""
+import logging
+from pathlib import Path
+
+import numpy as np
+from numba import njit
+
+log = logging.getLogger(__name__)
+
+
+@njit(cache=True, nogil=True)
+def strahler_order(receiver, order, drainage):
+    """uint8 Strahler order of the drainage cells (0 elsewhere) and their number of upstream drainage cells"""
+    n = receiver.size
+    strahler = np.zeros(n, dtype=np.uint8)
+    indegree = np.zeros(n, dtype=np.uint8)
+    max_in = np.zeros(n, dtype=np.uint8)
+    n_max = np.zeros(n, dtype=np.uint8)
+    for i in range(order.size):
+        cell = order[i]
+        if not drainage[cell]:
+            continue
+        if indegree[cell] == 0:
+            s = 1
+        elif n_max[cell] >= 2:
+            s = max_in[cell] + 1
+        else:
+            s = max_in[cell]
+        strahler[cell] = s
+        downstream = receiver[cell]
+        if downstream >= 0 and drainage[downstream]:
+            indegree[downstream] += 1
+            if s > max_in[downstream]:
+                max_in[downstream] = s
+                n_max[downstream] = 1
+            elif s == max_in[downstream]:
+                n_max[downstream] += 1
+    return strahler, indegree
+
+
+@njit(cache=True, nogil=True)
+def trace_segments(receiver, order, drainage, indegree):
+    """Cells of every segment of the network
+
+    Returns:
+        path: int32 cell indices of all segments, each followed by the first cell of its downstream segment
+        offsets: int64 start of every segment in `path`, with the total length appended
+        junction: int32 first cell of the downstream segment of every segment, -1 at outlets
+    """
+    n_segments = 0
+    n_cells = 0
+    for i in range(order.size):
+        cell = order[i]
+        if drainage[cell]:
+            n_cells += 1
+            if indegree[cell] != 1:
+                n_segments += 1
+
+    path = np.empty(n_cells + n_segments, dtype=np.int32)
+    offsets = np.empty(n_segments + 1, dtype=np.int64)
+    junction = np.full(n_segments, -1, dtype=np.int32)
+    tail = 0
+    segment = 0
+    for i in range(order.size):
+        cell = order[i]
+        if not drainage[cell] or indegree[cell] == 1:
+            continue
+        offsets[segment] = tail
+        path[tail] = cell
+        tail += 1
+        downstream = receiver[cell]
+        while downstream >= 0 and drainage[downstream] and indegree[downstream] == 1:
+            cell = downstream
+            path[tail] = cell
+            tail += 1
+            downstream = receiver[cell]
+        if downstream >= 0 and drainage[downstream]:
+            path[tail] = downstream
+            tail += 1
+            junction[segment] = downstream
+        segment += 1
+    offsets[segment] = tail
+    return path[:tail], offsets, junction
+
+
+def drainage_network(receiver, order, drainage, acc, transform, crs=None):
+    """GeoDataFrame of the drainage network, one LineString per segment
+
+    Args:
+        receiver: flat int32 downstream cell of every cell, see `d8.receivers`
+        order: topological order of the cells, see `d8.topological_order`
+        drainage: boolean array of the drainage cells, e.g. `(acc > acc_thresh) & ~basin_mask`
+        acc: flow accumulation
+        transform: affine transform of the grid
+        crs: CRS of the grid
+    """
+    import geopandas as gpd
+    import shapely
+
+    nrows, ncols = drainage.shape
+    flat_drainage = np.ascontiguousarray(drainage).ravel()
+    strahler, indegree = strahler_order(receiver, order, flat_drainage)
+    path, offsets, junction = trace_segments(receiver, order, flat_drainage, indegree)
+
+    n_segments = offsets.size - 1
+    lengths = np.diff(offsets)
+    segment_of_cell = np.full(receiver.size, -1, dtype=np.int64)
+    starts = path[offsets[:-1]]
+    segment_of_cell[starts] = np.arange(n_segments)
+    downstream = np.where(junction >= 0, segment_of_cell[np.maximum(junction, 0)], -1)
+
+    # the last cell of a segment itself, before the junction cell
+    own_lengths = lengths - (junction >= 0)
+    last_cells = path[offsets[:-1] + own_lengths - 1]
+
+    valid = lengths >= 2
+    # isolated outlet cells have no line, segments draining into them end at an outlet
+    downstream[np.isin(downstream, np.flatnonzero(~valid))] = -1
+
+    rows, cols = path // ncols, path % ncols
+    xs, ys = transform * (cols + 0.5, rows + 0.5)
+    lines = np.full(n_segments, None, dtype=object)
+    if valid.any():
+        keep = np.repeat(valid, lengths)
+        indices = np.repeat(np.arange(np.count_nonzero(valid)), lengths[valid])
+        lines[valid] = shapely.linestrings(np.column_stack((xs[keep], ys[keep])), indices=indices)
+
+    network = gpd.GeoDataFrame({
+        'segment_id': np.arange(n_segments, dtype=np.int32),
+        'downstream_id': downstream.astype(np.int32),
+        'strahler': strahler[starts],
+        'flow_acc': np.asarray(acc).ravel()[last_cells].astype(np.float32),
+        'n_cells': own_lengths.astype(np.int32),
+    }, geometry=lines, crs=crs)
+    return network[valid].reset_index(drop=True)
+
+
+def network_file_name(out_raster, network_dir):
+    """Drainage network file of a HAND raster, e.g. hand_100_basin5_id_1.tif -> `network_dir`/drainage_100_basin5_id_1.parquet"""
+    return Path(network_dir) / Path(out_raster).with_suffix('.parquet').name.replace('hand_', 'drainage_', 1)
+
+
+def write_drainage_network(network_file, receiver, order, drainage, acc, transform, crs=None):
+    log.info(f'Writing drainage network {network_file}')
+    network = drainage_network(receiver, order, drainage, acc, transform, crs=crs)
+    network.to_parquet(network_file)
+    return network_file
@@ -6,6 +6,7 @@ import json
 
 from pyarrow.parquet import ParquetFile
 from pyarrow import Table as pa_Table
+from pyarrow import concat_tables
 from datasets import Dataset
 
 DATASET = "satellogic/EarthView"
@@ -68,6 +69,170 @@ def load_parquet(subset_or_filename, batch_size=100):
     batch  = pqfile.iter_batches(batch_size=batch_size)
     return Dataset(pa_Table.from_batches(batch))
 
+def iter_parquet(subset_or_filename, batch_size=100, columns=None, row_filter=None, prefetch=True, as_items=False):
+    """
+    Streams a parquet file with bounded memory: at most the current and the next row group are held in memory
+
+    subset_or_filename: see `open_parquet`
+    batch_size: maximum number of rows per yielded batch
+    columns: optional column projection, e.g. ["metadata"]
+    row_filter: optional pyarrow.compute expression (e.g. `pc.field("id") > 10`), or a callable that takes a
+        row group Table and returns a boolean mask
+    prefetch: read the next row group on a background thread while the current one is consumed
+    as_items: yield items (dicts, like the rows of `load_parquet`) instead of RecordBatches
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    pqfile = open_parquet(subset_or_filename)
+
+    def read_row_group(row_group):
+        table = pqfile.read_row_group(row_group, columns=columns)
+        if row_filter is None:
+            return table
+        if callable(row_filter):
+            return table.filter(row_filter(table))
+        return table.filter(row_filter)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = None
+        for row_group in range(pqfile.num_row_groups):
+            if future is None:
+                table = read_row_group(row_group)
+            else:
+                table = future.result()
+
+            future = None
+            if prefetch and row_group + 1 < pqfile.num_row_groups:
+                future = executor.submit(read_row_group, row_group + 1)
+
+            for batch in table.to_batches(max_chunksize=batch_size):
+                if as_items:
+                    yield from batch.to_pylist()
+                else:
+                    yield batch
+            del table
+
+def stream_parquet(subset_or_filename, batch_size=100, columns=None, row_filter=None, prefetch=True):
+    """
+    Streaming variant of `load_parquet`: an IterableDataset over the items of the file, read with `iter_parquet`
+    """
+    from functools import partial
+    from datasets import IterableDataset
+
+    # from_generator shards the lists in gen_kwargs, so only the file goes there and the rest is bound
+    generator = partial(iter_parquet, batch_size=batch_size, columns=columns, row_filter=row_filter,
+                        prefetch=prefetch, as_items=True)
+    return IterableDataset.from_generator(generator, gen_kwargs=dict(subset_or_filename=subset_or_filename))
+
+def get_shard_url(subset, shard, split="train", dataset=DATASET):
+    """hf:// URL of a single parquet shard, readable with `open_parquet` (requires huggingface_hub)"""
+    nshards = get_nshards(subset)
+    path = get_path(subset)
+    return f"hf://datasets/{dataset}/{path}/{split}-{shard:05d}-of-{nshards:05d}.parquet"
+
+def open_parquet(subset_or_filename):
+    """
+    Opens a ParquetFile without reading any data
+
+    subset_or_filename: a subset name (its local `dataset/{subset}/sample.parquet`), a local file or an fsspec URL
+    such as the ones returned by `get_shard_url`
+    """
+    if subset_or_filename in get_subsets():
+        filename = f"dataset/{subset_or_filename}/sample.parquet"
+    else:
+        filename = str(subset_or_filename)
+
+    if "://" in filename:
+        import fsspec
+        token = environ.get("HF_TOKEN", None)
+        storage_options = {"token": token} if filename.startswith("hf://") and token else {}
+        return ParquetFile(fsspec.open(filename, "rb", **storage_options).open())
+    return ParquetFile(filename)
+
+def row_group_statistics(pqfile, row_group):
+    """
+    Returns the min/max statistics of a row group as {column_path: (min, max)}, e.g.
+    {"metadata.bounds.list.element.list.element": (178191.0, 8248828.0)}. Columns without statistics are left out.
+    """
+    rg = pqfile.metadata.row_group(row_group)
+    statistics = {}
+    for i in range(rg.num_columns):
+        column = rg.column(i)
+        if column.statistics is not None and column.statistics.has_min_max:
+            statistics[column.path_in_schema] = (column.statistics.min, column.statistics.max)
+    return statistics
+
+def scan_metadata(subset_or_filename, flags_fn, row_group_filter=None, batch_size=1000):
+    """
+    Finds the matching rows of a parquet file by reading only its "metadata" column
+
+    subset_or_filename: see `open_parquet`
+    flags_fn: called with a list of items {"metadata": ...}, returns one boolean per item,
+        e.g. `satellogic.IntersectionFilter().flags`
+    row_group_filter: optional, called with `row_group_statistics` of every row group, returns False for row
+        groups that cannot contain matches; these are not read at all
+    batch_size: number of rows passed to `flags_fn` at once
+
+    returns the sorted indices of the matching rows within the file
+    """
+    pqfile = open_parquet(subset_or_filename)
+    indices = []
+    row_offset = 0
+    for row_group in range(pqfile.num_row_groups):
+        num_rows = pqfile.metadata.row_group(row_group).num_rows
+        if row_group_filter is not None and not row_group_filter(row_group_statistics(pqfile, row_group)):
+            row_offset += num_rows
+            continue
+
+        for batch in pqfile.iter_batches(batch_size=batch_size, row_groups=[row_group], columns=["metadata"]):
+            items = [{"metadata": metadata} for metadata in batch.column("metadata").to_pylist()]
+            flags = np.asarray(flags_fn(items), dtype=bool)
+            indices.extend((row_offset + np.flatnonzero(flags)).tolist())
+            row_offset += batch.num_rows
+
+    return indices
+
+def read_rows(subset_or_filename, indices, columns=None):
+    """
+    Reads only the given rows of a parquet file, decoding only the row groups that contain them
+
+    subset_or_filename: see `open_parquet`
+    indices: row indices within the file, e.g. as returned by `scan_metadata`
+    columns: optional column projection
+
+    returns a Dataset with the rows in the order of `indices`
+    """
+    pqfile = open_parquet(subset_or_filename)
+    indices = np.asarray(indices, dtype=np.int64)
+    row_group_ends = np.cumsum([pqfile.metadata.row_group(i).num_rows for i in range(pqfile.num_row_groups)])
+    row_group_starts = row_group_ends - np.asarray([pqfile.metadata.row_group(i).num_rows
+                                                    for i in range(pqfile.num_row_groups)])
+    row_groups = np.searchsorted(row_group_ends, indices, side="right")
+
+    tables = []
+    positions = []
+    for row_group in np.unique(row_groups):
+        selected = np.flatnonzero(row_groups == row_group)
+        table = pqfile.read_row_group(int(row_group), columns=columns)
+        tables.append(table.take(indices[selected] - row_group_starts[row_group]))
+        positions.append(selected)
+
+    if not tables:
+        table = pqfile.schema_arrow.empty_table()
+        return Dataset(table.select(columns) if columns else table)
+
+    order = np.argsort(np.concatenate(positions))
+    return Dataset(concat_tables(tables).take(order))
+
+def scan_and_load(subset_or_filename, flags_fn, row_group_filter=None, columns=None, batch_size=1000):
+    """
+    Scans the metadata of a parquet file with `scan_metadata` and loads only the matching rows with `read_rows`
+
+    returns the matching row indices and a Dataset with those rows
+    """
+    indices = scan_metadata(subset_or_filename, flags_fn, row_group_filter=row_group_filter, batch_size=batch_size)
+    return indices, read_rows(subset_or_filename, indices, columns=columns)
+
 def item_to_images(subset, item):
     """
     Converts the images within an item (arrays), as retrieved from the dataset to proper PIL.Image
@@ -149,5 +314,118 @@ def item_to_images(subset, item):
     item["metadata"]["count"] = count
     return item
 
+class LazyImage:
+    """
+    A view on an image array that only becomes a PIL.Image when accessed
+
+    np.asarray(lazy_image) returns the array without creating the image; any PIL.Image attribute or method
+    (size, save, convert, ...) creates the image once and delegates to it.
+    """
+    __slots__ = ("array", "_image")
+
+    def __init__(self, array):
+        self.array = array
+        self._image = None
+
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = Image.fromarray(np.ascontiguousarray(self.array))
+        return self._image
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.array, dtype=dtype)
+
+    def __getattr__(self, name):
+        return getattr(self.image, name)
+
+    def __repr__(self):
+        return f"LazyImage(shape={self.array.shape}, dtype={self.array.dtype})"
+
+def _convert_stacked(subset, fields):
+    """
+    Vectorized conversion of stacked fields (items, time steps, bands, height, width) into stacked images
+    (items, time steps, height, width[, channels]), same conversions as `item_to_images`
+
+    returns the converted fields and the name of the field whose length is the image count
+    """
+    if subset == "satellogic":
+        converted = {
+            "rgb": fields["rgb"].transpose(0, 1, 3, 4, 2),
+            "1m": fields["1m"][:, :, 0],
+        }
+        count_field = "1m"
+    elif subset == "sentinel_1":
+        i10m = fields["10m"]
+        ratio = (i10m[:, :, 0] / (i10m[:, :, 1] + 0.01) * 256).astype("uint8")
+        i10m = np.concatenate((i10m, ratio[:, :, np.newaxis]), 2)
+        converted = {"10m": i10m.transpose(0, 1, 3, 4, 2)}
+        count_field = "10m"
+    elif subset == "neon":
+        # same arbitrary hyperspectral to RGB conversion as `item_to_images`, for all items and time steps at once
+        i1m = fields["1m"]
+        converted = {
+            "rgb": fields["rgb"].transpose(0, 1, 3, 4, 2),
+            "chm": fields["chm"][:, :, 0],
+            "1m": np.stack((
+                i1m[:, :, :124].mean(axis=2),
+                i1m[:, :, 124:247].mean(axis=2),
+                i1m[:, :, 247:].mean(axis=2)),
+                -1).astype("uint8"),
+        }
+        count_field = "rgb"
+    else:
+        raise ValueError(f"Unknown subset {subset}, expected one of {list(get_subsets())}")
+
+    return converted, count_field
+
+def items_to_images(subset, items):
+    """
+    Batched version of `item_to_images`
+
+    The array fields of all items with the same shapes are stacked and converted at once, and the images are
+    returned as `LazyImage` views into the stacked arrays, so no PIL.Image is created until it is used.
+
+    subset: The name of the Subset, one of "satellogic", "neon", "sentinel_1"
+    items: list of items as retrieved from the subset
+
+    returns the list of items, with arrays converted to lists of LazyImage
+    """
+    items = list(items)
+    arrays = [
+        {k: np.asarray(v) for k, v in item.items() if k != "metadata"}
+            for item in items
+    ]
+
+    # group items with identical field shapes, so their fields can be stacked
+    groups = {}
+    for i, fields in enumerate(arrays):
+        signature = tuple((k, v.shape) for k, v in sorted(fields.items()))
+        groups.setdefault(signature, []).append(i)
+
+    results = [None] * len(items)
+    for signature, indices in groups.items():
+        stacked = {
+            k: np.stack([arrays[i][k] for i in indices]).astype("uint8", copy=False)
+                for k, _ in signature
+        }
+        converted, count_field = _convert_stacked(subset, stacked)
+
+        for n, i in enumerate(indices):
+            metadata = items[i]["metadata"]
+            if type(metadata) == str:
+                metadata = json.loads(metadata)
+            else:
+                metadata = dict(metadata)
+
+            item = {k: v[n] for k, v in stacked.items()}
+            for k, v in converted.items():
+                item[k] = [LazyImage(image) for image in v[n]]
+            metadata["count"] = len(item[count_field])
+            item["metadata"] = metadata
+            results[i] = item
+
+    return results
+
 
 
@@ -0,0 +1,198 @@
+"""Scan many EarthView shards in parallel processes
+
+Every shard is scanned in a worker process with `earthview.scan_metadata`, matches are streamed back to the
+caller through a queue as soon as they are found, and completed shards are appended to a checkpoint file so
+that an interrupted scan resumes with the remaining shards. A shard that fails after some of its matches were
+yielded is checkpointed as partial, with those rows, which are not yielded again when it is rescanned.
+
+Example:
+    from satellogic import IntersectionFilter, intersection_flag
+
+    for shard, index, item in scan_shards("satellogic", range(3676), IntersectionFilter().flags, batched=True,
+                                          checkpoint="outputs/scan_satellogic.jsonl", load_items=True):
+        ...
+"""
+import json
+import multiprocessing
+import queue as queue_module
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import earthview as ev
+
+
+def shard_source(subset, shard, mirror=None, split="train"):
+    """Local mirror file of a shard if it exists, else its hub URL"""
+    url = ev.get_shard_url(subset, shard, split=split)
+    if mirror is not None:
+        filename = Path(mirror) / url.split(f"{ev.DATASET}/")[-1]
+        if filename.exists():
+            return str(filename)
+    return url
+
+
+def _read_checkpoint(checkpoint):
+    records = []
+    if checkpoint is not None and Path(checkpoint).exists():
+        with open(checkpoint) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    return records
+
+
+def load_checkpoint(checkpoint):
+    """Returns {shard: [matching row indices]} of the shards completed in a previous run"""
+    return {record["shard"]: record["indices"] for record in _read_checkpoint(checkpoint) if "indices" in record}
+
+
+def load_yielded(checkpoint):
+    """Returns {shard: {row indices}} already yielded from shards that failed in a previous run"""
+    completed = load_checkpoint(checkpoint)
+    yielded = {}
+    for record in _read_checkpoint(checkpoint):
+        if "yielded" in record and record["shard"] not in completed:
+            yielded.setdefault(record["shard"], set()).update(record["yielded"])
+    return yielded
+
+
+def _flags_fn(predicate, batched):
+    if batched:
+        return predicate
+    return lambda items: [bool(predicate(item)) for item in items]
+
+
+def _scan_shard(queue, subset, shard, predicate, batched, load_items, mirror, split):
+    """Worker: scans one shard and puts ("match", shard, index, item) and ("done", shard, indices) on the queue"""
+    try:
+        source = shard_source(subset, shard, mirror=mirror, split=split)
+        indices = ev.scan_metadata(source, _flags_fn(predicate, batched))
+        if load_items and indices:
+            for index, item in zip(indices, ev.read_rows(source, indices)):
+                queue.put(("match", shard, index, item))
+        else:
+            for index in indices:
+                queue.put(("match", shard, index, None))
+        queue.put(("done", shard, indices))
+    except Exception as e:
+        queue.put(("error", shard, repr(e)))
+
+
+def scan_shards(subset, shards, predicate, batched=False, max_workers=None, ordered=False, checkpoint=None,
+                load_items=False, mirror=None, split="train"):
+    """
+    Scans shards of a subset in a process pool and yields (shard, row index, item) for every match
+
+    subset: The name of the Subset, one of "satellogic", "neon", "sentinel_1"
+    shards: shard indices to scan
+    predicate: picklable function item -> bool, e.g. `satellogic.intersection_flag`, or with `batched=True`
+        a function list of items -> booleans, e.g. `satellogic.IntersectionFilter().flags`
+    max_workers: number of processes, defaults to the number of CPUs
+    ordered: yield the matches shard by shard in the order of `shards` (buffering the shards that finish early)
+        instead of as soon as they arrive; the matches of a failed shard are then dropped
+    checkpoint: optional JSON-lines file; completed shards are appended to it and skipped when the scan
+        is restarted
+    load_items: also read the matching rows; otherwise item is None
+    mirror: optional local folder with the hub layout, see `shard_source`
+
+    Shards that fail are reported and not checkpointed as completed, so they are retried on the next run. Without
+    `ordered`, the rows they yielded before failing are checkpointed and skipped in that retry.
+    """
+    completed = load_checkpoint(checkpoint)
+    skip = load_yielded(checkpoint)
+    shards = [shard for shard in shards if shard not in completed]
+    if not shards:
+        return
+
+    manager = multiprocessing.Manager()
+    queue = manager.Queue()
+    pending = {shard: [] for shard in shards}
+    yielded = {shard: [] for shard in shards}
+    next_shard = 0
+    finished = {}
+    checkpoint_file = open(checkpoint, "a") if checkpoint is not None else None
+
+    # managed explicitly: leaving a `with` block waits for all shards, also when the consumer stops early
+    executor = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {
+            executor.submit(_scan_shard, queue, subset, shard, predicate, batched, load_items, mirror, split): shard
+                for shard in shards
+        }
+
+        while len(finished) < len(shards):
+            try:
+                message = queue.get(timeout=1)
+            except queue_module.Empty:
+                # a worker that died (e.g. killed for memory) never reports back
+                for future, shard in futures.items():
+                    if shard not in finished and future.done() and future.exception() is not None:
+                        queue.put(("error", shard, repr(future.exception())))
+                continue
+            kind, shard = message[0], message[1]
+
+            if kind == "match":
+                if ordered:
+                    pending[shard].append(message[1:])
+                elif message[2] not in skip.get(shard, ()):
+                    yielded[shard].append(message[2])
+                    yield message[1:]
+                continue
+
+            if kind == "error":
+                print(f"Failed to scan shard {shard}: {message[2]}")
+                finished[shard] = False
+                if not ordered and yielded[shard] and checkpoint_file is not None:
+                    _write_checkpoint(checkpoint_file, shard, yielded[shard], partial=True)
+            else:
+                finished[shard] = True
+                if not ordered and checkpoint_file is not None:
+                    _write_checkpoint(checkpoint_file, shard, message[2])
+
+            if ordered:
+                # release the buffered matches of all consecutive finished shards
+                while next_shard < len(shards) and shards[next_shard] in finished:
+                    done_shard = shards[next_shard]
+                    matches = pending.pop(done_shard)
+                    if finished[done_shard]:
+                        yield from (match for match in matches if match[1] not in skip.get(done_shard, ()))
+                        if checkpoint_file is not None:
+                            _write_checkpoint(checkpoint_file, done_shard, [index for _, index, _ in matches])
+                    next_shard += 1
+    finally:
+        if len(finished) < len(shards):
+            # the consumer stopped early: the shards still being scanned are not wanted anymore, and their
+            # workers would fail on the queue once the manager is shut down
+            for process in list((executor._processes or {}).values()):
+                process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+        if checkpoint_file is not None:
+            # a consumer that stopped early got some rows of unfinished shards, which are skipped on the next run
+            if not ordered:
+                for shard, indices in yielded.items():
+                    if indices and shard not in finished:
+                        _write_checkpoint(checkpoint_file, shard, indices, partial=True)
+            checkpoint_file.close()
+        manager.shutdown()
+
+
+def _write_checkpoint(checkpoint_file, shard, indices, partial=False):
+    # a partial record holds the rows yielded from a shard that failed, a complete one all its matches
+    record = {"shard": shard, "yielded" if partial else "indices": [int(index) for index in indices]}
+    checkpoint_file.write(json.dumps(record) + "\n")
+    checkpoint_file.flush()
+
+
+if __name__ == "__main__":
+
+    from tqdm import tqdm
+    from satellogic import IntersectionFilter
+
+    subset = "satellogic"
+    shards = range(ev.get_nshards(subset))
+    checkpoint = Path("outputs") / f"scan_{subset}.jsonl"
+    checkpoint.parent.mkdir(exist_ok=True, parents=True)
+
+    for shard, index, _ in tqdm(scan_shards(subset, shards, IntersectionFilter().flags, batched=True,
+                                            checkpoint=checkpoint)):
+        print(f"shard {shard}, row {index}")
+
+    print(f"matches: {sum(len(indices) for indices in load_checkpoint(checkpoint).values())}")
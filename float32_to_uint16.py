@@ -1,7 +1,11 @@
 
 import os
+import concurrent.futures
+from pathlib import Path
+from tempfile import TemporaryDirectory
 import numpy as np
 import rasterio
+import rasterio.shutil
 from tqdm import tqdm
 from rasterio import Affine
 from rasterio.enums import Resampling
@@ -28,27 +32,128 @@ def convert_geotiff_to_uint16(input_file, output_file, nodata_value = 65535):
             dst.write(data_uint16, 1)
 
 
+def encode_block_uint16(block, out, scale=1, offset=0, nodata_value=65535, invalid=None, buffer=None):
+    """Scale, clip and truncate a block into the uint16 array `out`, the encoding of all HAND and flow_acc outputs
 
-if __name__ == "__main__":
+    Values are transformed as `block * scale + offset` in float64, clipped to [0, nodata_value - 1] (so e.g. a flow
+    accumulation of 100000 saturates at 65534 instead of wrapping) and truncated, so that a stored value v stands
+    for [v, v + 1) / scale, as decoded by `hand_stats` and `flood_query`. Both `calculate.encode_uint16` and the
+    conversion of older float outputs go through here, so the same value gets the same code on either path.
 
+    Args:
+        block: float array to encode
+        out: uint16 array of the same shape
+        invalid: boolean array of the pixels set to `nodata_value`, defaults to the NaNs of `block`
+        buffer: float64 work array of the same shape, allocated if None
+    """
+    if invalid is None:
+        invalid = np.isnan(block)
+    if buffer is None:
+        buffer = np.empty(block.shape, dtype=np.float64)
 
-    from pathlib import Path
-    current_directory = os.getcwd()
+    np.multiply(block, scale, out=buffer)
+    if offset != 0:
+        np.add(buffer, offset, out=buffer)
+    np.clip(buffer, 0, nodata_value - 1, out=buffer)
+    buffer[invalid] = nodata_value
+    np.copyto(out, buffer, casting='unsafe')
+    return out
 
-    in_folder = Path("outputs/flow_acc")
-    out_folder = Path("outputs/flow_acc_uint16")
+
+def scale_block_to_uint16(block, scale=1, offset=0, nodata_value=65535, src_nodata=None):
+    """Encode a block read from a GeoTIFF into uint16 with `encode_block_uint16`
+
+    NaNs (and `src_nodata`, if given) are set to `nodata_value`.
+    """
+    invalid = np.isnan(block) if np.issubdtype(block.dtype, np.floating) else np.zeros(block.shape, dtype=bool)
+    if src_nodata is not None and not np.isnan(src_nodata):
+        invalid |= block == src_nodata
+    return encode_block_uint16(block, np.empty(block.shape, dtype=np.uint16), scale=scale, offset=offset,
+                               nodata_value=nodata_value, invalid=invalid)
+
+
+def convert_geotiff_to_uint16_chunked(input_file, output_file, scale=1, offset=0, nodata_value=65535,
+                                      blocksize=512, compress='lzw'):
+    """Convert a single-band GeoTIFF into a uint16 Cloud Optimized GeoTIFF, block by block
+
+    Only one `blocksize` x `blocksize` window is held in memory at a time. The blocks are first written
+    into a tiled temporary GeoTIFF, which is then copied into a COG (the COG driver only supports
+    whole-file copies). Inputs that are uint16 already are copied without `scale` and `offset`.
+
+    Args:
+        input_file: float GeoTIFF to convert
+        output_file: uint16 COG to create
+        scale: multiplier applied before casting, e.g. 10 for HAND
+        offset: value added after scaling
+        nodata_value: uint16 NODATA value of the output; valid values are clipped below it
+        blocksize: tile size of the intermediate and output rasters
+        compress: compression of the output COG
+    """
+    with TemporaryDirectory() as temp_dir:
+        temp_file = os.path.join(temp_dir, 'uint16.tif')
+
+        with rasterio.open(input_file) as src:
+            if src.dtypes[0] == 'uint16':
+                scale, offset = 1, 0
+            profile = src.profile
+            profile.update(driver='GTiff', dtype=rasterio.uint16, count=1, nodata=nodata_value,
+                           tiled=True, blockxsize=blocksize, blockysize=blocksize, compress=compress,
+                           BIGTIFF='IF_SAFER')
+
+            with rasterio.open(temp_file, 'w', **profile) as dst:
+                for _, window in dst.block_windows(1):
+                    block = src.read(1, window=window)
+                    dst.write(scale_block_to_uint16(block, scale=scale, offset=offset, nodata_value=nodata_value,
+                                                    src_nodata=src.nodata), 1, window=window)
+
+        rasterio.shutil.copy(temp_file, output_file, driver='COG', COMPRESS=compress.upper(),
+                             BLOCKSIZE=blocksize, OVERVIEW_RESAMPLING='NEAREST', BIGTIFF='IF_SAFER')
+
+    return output_file
+
+
+def convert_folder_to_uint16(in_folder, out_folder, prefix='', scale=1, offset=0, nodata_value=65535,
+                             max_workers=None, overwrite=False):
+    """Convert all GeoTIFFs of a folder into uint16 COGs in a process pool
+
+    Args:
+        in_folder: folder with the float GeoTIFFs
+        out_folder: folder for the uint16 COGs, created if missing
+        prefix: only convert files whose name starts with `prefix`
+        scale, offset, nodata_value: see `convert_geotiff_to_uint16_chunked`
+        max_workers: number of processes, defaults to the number of CPUs
+        overwrite: re-convert files that already exist in `out_folder`
+    """
+    in_folder, out_folder = Path(in_folder), Path(out_folder)
     out_folder.mkdir(exist_ok=True, parents=True)
-    # print(os.listdir(in_folder))
 
-    fileList = [f for f in os.listdir(in_folder) if f.startswith("flow_acc") and f.endswith(".tif")]
-    # print(fileList)
+    fileList = [f for f in sorted(os.listdir(in_folder)) if f.startswith(prefix) and f.endswith(".tif")]
+    if not overwrite:
+        fileList = [f for f in fileList if not (out_folder / f).exists()]
+
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(convert_geotiff_to_uint16_chunked, in_folder / filename, out_folder / filename,
+                            scale=scale, offset=offset, nodata_value=nodata_value): filename
+            for filename in fileList
+        }
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to convert {futures[future]}: {e}")
+                failed.append(futures[future])
 
-    for filename in tqdm(fileList):
-        input_file = in_folder / filename
-        output_file = out_folder / filename
+    return failed
 
-        if not output_file.exists():
-            print(filename)
-            convert_geotiff_to_uint16(input_file, output_file)
 
 
+if __name__ == "__main__":
+
+    in_folder = Path("outputs/flow_acc")
+    out_folder = Path("outputs/flow_acc_uint16")
+
+    # flow accumulation is stored as-is (saturated at 65534); use scale=10 for HAND
+    failed = convert_folder_to_uint16(in_folder, out_folder, prefix="flow_acc", scale=1)
+    print(f"{len(failed)} files failed: {failed}")
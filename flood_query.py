@@ -0,0 +1,146 @@
+"""Local flood-extent queries over the per-basin HAND outputs
+
+Answers "which pixels have HAND < h within this polygon" and "inundated area vs. stage for basin X" from the
+HAND COGs of `calculate_hand_for_basins`, without going through Earth Engine:
+    * the basins intersecting the query are found in the STRtree of `coregister.HandIndex`
+    * only the window of the query polygon is read from every basin, optionally decimated, in which case GDAL
+      reads from the COG overviews
+    * stage curves are computed for all stages at once from an area-weighted histogram of the uint16 HAND values
+
+Pixels on the boundary of two basins are present in both basin outputs and are counted twice in queries that
+span both basins.
+
+Example:
+    query = FloodQuery.from_folder("outputs/hand_acc100", cache_file="outputs/hand_acc100_index.json")
+    stages = np.arange(0, 10.5, 0.5)
+    area_km2 = query.stage_curve(stages, hybas_id=2050012730)
+    for mask, transform, hand_file in query.pixels_below(polygon, h=2.0):
+        ...
+"""
+import argparse
+import math
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import rasterio.errors
+import rasterio.features
+import shapely
+from rasterio.enums import Resampling
+from rasterio.windows import Window, from_bounds as window_from_bounds
+from shapely.geometry.base import BaseGeometry
+
+from coregister import NODATA_VALUE, HandIndex
+
+HAND_SCALE = 10  # HAND is stored x 10
+EARTH_RADIUS_KM = 6371.0088
+
+
+def pixel_areas(transform, height) -> np.ndarray:
+    """Area in km² of the pixels of every row of a lon/lat grid"""
+    lat = transform.f + (np.arange(height) + 0.5) * transform.e
+    degree = math.pi / 180 * EARTH_RADIUS_KM
+    return abs(transform.a) * abs(transform.e) * degree ** 2 * np.cos(np.radians(lat))
+
+
+class FloodQuery:
+    """Queries over the HAND COGs of a `coregister.HandIndex`"""
+
+    def __init__(self, index: HandIndex):
+        self.index = index
+        self.basin_ids = np.array([int(f.stem.split('_')[-1]) for f in index.hand_files], dtype=np.int64)
+
+    @classmethod
+    def from_folder(cls, hand_dir, cache_file=None, **kwargs):
+        return cls(HandIndex.from_folder(hand_dir, cache_file=cache_file, **kwargs))
+
+    def _files(self, geometry: Optional[BaseGeometry], hybas_id):
+        if hybas_id is not None:
+            idx = np.flatnonzero(self.basin_ids == int(hybas_id))
+            if geometry is not None:
+                idx = [i for i in idx if shapely.intersects(geometry, shapely.box(*self.index.bounds[i]))]
+            return [self.index.hand_files[i] for i in idx]
+        if geometry is None:
+            raise ValueError('Either a geometry or a hybas_id is required')
+        return [self.index.hand_files[i] for i in self.index.query([geometry])[1]]
+
+    def read(self, geometry: Optional[BaseGeometry] = None, hybas_id=None,
+             decimation: int = 1) -> Iterator[Tuple[np.ndarray, np.ndarray, object, object]]:
+        """Yields (uint16 HAND window, mask of the valid pixels inside `geometry`, window transform, file)
+
+        Args:
+            geometry: query polygon in EPSG:4326; defaults to the whole basin of `hybas_id`
+            hybas_id: restricts the query to one basin
+            decimation: read every `decimation`-th pixel in both directions, from the overviews if available
+        """
+        for hand_file in self._files(geometry, hybas_id):
+            dataset = self.index.datasets.get(hand_file)
+            if geometry is None:
+                window = Window(0, 0, dataset.width, dataset.height)
+            else:
+                window = window_from_bounds(*geometry.bounds, transform=dataset.transform)
+                window = window.round_offsets(op='floor').round_lengths(op='ceil')
+                try:
+                    window = window.intersection(Window(0, 0, dataset.width, dataset.height))
+                except rasterio.errors.WindowError:
+                    continue
+
+            out_shape = (max(int(window.height) // decimation, 1), max(int(window.width) // decimation, 1))
+            data = dataset.read(1, window=window, out_shape=out_shape, resampling=Resampling.nearest)
+            transform = dataset.window_transform(window) * rasterio.Affine.scale(window.width / out_shape[1],
+                                                                                window.height / out_shape[0])
+            mask = data != NODATA_VALUE
+            if geometry is not None:
+                mask &= rasterio.features.geometry_mask([geometry], out_shape=data.shape, transform=transform,
+                                                        invert=True)
+            yield data, mask, transform, hand_file
+
+    def pixels_below(self, geometry: BaseGeometry, h: float, hybas_id=None, decimation: int = 1):
+        """Yields (mask of the pixels with HAND < h inside `geometry`, window transform, file) for every basin"""
+        for data, mask, transform, hand_file in self.read(geometry, hybas_id, decimation):
+            yield mask & (data < h * HAND_SCALE), transform, hand_file
+
+    def area_histogram(self, geometry: Optional[BaseGeometry] = None, hybas_id=None,
+                       decimation: int = 1) -> np.ndarray:
+        """Area in km² of the valid pixels per uint16 HAND value (HAND x 10), inside `geometry`/basin"""
+        histogram = np.zeros(NODATA_VALUE, dtype=np.float64)
+        for data, mask, transform, _ in self.read(geometry, hybas_id, decimation):
+            areas = np.broadcast_to(pixel_areas(transform, data.shape[0])[:, None], data.shape)
+            histogram += np.bincount(data[mask], weights=areas[mask], minlength=NODATA_VALUE)[:NODATA_VALUE]
+        return histogram
+
+    def stage_curve(self, stages, geometry: Optional[BaseGeometry] = None, hybas_id=None,
+                    decimation: int = 1) -> np.ndarray:
+        """Inundated area in km² (HAND < stage) for every stage in meters, from one pass over the data"""
+        cumulative = np.concatenate(([0.], np.cumsum(self.area_histogram(geometry, hybas_id, decimation))))
+        # HAND < stage <=> stored value < stage * 10, i.e. the stored values 0 .. ceil(stage * 10) - 1
+        limits = np.clip(np.ceil(np.asarray(stages, dtype=float) * HAND_SCALE), 0, NODATA_VALUE).astype(np.int64)
+        return cumulative[limits]
+
+    def close(self):
+        self.index.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Inundated area vs. stage from the per-basin HAND outputs')
+    parser.add_argument('hand_dir', help='folder of the HAND COGs, e.g. outputs/hand_acc100')
+    parser.add_argument('--basin', type=int, help='hybas_id of the basin')
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'))
+    parser.add_argument('--polygon', help='vector file with the query polygon(s), e.g. a GeoJSON')
+    parser.add_argument('--stages', type=float, nargs='+', default=[0.5, 1, 2, 5, 10], help='meters')
+    parser.add_argument('--decimation', type=int, default=1, help='read every n-th pixel (overviews)')
+    parser.add_argument('--index-cache', help='JSON file caching the bounds of the HAND files')
+    args = parser.parse_args()
+
+    geometry = None
+    if args.bbox:
+        geometry = shapely.box(*args.bbox)
+    elif args.polygon:
+        import geopandas as gpd
+        geometry = gpd.read_file(args.polygon).to_crs(4326).union_all()
+
+    query = FloodQuery.from_folder(args.hand_dir, cache_file=args.index_cache)
+    areas = query.stage_curve(args.stages, geometry=geometry, hybas_id=args.basin, decimation=args.decimation)
+    for stage, area in zip(args.stages, areas):
+        print(f'HAND < {stage:g} m: {area:.3f} km²')
+    query.close()
@@ -0,0 +1,153 @@
+"""Per-basin HAND statistics sidecars and their catalogue
+
+`calculate_hand_for_basins` writes next to every HAND COG a small JSON sidecar
+(`hand_100_basin5_id_1.tif` -> `hand_100_basin5_id_1.stats.json`), computed from the arrays still in memory:
+valid pixel count, HAND histogram (on `BIN_EDGES`), quantiles, mean and max, drainage cell count and maximum flow
+accumulation. `aggregate_stats` merges the sidecars of a folder into region-wide statistics without reading
+any raster.
+
+Example:
+    python hand_stats.py outputs/hand_acc100 --output outputs/hand_acc100_catalogue.json
+"""
+import argparse
+import json
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+HAND_SCALE = 10  # HAND is stored x 10
+NODATA_VALUE = 65535
+QUANTILES = [0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99]
+
+# histogram bin edges in meters: 0.1 m up to 10 m, 1 m up to 100 m, 10 m up to 1000 m, then everything above
+BIN_EDGES = np.concatenate((np.arange(0, 10, 0.1), np.arange(10, 100, 1.), np.arange(100, 1001, 10.),
+                            [NODATA_VALUE / HAND_SCALE])).round(1)
+
+
+def _quantiles(cumulative, edges_lower, edges_upper, quantiles):
+    """Quantiles from a cumulative histogram, linearly interpolated inside the bins"""
+    total = cumulative[-1]
+    values = []
+    for q in quantiles:
+        target = q * total
+        i = int(np.searchsorted(cumulative, target, side='left'))
+        i = min(i, len(cumulative) - 1)
+        before = cumulative[i - 1] if i > 0 else 0
+        in_bin = cumulative[i] - before
+        fraction = (target - before) / in_bin if in_bin else 0
+        values.append(float(edges_lower[i] + fraction * (edges_upper[i] - edges_lower[i])))
+    return values
+
+
+def drainage_threshold(acc: np.ndarray, acc_thresh: Optional[float] = None,
+                       mask: Optional[np.ndarray] = None) -> float:
+    """Accumulation threshold of the drainage cells: `acc_thresh`, or the mean accumulation inside the basin if None
+
+    Shared with `calculate.calculate_hand`, so that the statistics count the drainage cells HAND was computed
+    against. NaN cells (and those of `mask`, True outside of the basin) are left out of the mean.
+    """
+    if acc_thresh is not None:
+        return acc_thresh
+    inside = ~np.isnan(acc) if mask is None else ~mask & ~np.isnan(acc)
+    return float(np.mean(acc, where=inside, dtype=np.float64)) if inside.any() else 0.
+
+
+def hand_statistics(hand: np.ndarray, acc: Optional[np.ndarray] = None, acc_thresh: Optional[float] = None,
+                    mask: Optional[np.ndarray] = None, quantiles=QUANTILES) -> Dict:
+    """Statistics of a basin from its uint16 HAND (x 10, nodata 65535) and float flow accumulation
+
+    Args:
+        hand: uint16 HAND as written by `calculate_hand_for_basins`
+        acc: flow accumulation, NaN outside of the basin
+        acc_thresh: accumulation threshold of the drainage cells; the mean accumulation inside the basin if None,
+            see `drainage_threshold`. The threshold used is the one recorded
+        mask: Array of booleans, True outside of the basin, e.g. `basin_mask`
+
+    The quantiles are exact up to the 0.1 m precision of the stored HAND.
+    """
+    counts = np.bincount(hand.ravel(), minlength=NODATA_VALUE + 1)[:NODATA_VALUE]
+    valid = int(counts.sum())
+    stored = np.arange(NODATA_VALUE)
+
+    stats = {'valid_pixels': valid, 'acc_thresh': acc_thresh}
+    if valid:
+        cumulative = np.cumsum(counts)
+        meters = stored / HAND_SCALE
+        # every stored value v stands for HAND in [v, v + 1) / 10 after truncation
+        stats['quantiles'] = dict(zip(map(str, quantiles),
+                                      _quantiles(cumulative, meters, meters + 1 / HAND_SCALE, quantiles)))
+        stats['mean'] = float((counts * meters).sum() / valid)
+        stats['max'] = float(meters[np.flatnonzero(counts)[-1]])
+    stats['histogram'] = {'bins': BIN_EDGES.tolist(),
+                          'counts': np.add.reduceat(counts, np.searchsorted(stored / HAND_SCALE,
+                                                                            BIN_EDGES[:-1])).tolist()}
+
+    if acc is not None:
+        inside = ~np.isnan(acc) if mask is None else ~mask & ~np.isnan(acc)
+        stats['acc_thresh'] = acc_thresh = drainage_threshold(acc, acc_thresh, mask=mask)
+        stats['drainage_cells'] = int(np.count_nonzero(acc[inside] > acc_thresh))
+        stats['max_flow_acc'] = float(acc[inside].max()) if inside.any() else None
+    return stats
+
+
+def stats_file(out_raster) -> Path:
+    return Path(out_raster).with_suffix('.stats.json')
+
+
+def write_stats(out_raster, stats: Dict, **metadata) -> Path:
+    filename = stats_file(out_raster)
+    filename.write_text(json.dumps({'file': Path(out_raster).name, **metadata, **stats}))
+    return filename
+
+
+def read_stats(files: Iterable) -> list:
+    return [json.loads(Path(f).read_text()) for f in files]
+
+
+def aggregate_stats(sidecars: list, quantiles=QUANTILES) -> Dict:
+    """Region-wide statistics from the sidecars of many basins
+
+    The merged quantiles are interpolated in the bins of `BIN_EDGES`.
+    """
+    edges = np.asarray(BIN_EDGES)
+    counts = np.zeros(len(edges) - 1, dtype=np.int64)
+    valid, drainage, weighted_sum, max_hand, max_acc = 0, 0, 0., None, None
+    for stats in sidecars:
+        if stats['histogram']['bins'] != edges.tolist():
+            raise ValueError(f"Histogram bins of {stats.get('file')} differ from BIN_EDGES")
+        counts += np.asarray(stats['histogram']['counts'], dtype=np.int64)
+        valid += stats['valid_pixels']
+        drainage += stats.get('drainage_cells', 0)
+        if stats['valid_pixels']:
+            weighted_sum += stats['mean'] * stats['valid_pixels']
+            max_hand = stats['max'] if max_hand is None else max(max_hand, stats['max'])
+        if stats.get('max_flow_acc') is not None:
+            max_acc = stats['max_flow_acc'] if max_acc is None else max(max_acc, stats['max_flow_acc'])
+
+    catalogue = {'basins': len(sidecars), 'valid_pixels': valid, 'drainage_cells': drainage,
+                 'max': max_hand, 'max_flow_acc': max_acc,
+                 'histogram': {'bins': edges.tolist(), 'counts': counts.tolist()}}
+    if valid:
+        catalogue['mean'] = weighted_sum / valid
+        catalogue['quantiles'] = dict(zip(map(str, quantiles),
+                                          _quantiles(np.cumsum(counts), edges[:-1], edges[1:], quantiles)))
+    return catalogue
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Merge the HAND statistics sidecars of a folder')
+    parser.add_argument('folder', help='folder of the HAND COGs and their .stats.json sidecars')
+    parser.add_argument('--output', help='JSON catalogue with the merged statistics and the per-basin sidecars')
+    args = parser.parse_args()
+
+    sidecars = read_stats(sorted(Path(args.folder).glob('*.stats.json')))
+    catalogue = aggregate_stats(sidecars)
+    print(f"{catalogue['basins']} basins, {catalogue['valid_pixels']} valid pixels, "
+          f"{catalogue['drainage_cells']} drainage cells")
+    for q, value in catalogue.get('quantiles', {}).items():
+        print(f'    HAND q{q}: {value:.1f} m')
+
+    if args.output:
+        Path(args.output).write_text(json.dumps({**catalogue, 'sidecars': sidecars}))
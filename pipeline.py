@@ -0,0 +1,319 @@
+"""One entry point for the whole HAND pipeline: download -> extract -> hand -> convert -> upload
+
+Replaces the region, basin level and threshold choices hardcoded in the step scripts by command line options.
+The basins of a region/level are taken from the HydroBASINS file, optionally restricted to a country (Earth
+Engine query of `step1_download_fabdem_by_country.py`), to explicit ids or to a list in `constant.py`. Each stage
+reuses the functions of the step scripts and skips work that is already done.
+
+`--dry-run` only plans the run and prints predicted tile count, download bytes, pixel count, memory peak and
+wall time. The predictions come from a simple cost model (`BYTES_PER_PIXEL`, `SECONDS_PER_MPIXEL`, ...) that can
+be calibrated on the command line from a previous run.
+
+Example:
+    python pipeline.py --region eu --level 5 --acc-thresh 100 1000 --country Italy --dry-run
+    python pipeline.py --region sa --level 6 --ids-from constant:missing_ids_lv6 --stages hand upload
+"""
+import argparse
+import importlib
+import os
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+STAGES = ['download', 'extract', 'hand', 'convert', 'upload']
+DEFAULT_STAGES = ['download', 'extract', 'hand', 'upload']
+
+FABDEM_URL = "https://data.bris.ac.uk/datasets/s5hqmjcdj8yo2ibzi9b4ew3sn/"
+FABDEM_GEOJSON = "data/FABDEM_v1-2_tiles.geojson"
+PIXELS_PER_DEGREE = 3600  # FABDEM is 1 arc-second
+
+# cost model of the dry run; rough figures for a single worker, calibrate with the command line options
+TILE_BYTES = 25e6  # compressed size of a 1x1 degree FABDEM tile in its zip
+BYTES_PER_PIXEL = 64  # peak memory of `calculate_hand_for_basins` per basin window pixel (pysheds engines)
+SECONDS_PER_MPIXEL = 2.0  # HAND wall time per million basin window pixels
+CONVERT_SECONDS_PER_MPIXEL = 0.05
+OUTPUT_BYTES_PER_PIXEL = 0.6  # compressed uint16 COG
+BANDWIDTH = 20e6  # bytes/s, download and upload
+
+
+def basins_file(region, level):
+    return Path(f"data/hydroBASIN/hybas_{region}_lev{level:02d}_v1c.zip")
+
+
+def select_basins(hydroBASIN, country=None, hybas_ids=None, ids_from=None):
+    """Basins of the run: all basins of the file, or those of a country, of explicit ids or of a list in a module
+
+    hydroBASIN: GeoDataFrame of HydroBASINS polygons, or a `basin_store.BasinStore` from which only the selected
+        basins are read
+    ids_from: `module:attribute`, e.g. `constant:missing_ids_lv6`
+    """
+    if country is not None:
+        from step1_download_fabdem_by_country import query_by_country
+        _, hybas_ids = query_by_country(country_name=country)
+    elif ids_from is not None:
+        module, attribute = ids_from.split(':')
+        hybas_ids = getattr(importlib.import_module(module), attribute)
+
+    from basin_store import BasinStore
+
+    if isinstance(hydroBASIN, BasinStore):
+        if hybas_ids is not None:
+            hybas_ids = [hybas_id for hybas_id in dict.fromkeys(hybas_ids) if hybas_id in hydroBASIN]
+        return hydroBASIN.select(hybas_ids)
+    if hybas_ids is not None:
+        hydroBASIN = hydroBASIN[hydroBASIN.HYBAS_ID.isin(list(hybas_ids))]
+    return hydroBASIN
+
+
+def window_pixels(bounds):
+    """Number of pixels of the FABDEM windows of basins (minx, miny, maxx, maxy), padded as in `calculate_hand_for_basins`"""
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+    width = np.ceil((bounds[:, 2] - bounds[:, 0]) * PIXELS_PER_DEGREE) + 2
+    height = np.ceil((bounds[:, 3] - bounds[:, 1]) * PIXELS_PER_DEGREE) + 2
+    return (width * height).astype(np.int64)
+
+
+def basin_window_pixels(geometries):
+    """`window_pixels` of basin geometries, antimeridian basins in the [0°, 360°) frame they are processed in"""
+    from antimeridian import shifted_bounds
+    return window_pixels(shifted_bounds(geometries))
+
+
+def plan_run(basins, acc_threshs, stages=DEFAULT_STAGES, tiles_geojson=FABDEM_GEOJSON, zip_dir="data/FABDEM/zips",
+             tile_dir="data/FABDEM/tiles", head=False, tile_bytes=TILE_BYTES, bytes_per_pixel=BYTES_PER_PIXEL,
+             seconds_per_mpixel=SECONDS_PER_MPIXEL, bandwidth=BANDWIDTH, n_workers=1, worker_memory=None):
+    """Work of every stage of a run, with the predictions of the cost model
+
+    Args:
+        basins: GeoDataFrame of the selected HydroBASINS polygons
+        acc_threshs: accumulation thresholds, HAND is calculated once per threshold
+        stages: stages to run, see `STAGES`
+        zip_dir, tile_dir: download and extraction folders; zips and tiles already there are not counted
+        head: ask the server for the zip sizes instead of estimating them from `tile_bytes`
+        n_workers, worker_memory: HAND workers and their memory limit in bytes; the hand stage time is the total
+            time of the largest-first packing of `scheduling.pack_basins`, an estimate only (`run` is serial)
+
+    Returns:
+        plan: dict with the zips, tiles, basin window pixels and the predicted bytes, memory peak and seconds
+    """
+    import geopandas as gpd
+
+    tiles = gpd.read_file(tiles_geojson)
+    intersecting = gpd.sjoin(tiles, basins[['HYBAS_ID', 'geometry']], how='inner', predicate='intersects')
+    tile_names = sorted(intersecting.file_name.unique())
+    zip_names = sorted(intersecting.zipfile_name.unique())
+
+    missing_zips = [name for name in zip_names if not (Path(zip_dir) / name).exists()]
+    missing_tiles = [name for name in tile_names if not (Path(tile_dir) / name).exists()]
+    tiles_per_zip = tiles.groupby('zipfile_name').size()
+    if head:
+        import requests
+        zip_bytes = {name: int(requests.head(FABDEM_URL + name, allow_redirects=True).headers.get('content-length', 0))
+                     for name in missing_zips}
+    else:
+        zip_bytes = {name: tiles_per_zip.get(name, 0) * tile_bytes for name in missing_zips}
+
+    from scheduling import basin_costs, pack_basins
+
+    pixels = basin_window_pixels(basins.geometry)
+    download_bytes = sum(zip_bytes.values())
+    n_runs = len(acc_threshs)
+    costs = basin_costs(basins, bytes_per_pixel=bytes_per_pixel)
+    assignments, loads, unschedulable = pack_basins(costs, [worker_memory] * n_workers,
+                                                    seconds_per_pixel=seconds_per_mpixel / 1e6)
+
+    seconds = {
+        'download': download_bytes / bandwidth if 'download' in stages else 0,
+        'extract': 0,
+        'hand': loads.max() * n_runs if 'hand' in stages and len(loads) else 0,
+        'convert': pixels.sum() / 1e6 * CONVERT_SECONDS_PER_MPIXEL * (n_runs + 1) if 'convert' in stages else 0,
+        'upload': pixels.sum() * OUTPUT_BYTES_PER_PIXEL * (n_runs + 1) / bandwidth if 'upload' in stages else 0,
+    }
+    # every zip with a missing tile is extracted as a whole, at roughly disk speed
+    extract_zips = sorted(intersecting[intersecting.file_name.isin(missing_tiles)].zipfile_name.unique())
+    if 'extract' in stages:
+        seconds['extract'] = sum(tiles_per_zip.get(name, 0) for name in extract_zips) * tile_bytes / 200e6
+
+    largest = np.argsort(pixels)[::-1][:5]
+    return {
+        'stages': list(stages),
+        'acc_threshs': list(acc_threshs),
+        'n_basins': len(basins),
+        'tiles': tile_names,
+        'zips': zip_names,
+        'missing_zips': missing_zips,
+        'missing_tiles': missing_tiles,
+        'extract_zips': extract_zips,
+        'download_bytes': download_bytes,
+        'pixels': int(pixels.sum()),
+        'memory_peak': int(pixels.max() * bytes_per_pixel) if len(pixels) else 0,
+        'largest_basins': [(int(basins.HYBAS_ID.iloc[i]), int(pixels[i]), int(pixels[i] * bytes_per_pixel))
+                           for i in largest],
+        'n_workers': n_workers,
+        'worker_loads': loads * n_runs,
+        'unschedulable': unschedulable,
+        'seconds': seconds,
+    }
+
+
+def print_plan(plan):
+    gb = 1024 ** 3
+    print(f"stages: {' -> '.join(plan['stages'])}, thresholds: {plan['acc_threshs']}")
+    print(f"basins: {plan['n_basins']}")
+    print(f"tiles: {len(plan['tiles'])} in {len(plan['zips'])} zips, "
+          f"{len(plan['missing_tiles'])} tiles / {len(plan['missing_zips'])} zips missing")
+    print(f"download: {plan['download_bytes'] / gb:.2f} GB")
+    print(f"pixels: {plan['pixels'] / 1e9:.2f} Gpx per threshold")
+    print(f"memory peak: {plan['memory_peak'] / gb:.2f} GB")
+    for hybas_id, pixels, memory in plan['largest_basins']:
+        print(f"    basin {hybas_id}: {pixels / 1e6:.0f} Mpx, {memory / gb:.2f} GB")
+    if plan['n_workers'] > 1:
+        print(f"hand workers: {plan['n_workers']}, load {plan['worker_loads'].min() / 3600:.2f} - "
+              f"{plan['worker_loads'].max() / 3600:.2f} h")
+    if plan['unschedulable']:
+        print(f"basins exceeding the worker memory: {plan['unschedulable']}")
+    for stage, seconds in plan['seconds'].items():
+        if stage in plan['stages']:
+            print(f"{stage:>10}: {seconds / 3600:.2f} h")
+    print(f"{'total':>10}: {sum(plan['seconds'].values()) / 3600:.2f} h")
+
+
+def basin_output_files(folder, prefix, hybas_ids):
+    """The .tif outputs of the basins `hybas_ids` in `folder`, including the east/west parts of antimeridian basins"""
+    hybas_ids = {int(hybas_id) for hybas_id in hybas_ids}
+    return [filename for filename in sorted(os.listdir(folder))
+            if filename.startswith(prefix) and filename.endswith('.tif')
+            and int(Path(filename).stem.split('_')[-1]) in hybas_ids]
+
+
+def existing_assets(ee_img_col):
+    """Names of the images already in an Earth Engine ImageCollection"""
+    import ee
+
+    names, page_token = set(), None
+    while True:
+        params = {'parent': ee_img_col}
+        if page_token:
+            params['pageToken'] = page_token
+        response = ee.data.listAssets(params)
+        names.update(asset['name'].split('/')[-1] for asset in response.get('assets', []))
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return names
+
+
+def run(plan, basins, acc_threshs, zip_dir="data/FABDEM/zips", tile_dir="data/FABDEM/tiles", output_dir="outputs",
+        n_threads=None, only_changed=False, basin_level=5, ee_collection="projects/global-wetland-watch/assets/features",
+        gs_dir="gs://hand_from_fabdem", conditioning='pysheds', routing_engine='pysheds'):
+    """Runs the stages of `plan` in order
+
+    conditioning, routing_engine: see `calculate.calculate_hand`; `n_threads` only threads accumulation and HAND
+        with routing_engine='numba'
+
+    The upload stage only copies and ingests the outputs of `basins`; files already in `gs_dir` and images already
+    in the Earth Engine collection are skipped.
+    """
+    from step1_download_fabdem_by_hydroBASIN import download_files_in_parallel, unzip_file
+
+    zip_dir, tile_dir, output_dir = Path(zip_dir), Path(tile_dir), Path(output_dir)
+    stages = plan['stages']
+
+    if 'download' in stages and plan['missing_zips']:
+        zip_dir.mkdir(exist_ok=True, parents=True)
+        download_files_in_parallel(urls=[FABDEM_URL + name for name in plan['missing_zips']], dst_folder=zip_dir)
+
+    if 'extract' in stages:
+        for name in plan['extract_zips']:
+            unzip_file(zip_dir / name, tile_dir)
+
+    if 'hand' in stages:
+        from scheduling import order_largest_first
+        from step2_fabdem_to_hand import process_basins
+        # largest first, so that a basin that does not fit into memory fails early
+        for acc_thresh in acc_threshs:
+            process_basins(basins, order_largest_first(basins), acc_thresh=acc_thresh, fabdem_path=tile_dir,
+                           hand_path=output_dir / f"hand_acc{acc_thresh}", only_changed=only_changed,
+                           n_threads=n_threads, conditioning=conditioning, routing_engine=routing_engine,
+                           output_dir=output_dir)
+
+    folders = {f"hand_acc{acc_thresh}": ("hand", acc_thresh) for acc_thresh in acc_threshs}
+    folders["flow_acc"] = ("flow_acc", None)
+
+    if 'convert' in stages:
+        # the outputs of `calculate_hand_for_basins` are uint16 already (copied as they are); this normalizes the
+        # float outputs of older runs: HAND in decimeters, flow accumulation saturated at 65534
+        from float32_to_uint16 import convert_folder_to_uint16
+        for folder, (prefix, _) in list(folders.items()):
+            convert_folder_to_uint16(output_dir / folder, output_dir / f"{folder}_uint16", prefix=prefix,
+                                     scale=10 if prefix == 'hand' else 1)
+            folders[f"{folder}_uint16"] = folders.pop(folder)
+
+    if 'upload' in stages:
+        import step3_upload_hand_into_gee as upload_hand
+        import step3_upload_flow_acc_into_gee as upload_flow_acc
+
+        for folder, (prefix, acc_thresh) in folders.items():
+            module = upload_hand if prefix == 'hand' else upload_flow_acc
+            ee_img_col = f"{ee_collection}/{'hand' if prefix == 'hand' else 'flow_accumulation'}"
+            filenames = basin_output_files(output_dir / folder, prefix, basins.HYBAS_ID)
+            if not filenames:
+                continue
+            # -n: objects already in the bucket are not copied again
+            subprocess.run(['gsutil', '-m', 'cp', '-n', '-I', f"{gs_dir}/{folder}/"], check=True, text=True,
+                           input=''.join(f"{output_dir / folder / filename}\n" for filename in filenames))
+            ingested = existing_assets(ee_img_col)
+            for filename in filenames:
+                if Path(filename).stem in ingested:
+                    continue
+                kwargs = {'acc_thresh': acc_thresh} if acc_thresh is not None else {}
+                module.upload_geotiff_with_properties(f"{gs_dir}/{folder}/{filename}", basin_level=basin_level,
+                                                      ee_img_col=ee_img_col, **kwargs)
+
+
+if __name__ == "__main__":
+
+    from basin_store import open_basins
+
+    parser = argparse.ArgumentParser(description='Plan and run download -> extract -> hand -> convert -> upload')
+    parser.add_argument('--region', required=True, help='HydroBASINS region, e.g. eu, sa, af, au')
+    parser.add_argument('--level', type=int, default=5, help='HydroBASINS level')
+    parser.add_argument('--acc-thresh', type=int, nargs='+', default=[100], help='accumulation thresholds')
+    parser.add_argument('--basins-file', help='HydroBASINS file, defaults to data/hydroBASIN/hybas_{region}_lev{level}_v1c.zip')
+    parser.add_argument('--country', help='only the basins intersecting a country (Earth Engine query)')
+    parser.add_argument('--hybas-ids', type=int, nargs='+', help='only these basins')
+    parser.add_argument('--ids-from', help='only the basins of a list in a module, e.g. constant:missing_ids_lv6')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=DEFAULT_STAGES)
+    parser.add_argument('--zip-dir', default='data/FABDEM/zips')
+    parser.add_argument('--tile-dir', default='data/FABDEM/tiles')
+    parser.add_argument('--output-dir', default='outputs')
+    parser.add_argument('--tiles-geojson', default=FABDEM_GEOJSON)
+    parser.add_argument('--n-threads', type=int, default=os.cpu_count(), help='threads inside a basin')
+    parser.add_argument('--conditioning', choices=['pysheds', 'priority_flood'], default='pysheds')
+    parser.add_argument('--routing-engine', choices=['pysheds', 'numba'], default='pysheds',
+                        help='numba also threads accumulation and HAND')
+    parser.add_argument('--only-changed', action='store_true', help='rerun only basins with changed inputs')
+    parser.add_argument('--dry-run', action='store_true', help='only print the plan and its predictions')
+    parser.add_argument('--head', action='store_true', help='ask the server for the zip sizes in the dry run')
+    parser.add_argument('--tile-bytes', type=float, default=TILE_BYTES)
+    parser.add_argument('--bytes-per-pixel', type=float, default=BYTES_PER_PIXEL)
+    parser.add_argument('--seconds-per-mpixel', type=float, default=SECONDS_PER_MPIXEL)
+    parser.add_argument('--bandwidth', type=float, default=BANDWIDTH, help='bytes/s')
+    parser.add_argument('--n-workers', type=int, default=1, help='HAND workers of the dry run estimate')
+    parser.add_argument('--worker-memory', type=float, help='GB per HAND worker for the dry run estimate')
+    args = parser.parse_args()
+
+    hydroBASIN = open_basins(args.basins_file or basins_file(args.region, args.level))
+    basins = select_basins(hydroBASIN, country=args.country, hybas_ids=args.hybas_ids, ids_from=args.ids_from)
+
+    plan = plan_run(basins, args.acc_thresh, stages=args.stages, tiles_geojson=args.tiles_geojson,
+                    zip_dir=args.zip_dir, tile_dir=args.tile_dir, head=args.head, tile_bytes=args.tile_bytes,
+                    bytes_per_pixel=args.bytes_per_pixel, seconds_per_mpixel=args.seconds_per_mpixel,
+                    bandwidth=args.bandwidth, n_workers=args.n_workers,
+                    worker_memory=args.worker_memory * 1024 ** 3 if args.worker_memory is not None else None)
+    print_plan(plan)
+
+    if not args.dry_run:
+        run(plan, basins, args.acc_thresh, zip_dir=args.zip_dir, tile_dir=args.tile_dir, output_dir=args.output_dir,
+            n_threads=args.n_threads, only_changed=args.only_changed, basin_level=args.level,
+            conditioning=args.conditioning, routing_engine=args.routing_engine)
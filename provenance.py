@@ -0,0 +1,270 @@
+"""Dependency tracking of the per-basin HAND outputs
+
+Every HAND output gets a manifest next to it (`hand_100_basin5_id_1.tif` -> `hand_100_basin5_id_1.deps.json`)
+recording what produced it:
+    * the FABDEM tiles intersecting the basin (size, mtime and sha256) and the hash of their tiles index entries
+    * the hash of the basin geometry
+    * `acc_thresh` and the other parameters of `calculate_hand_for_basins`
+    * the code version, a hash of the modules that compute HAND
+
+`plan_basins` compares the manifests with the current inputs and returns the basins that have to be rerun, with
+the reasons, so that a FABDEM update or an edited tile entry only reprocesses the basins it affects. A tile whose
+mtime changed is compared by content, so an identical re-download is not a change.
+
+Example:
+    python provenance.py data/hydroBASIN/hybas_eu_lev05_v1c.zip --hand-path outputs/hand_acc100 --acc-thresh 100
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import shapely
+from shapely.geometry import GeometryCollection
+from shapely.geometry.base import BaseGeometry
+
+log = logging.getLogger(__name__)
+
+FABDEM_GEOJSON = 'data/FABDEM_v1-2_tiles.geojson'
+
+# modules whose changes change the HAND outputs
+CODE_FILES = ['calculate.py', 'conditioning.py', 'd8.py', 'antimeridian.py']
+
+
+def file_sha256(filename: Union[str, Path], chunk_size: int = 8 * 1024 * 1024) -> str:
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+@lru_cache(maxsize=4096)
+def _cached_sha256(filename: str, size: int, mtime_ns: int) -> str:
+    # keyed by size and mtime, so tiles shared by many basins are hashed once per process
+    return file_sha256(filename)
+
+
+def tile_record(filename: Union[str, Path], checksum: bool = False) -> Optional[Dict]:
+    """size, mtime and optionally sha256 of a tile file, None if it does not exist"""
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    record = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if checksum:
+        record['sha256'] = _cached_sha256(str(filename), stat.st_size, stat.st_mtime_ns)
+    return record
+
+
+@lru_cache(maxsize=None)
+def code_version(files: Tuple[str, ...] = tuple(CODE_FILES)) -> str:
+    """Hash of the source of the modules that compute HAND"""
+    sha256 = hashlib.sha256()
+    for filename in files:
+        path = Path(__file__).parent / filename
+        sha256.update(filename.encode())
+        if path.exists():
+            sha256.update(path.read_bytes())
+    return sha256.hexdigest()[:16]
+
+
+def geometry_hash(geometry: BaseGeometry) -> str:
+    """Hash of the normalized WKB of a geometry, independent of the vertex order of its rings and parts
+
+    A collection of a single geometry (e.g. `GeometryCollection([basin.geometry])[0]` in `process_basins`) has the
+    hash of that geometry, so that it matches the plain polygons of `plan_basins`.
+    """
+    while isinstance(geometry, GeometryCollection) and len(geometry.geoms) == 1:
+        geometry = geometry.geoms[0]
+    return hashlib.sha256(shapely.normalize(geometry).wkb).hexdigest()[:16]
+
+
+@lru_cache(maxsize=None)
+def _tile_features(tiles_geojson: str):
+    from asf_tools import vector
+    return vector.get_features(tiles_geojson)
+
+
+@lru_cache(maxsize=4)
+def _tile_entries(tiles_geojson: str, mtime_ns: int) -> Dict[str, str]:
+    # sha256 of every feature of the tiles index by file name, re-read when the index changes
+    features = json.loads(Path(tiles_geojson).read_text())['features']
+    return {feature['properties']['file_name']: hashlib.sha256(json.dumps(feature, sort_keys=True).encode()).hexdigest()
+            for feature in features}
+
+
+def tile_entries_hash(tiles: Iterable[str], tiles_geojson: str = FABDEM_GEOJSON) -> Optional[str]:
+    """Hash of the entries of `tiles` in the tiles index, None without an index
+
+    Only the entries of the basin's tiles are hashed, so that an edit of the index for one tile does not mark every
+    basin as changed.
+    """
+    if not Path(tiles_geojson).exists():
+        return None
+    entries = _tile_entries(str(tiles_geojson), os.stat(tiles_geojson).st_mtime_ns)
+    sha256 = hashlib.sha256()
+    for name in sorted(tiles):
+        sha256.update(name.encode())
+        sha256.update(entries.get(name, '').encode())
+    return sha256.hexdigest()[:16]
+
+
+def basin_tiles(geometry: BaseGeometry, tiles_geojson: str = FABDEM_GEOJSON) -> List[str]:
+    """File names of the FABDEM tiles intersecting a basin, as selected by `prepare_fabdem_vrt`"""
+    from asf_tools import vector
+    from osgeo import ogr
+
+    ogr_geometry = ogr.CreateGeometryFromWkb(geometry.wkb)
+    return sorted(vector.intersecting_feature_properties(ogr_geometry, _tile_features(str(tiles_geojson)),
+                                                         'file_name'))
+
+
+def manifest_file(out_raster: Union[str, Path]) -> Path:
+    return Path(out_raster).with_suffix('.deps.json')
+
+
+def build_manifest(hybas_id, geometry: BaseGeometry, acc_thresh, fabdem_path: Union[str, Path],
+                   tiles_geojson: str = FABDEM_GEOJSON, checksum: bool = True, outputs: Iterable = (),
+                   **params) -> Dict:
+    """Record of the inputs of one basin output
+
+    Args:
+        hybas_id: HydroBASINS id of the basin
+        geometry: basin geometry in EPSG:4326, as read from HydroBASINS (before any antimeridian shift)
+        acc_thresh: accumulation threshold
+        fabdem_path: folder with the extracted FABDEM tiles
+        tiles_geojson: FABDEM tiles index
+        checksum: also record the sha256 of the tiles, so that a re-download with identical content is
+            not reported as a change; hashed once per tile and process
+        outputs: files written for the basin
+        params: other parameters of `calculate_hand_for_basins` that change the outputs, e.g.
+            conditioning='priority_flood', routing_engine='numba'
+    """
+    tiles = basin_tiles(geometry, tiles_geojson)
+    return {
+        'hybas_id': int(hybas_id),
+        'geometry': geometry_hash(geometry),
+        'acc_thresh': acc_thresh,
+        'params': params,
+        'code_version': code_version(),
+        'tile_entries': tile_entries_hash(tiles, tiles_geojson),
+        'tiles': {name: tile_record(Path(fabdem_path) / name, checksum=checksum) for name in tiles},
+        'outputs': [str(output) for output in outputs],
+    }
+
+
+def write_manifest(out_raster: Union[str, Path], manifest: Dict) -> Path:
+    filename = manifest_file(out_raster)
+    temp_file = filename.with_suffix('.json.tmp')
+    temp_file.write_text(json.dumps(manifest, indent=1))
+    os.replace(temp_file, filename)
+    return filename
+
+
+def read_manifest(out_raster: Union[str, Path]) -> Optional[Dict]:
+    filename = manifest_file(out_raster)
+    if not filename.exists():
+        return None
+    return json.loads(filename.read_text())
+
+
+def _tile_changed(name: str, recorded: Optional[Dict], fabdem_path: Union[str, Path]) -> bool:
+    current = tile_record(Path(fabdem_path) / name)
+    if recorded is None or current is None:
+        return recorded != current
+    if current['size'] == recorded['size'] and current['mtime'] == recorded['mtime']:
+        return False
+    if 'sha256' in recorded and current['size'] == recorded['size']:
+        return tile_record(Path(fabdem_path) / name, checksum=True)['sha256'] != recorded['sha256']
+    return True
+
+
+def changed_inputs(out_raster: Union[str, Path], hybas_id, geometry: BaseGeometry, acc_thresh,
+                   fabdem_path: Union[str, Path], tiles_geojson: str = FABDEM_GEOJSON, **params) -> List[str]:
+    """Reasons why the output of a basin is out of date, empty if it is up to date"""
+    manifest = read_manifest(out_raster)
+    if manifest is None:
+        return ['no manifest']
+
+    reasons = []
+    missing = [output for output in manifest['outputs'] if not Path(output).exists()]
+    if missing or not manifest['outputs']:
+        reasons.append(f'missing outputs {missing}')
+    if manifest['geometry'] != geometry_hash(geometry):
+        reasons.append('basin geometry')
+    if manifest['acc_thresh'] != acc_thresh:
+        reasons.append(f"acc_thresh {manifest['acc_thresh']} -> {acc_thresh}")
+    if manifest['params'] != params:
+        reasons.append(f"params {manifest['params']} -> {params}")
+    if manifest['code_version'] != code_version():
+        reasons.append('code version')
+
+    tiles = basin_tiles(geometry, tiles_geojson)
+    # manifests of older runs hashed the whole index instead, which is not compared
+    if 'tile_entries' in manifest and manifest['tile_entries'] != tile_entries_hash(tiles, tiles_geojson):
+        reasons.append('tiles index entries')
+    if set(tiles) != set(manifest['tiles']):
+        reasons.append(f"tiles {sorted(set(manifest['tiles']) ^ set(tiles))}")
+    changed = [name for name in tiles if name in manifest['tiles']
+               and _tile_changed(name, manifest['tiles'][name], fabdem_path)]
+    if changed:
+        reasons.append(f'modified tiles {changed}')
+
+    return reasons
+
+
+def hand_raster_name(hand_path: Union[str, Path], hybas_id, acc_thresh) -> Path:
+    """HAND output of a basin, named as in `step2_fabdem_to_hand.py`"""
+    return Path(hand_path) / f'hand_{acc_thresh}_basin5_id_{hybas_id}.tif'
+
+
+def plan_basins(basins: Iterable[Tuple[int, BaseGeometry]], hand_path: Union[str, Path], acc_thresh,
+                fabdem_path: Union[str, Path], tiles_geojson: str = FABDEM_GEOJSON,
+                **params) -> Dict[int, List[str]]:
+    """{hybas_id: reasons} of the basins whose output is missing or whose inputs changed
+
+    Args:
+        basins: (hybas_id, geometry) pairs, e.g. zip(hydroBASIN.HYBAS_ID, hydroBASIN.geometry)
+        hand_path: folder of the HAND outputs
+        acc_thresh, fabdem_path, tiles_geojson, params: current inputs, see `build_manifest`
+    """
+    stale = {}
+    for hybas_id, geometry in basins:
+        out_raster = hand_raster_name(hand_path, hybas_id, acc_thresh)
+        reasons = changed_inputs(out_raster, hybas_id, geometry, acc_thresh, fabdem_path, tiles_geojson, **params)
+        if reasons:
+            stale[int(hybas_id)] = reasons
+    return stale
+
+
+if __name__ == "__main__":
+
+    import geopandas as gpd
+
+    parser = argparse.ArgumentParser(description='List the basins whose HAND outputs are missing or out of date')
+    parser.add_argument('basins', help='HydroBASINS file, e.g. data/hydroBASIN/hybas_eu_lev05_v1c.zip')
+    parser.add_argument('--hand-path', default='outputs/hand_acc100')
+    parser.add_argument('--acc-thresh', type=int, default=100)
+    parser.add_argument('--fabdem-path', default='data/FABDEM/tiles')
+    parser.add_argument('--tiles-geojson', default=FABDEM_GEOJSON)
+    parser.add_argument('--conditioning', default='pysheds')
+    parser.add_argument('--routing-engine', default='pysheds')
+    parser.add_argument('--output', help='write the stale hybas_ids to this file, one per line')
+    args = parser.parse_args()
+
+    hydroBASIN = gpd.read_file(args.basins)
+    stale = plan_basins(zip(hydroBASIN.HYBAS_ID, hydroBASIN.geometry), args.hand_path, args.acc_thresh,
+                        args.fabdem_path, args.tiles_geojson, conditioning=args.conditioning,
+                        routing_engine=args.routing_engine)
+
+    for hybas_id, reasons in stale.items():
+        print(f"{hybas_id}: {'; '.join(reasons)}")
+    print(f'{len(stale)} of {len(hydroBASIN)} basins to be rerun')
+
+    if args.output:
+        Path(args.output).write_text(''.join(f'{hybas_id}\n' for hybas_id in stale))
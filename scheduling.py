@@ -0,0 +1,92 @@
+"""Order and pack basins by estimated cost
+
+The HAND time and memory of a basin grow with the pixel count of its FABDEM window (`pipeline.window_pixels`, in
+the [0°, 360°) frame for antimeridian basins), or, without geometries, roughly with its HydroBASINS `SUB_AREA`. Running the basins in arbitrary order often starts
+a giant basin last, which then dominates the total time. Here:
+    * `basin_costs` estimates the cost (pixels or area) and the peak memory of every basin
+    * `order_largest_first` orders the basins by decreasing cost
+    * `pack_basins` estimates the total time of a run on several workers by assigning the basins largest first
+      onto the least loaded worker with enough memory (LPT scheduling, at most 4/3 of the optimal total time).
+      It is only used for the dry run of `pipeline.py`: `pipeline.run` processes the basins one after the other,
+      and distributed workers claim jobs dynamically, which follows the same largest-first rule
+
+The distributed queue (`distributed.basin_jobs`) uses the cost as the job priority and the memory for the
+per-worker limits of `JobQueue.claim`.
+"""
+import heapq
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from pipeline import BYTES_PER_PIXEL, PIXELS_PER_DEGREE, basin_window_pixels
+
+# FABDEM pixels per km² at the equator; the pixel count of a SUB_AREA estimate is only used for ordering
+PIXELS_PER_KM2 = PIXELS_PER_DEGREE ** 2 / 111.32 ** 2
+
+
+def basin_costs(basins, by: str = 'pixels', bytes_per_pixel: float = BYTES_PER_PIXEL) -> pd.DataFrame:
+    """Cost and peak memory of every basin
+
+    Args:
+        basins: GeoDataFrame of HydroBASINS polygons, or a DataFrame with HYBAS_ID and SUB_AREA for `by='sub_area'`
+        by: `pixels` (pixel count of the basin window, from the geometry) or `sub_area` (HydroBASINS attribute, km²)
+        bytes_per_pixel: peak memory per pixel, see `pipeline.BYTES_PER_PIXEL`
+
+    Returns:
+        costs: DataFrame indexed by HYBAS_ID with `pixels` and `memory` (bytes), sorted by decreasing cost
+    """
+    if by == 'pixels':
+        pixels = basin_window_pixels(basins.geometry)
+    elif by == 'sub_area':
+        # the window of a basin is larger than its area; the estimate is good enough for ordering
+        pixels = np.asarray(basins.SUB_AREA, dtype=float) * PIXELS_PER_KM2
+    else:
+        raise ValueError(f"Unknown cost {by}, expected 'pixels' or 'sub_area'")
+
+    costs = pd.DataFrame({'pixels': np.asarray(pixels, dtype=np.int64)}, index=pd.Index(basins.HYBAS_ID, name='HYBAS_ID'))
+    costs['memory'] = (costs.pixels * bytes_per_pixel).astype(np.int64)
+    return costs.sort_values('pixels', ascending=False, kind='stable')
+
+
+def order_largest_first(basins, by: str = 'pixels') -> List[int]:
+    """hybas_ids ordered by decreasing cost"""
+    return [int(hybas_id) for hybas_id in basin_costs(basins, by=by).index]
+
+
+def pack_basins(costs: pd.DataFrame, worker_memory: Sequence[Optional[float]], seconds_per_pixel: float = 1.0):
+    """Assigns basins to workers, largest first onto the least loaded worker whose memory limit fits the basin
+
+    An estimate of the loads only, the assignments are not executed, see the module docstring.
+
+    Args:
+        costs: output of `basin_costs`
+        worker_memory: memory limit (bytes) of every worker, None for no limit; one basin runs at a time per worker
+        seconds_per_pixel: converts the pixel counts into the loads
+
+    Returns:
+        assignments: {worker index: [hybas_id, ...]} in processing order
+        loads: total cost of every worker
+        unschedulable: hybas_ids whose memory exceeds every worker's limit
+    """
+    limits = [np.inf if memory is None else memory for memory in worker_memory]
+    # one heap of (load, worker) per distinct limit, so that the least loaded fitting worker is found quickly
+    heaps: Dict[float, list] = {}
+    for worker, limit in enumerate(limits):
+        heaps.setdefault(limit, []).append((0.0, worker))
+
+    assignments = {worker: [] for worker in range(len(limits))}
+    loads = np.zeros(len(limits))
+    unschedulable = []
+    for hybas_id, pixels, memory in zip(costs.index, costs.pixels, costs.memory):
+        candidates = [limit for limit in heaps if limit >= memory]
+        if not candidates:
+            unschedulable.append(int(hybas_id))
+            continue
+        limit = min(candidates, key=lambda limit: heaps[limit][0])
+        load, worker = heapq.heappop(heaps[limit])
+        assignments[worker].append(int(hybas_id))
+        loads[worker] = load + pixels * seconds_per_pixel
+        heapq.heappush(heaps[limit], (loads[worker], worker))
+
+    return assignments, loads, unschedulable
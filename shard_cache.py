@@ -0,0 +1,204 @@
+"""Local cache of EarthView parquet shards with size-based LRU eviction and parallel prefetch
+
+Shards are addressed like on the hub, `{path}/{split}-{shard:05d}-of-{nshards:05d}.parquet`, and stored by the
+sha256 of their content under `{cache_dir}/objects/`. `{cache_dir}/index.json` maps shard paths to objects and
+records their size and last access for eviction. Shards being read (`pinned`, and the current shard of
+`iter_shards`) are never evicted, even if a prefetch takes the cache above `max_bytes` meanwhile.
+
+Example:
+    cache = ShardCache("dataset/cache", max_bytes=100 * 1024 ** 3)
+    for shard, filename in cache.iter_shards("satellogic", range(10, 20), prefetch=4):
+        indices = ev.scan_metadata(filename, IntersectionFilter().flags)
+"""
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+
+import earthview as ev
+
+
+class ShardCache:
+    """
+    cache_dir: folder of the cache, created if missing
+    max_bytes: size limit of the cached objects; the least recently used shards are evicted beyond it
+    mirror: optional local folder with the hub layout (`{mirror}/{path}/{split}-...parquet`); shards found
+        there are used in place, without copying, which makes the cache usable offline and in tests
+    source: fsspec URL prefix to download missing shards from, defaults to the hub dataset
+    max_workers: number of parallel downloads
+    """
+
+    def __init__(self, cache_dir="dataset/cache", max_bytes=50 * 1024 ** 3, mirror=None, source=None,
+                 dataset=ev.DATASET, split="train", max_workers=4):
+        self.cache_dir = Path(cache_dir)
+        self.objects_dir = self.cache_dir / "objects"
+        self.objects_dir.mkdir(exist_ok=True, parents=True)
+        self.index_file = self.cache_dir / "index.json"
+        self.max_bytes = max_bytes
+        self.mirror = Path(mirror) if mirror is not None else None
+        self.source = source if source is not None else f"hf://datasets/{dataset}"
+        self.split = split
+
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._pins = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._index = json.loads(self.index_file.read_text()) if self.index_file.exists() else {}
+
+    def shard_path(self, subset, shard):
+        nshards = ev.get_nshards(subset)
+        return f"{ev.get_path(subset)}/{self.split}-{shard:05d}-of-{nshards:05d}.parquet"
+
+    def _object_file(self, digest):
+        return self.objects_dir / digest[:2] / f"{digest}.parquet"
+
+    def _save_index(self):
+        temp_file = self.index_file.with_suffix(".json.tmp")
+        temp_file.write_text(json.dumps(self._index, indent=1))
+        os.replace(temp_file, self.index_file)
+
+    def _download(self, rel_path):
+        import fsspec
+
+        storage_options = {}
+        if self.source.startswith("hf://") and os.environ.get("HF_TOKEN"):
+            storage_options["token"] = os.environ["HF_TOKEN"]
+
+        temp_file = None
+        try:
+            sha256 = hashlib.sha256()
+            with fsspec.open(f"{self.source}/{rel_path}", "rb", **storage_options) as src, \
+                    NamedTemporaryFile(dir=self.objects_dir, delete=False) as dst:
+                temp_file = dst.name
+                for chunk in iter(lambda: src.read(8 * 1024 * 1024), b""):
+                    sha256.update(chunk)
+                    dst.write(chunk)
+
+            digest = sha256.hexdigest()
+            object_file = self._object_file(digest)
+            object_file.parent.mkdir(exist_ok=True)
+            os.replace(temp_file, object_file)
+            temp_file = None
+
+            with self._lock:
+                self._index[rel_path] = {"sha256": digest, "size": object_file.stat().st_size,
+                                         "last_access": time.time()}
+                self._evict(keep=rel_path)
+                self._save_index()
+            return object_file
+        finally:
+            if temp_file is not None:
+                Path(temp_file).unlink(missing_ok=True)
+            with self._lock:
+                self._futures.pop(rel_path, None)
+
+    def _evict(self, keep=None):
+        """Removes the least recently used shards until the cache fits into `max_bytes`; call with the lock held"""
+        total = sum(entry["size"] for entry in self._index.values())
+        for rel_path, entry in sorted(self._index.items(), key=lambda item: item[1]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            if rel_path == keep or rel_path in self._futures or rel_path in self._pins:
+                continue
+            del self._index[rel_path]
+            total -= entry["size"]
+            # objects are content-addressed, another shard path may point to the same object
+            if not any(e["sha256"] == entry["sha256"] for e in self._index.values()):
+                self._object_file(entry["sha256"]).unlink(missing_ok=True)
+
+    def _cached_file(self, rel_path):
+        """Local file of `rel_path` if it is in the mirror or the cache, else None; call with the lock held"""
+        if self.mirror is not None and (self.mirror / rel_path).exists():
+            return self.mirror / rel_path
+        entry = self._index.get(rel_path)
+        if entry is not None and self._object_file(entry["sha256"]).exists():
+            entry["last_access"] = time.time()
+            return self._object_file(entry["sha256"])
+        return None
+
+    def prefetch(self, subset, shards):
+        """Starts downloading the shards that are not cached yet in the background"""
+        for shard in shards:
+            rel_path = self.shard_path(subset, shard)
+            with self._lock:
+                if rel_path in self._futures or self._cached_file(rel_path) is not None:
+                    continue
+                self._futures[rel_path] = self._executor.submit(self._download, rel_path)
+
+    def get(self, subset, shard):
+        """Local filename of a shard, downloading it (or waiting for its prefetch) if needed"""
+        rel_path = self.shard_path(subset, shard)
+        while True:
+            self.prefetch(subset, [shard])
+            with self._lock:
+                filename = self._cached_file(rel_path)
+                future = self._futures.get(rel_path)
+            if filename is not None:
+                return filename
+            if future is not None:
+                return future.result()
+
+    def _pin(self, rel_path):
+        with self._lock:
+            self._pins[rel_path] = self._pins.get(rel_path, 0) + 1
+
+    def _unpin(self, rel_path):
+        with self._lock:
+            self._pins[rel_path] -= 1
+            if not self._pins[rel_path]:
+                del self._pins[rel_path]
+                # downloads while the shard was pinned may have left the cache above `max_bytes`
+                self._evict()
+                self._save_index()
+
+    @contextmanager
+    def pinned(self, subset, shard):
+        """Local filename of a shard (see `get`) that is not evicted until the end of the with block"""
+        rel_path = self.shard_path(subset, shard)
+        self._pin(rel_path)
+        try:
+            yield self.get(subset, shard)
+        finally:
+            self._unpin(rel_path)
+
+    def iter_shards(self, subset, shards, prefetch=2):
+        """Yields (shard, local filename) while the next `prefetch` shards are downloaded in parallel
+
+        A shard stays pinned until the next one is requested, so that prefetching cannot evict it while it is read.
+        """
+        shards = list(shards)
+        for i, shard in enumerate(shards):
+            rel_path = self.shard_path(subset, shard)
+            self._pin(rel_path)
+            try:
+                self.prefetch(subset, shards[i:i + 1 + prefetch])
+                yield shard, self.get(subset, shard)
+            finally:
+                self._unpin(rel_path)
+
+    def size(self):
+        return sum(entry["size"] for entry in self._index.values())
+
+    def clear(self):
+        with self._lock:
+            shutil.rmtree(self.objects_dir, ignore_errors=True)
+            self.objects_dir.mkdir(exist_ok=True, parents=True)
+            self._index = {}
+            self._save_index()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._save_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -92,7 +92,7 @@ if __name__ == "__main__":
     from shapely.geometry import GeometryCollection, box
     # from asf_tools.dem import prepare_dem_vrt
 
-    import geopandas as gpd
+    from basin_store import open_basins
 
     acc_thresh = 100 # accumulation threshold
     fabdem_path = Path("data/FABDEM/sa")
@@ -101,19 +101,20 @@ if __name__ == "__main__":
     hand_path.mkdir(exist_ok=True, parents=True)
     
     # Italy, northern Algeria, Kenya, Uganda, South Africa, Australia 
-    basin_lv5 = gpd.read_file("data/hydroBASIN/hybas_sa_lev05_v1c.zip")
-    basin_lv6 = gpd.read_file("data/hydroBASIN/hybas_sa_lev06_v1c.zip")
+    basin_lv6 = open_basins("data/hydroBASIN/hybas_sa_lev06_v1c.zip", columns=['SUB_AREA', 'UP_AREA'])
     
     from constant import missing_ids_lv6
 
-    hydroBASIN = basin_lv6[basin_lv6.HYBAS_ID.isin(missing_ids_lv6)]
+    hydroBASIN = basin_lv6.select([hybas_id for hybas_id in dict.fromkeys(missing_ids_lv6) if hybas_id in basin_lv6])
+    basins = hydroBASIN.set_index('HYBAS_ID', drop=False)
+    basins.index.name = None
     print(hydroBASIN)
 
     # for idx, hybas_id in enumerate(tqdm([6050000750])): # 6050068100, 6050000740
     for idx, hybas_id in enumerate(tqdm(hydroBASIN.HYBAS_ID.unique())): #  6050069460, 6050001940, 6050266740
 
         if idx >= 0: # 388
-            basin = hydroBASIN[hydroBASIN.HYBAS_ID==hybas_id] # 6050069460
+            basin = basins.loc[[hybas_id]] # 6050069460
 
             print(f"=============================== idx: {idx}, hybas_id: {hybas_id} ===================================")
             print('basin SUB_AREA', basin.SUB_AREA)
@@ -43,7 +43,8 @@ def prepare_fabdem_vrt(vrt: Union[str, Path], geometry: Union[ogr.Geometry, Base
 
         min_lon, max_lon, _, _ = geometry.GetEnvelope()
         if min_lon < -160. and max_lon > 160.:
-            raise ValueError(f'asf_tools does not currently support geometries that cross the antimeridian: {geometry}')
+            raise ValueError(f'asf_tools does not currently support geometries that cross the antimeridian, '
+                             f'use antimeridian.prepare_fabdem_vrt_antimeridian: {geometry}')
 
         tile_features = vector.get_features(DEM_GEOJSON)
         if not vector.get_property_values_for_intersecting_features(geometry, tile_features):
@@ -75,50 +76,93 @@ def prepare_fabdem_vrt(vrt: Union[str, Path], geometry: Union[ogr.Geometry, Base
 #         return new_value
 #     return value
 
-def log_error_ids(hybas_id):
-    with open("outputs/error_ids.txt", "a") as log_file:
+def log_error_ids(hybas_id, output_dir="outputs"):
+    with open(Path(output_dir) / "error_ids.txt", "a") as log_file:
         log_file.write(f"Failed to process file: {hybas_id}\n")
 
 
 
 
-if __name__ == "__main__":
-    
+def process_basins(hydroBASIN, hybas_ids, acc_thresh=100, fabdem_path="data/FABDEM/tiles", hand_path=None,
+                   use_global_vrt=True, keep_basin_vrt=False, only_changed=False, n_threads=None,
+                   conditioning='pysheds', routing_engine='pysheds', raise_errors=False, should_stop=None,
+                   output_dir="outputs", cog_profile='lzw', network_dir=None):
+    """Calculate HAND and flow accumulation for the given basins, one after the other
 
-    import os, time
+    Args:
+        hydroBASIN: GeoDataFrame of HydroBASINS polygons containing `hybas_ids`, or a `basin_store.BasinStore`
+            from which only these basins are read
+        hybas_ids: ids of the basins to process
+        acc_thresh: accumulation threshold
+        fabdem_path: folder with the extracted FABDEM tiles
+        hand_path: output folder, defaults to `output_dir`/hand_acc{acc_thresh}
+        use_global_vrt: read basin windows from one VRT over all tiles (kept open across basins) instead of one
+            VRT per basin
+        keep_basin_vrt: keep the per-basin VRTs after use
+        only_changed: rerun only the basins whose output is missing or whose inputs changed, see provenance.py;
+            their flow accumulation is rewritten as well
+        n_threads: threads inside a basin (flow direction, NaN filling; with routing_engine='numba' also
+            accumulation and HAND), None for single-threaded
+        conditioning, routing_engine: engines of `calculate.calculate_hand`, recorded in the manifests
+        raise_errors: re-raise out-of-memory errors after logging them, e.g. so that a job queue retries the basin
+        should_stop: called before and after every basin; if it returns True, the loop stops without writing the
+            manifest of the current basin, e.g. when a distributed worker lost the lease of its job
+        output_dir: output root of the flow accumulation, VRTs, temporary files and error log
+        cog_profile: compression profile of the output COGs, also of the antimeridian parts, see `calculate.COG_PROFILES`
+        network_dir: if given, the drainage networks are written there, see `calculate_hand_for_basins`; those of
+            antimeridian basins are moved back to valid longitudes
+
+    Returns:
+        hybas_ids: ids of the basins that were processed
+    """
+    import time
     import numpy as np
     from tqdm import tqdm
-    import rasterio
-    from pathlib import Path 
-    from shapely.geometry import GeometryCollection, box
-    # from asf_tools.dem import prepare_dem_vrt
-
-    import geopandas as gpd
-
-    acc_thresh = 100 # accumulation threshold
-    fabdem_path = Path("data/FABDEM/tiles")
-
-    hand_path = Path(f"outputs/hand_acc{acc_thresh}")
+    from shapely.geometry import GeometryCollection
+
+    from antimeridian import (crosses_antimeridian, prepare_fabdem_vrt_antimeridian, split_antimeridian_output,
+                              wrap_antimeridian_network)
+    from basin_store import BasinStore
+    from buffer_pool import get_worker_pool
+    from calculate import calculate_hand_for_basins
+    from dem_cache import build_global_vrt, get_worker_cache
+    from drainage_network import network_file_name
+    from provenance import build_manifest, plan_basins, write_manifest
+
+    if isinstance(hydroBASIN, BasinStore):
+        hydroBASIN = hydroBASIN.select(hybas_ids, columns=['SUB_AREA', 'UP_AREA'])
+    # HYBAS_ID lookups through the index instead of a scan of the table per basin
+    basins = hydroBASIN.set_index('HYBAS_ID', drop=False)
+    basins.index.name = None
+
+    fabdem_path = Path(fabdem_path)
+    output_dir = Path(output_dir)
+    hand_path = Path(hand_path) if hand_path is not None else output_dir / f"hand_acc{acc_thresh}"
     hand_path.mkdir(exist_ok=True, parents=True)
-    
-    # TODO: change basin source!
-    # Italy, northern Algeria, Kenya, Uganda, South Africa / East Africa, Australia 
-    hydroBASIN = gpd.read_file("data/hydroBASIN/hybas_eu_lev05_v1c.zip")
 
-    # from constant import missing_ids
-    from step1_download_fabdem_by_country import query_by_country
-    _, hybas_ids = query_by_country(country_name='Italy')
+    if only_changed:
+        selected = basins[basins.index.isin(hybas_ids)]
+        stale = plan_basins(zip(selected.HYBAS_ID, selected.geometry), hand_path, acc_thresh, fabdem_path,
+                            conditioning=conditioning, routing_engine=routing_engine)
+        for hybas_id, reasons in stale.items():
+            print(f"{hybas_id}: {'; '.join(reasons)}")
+        hybas_ids = [hybas_id for hybas_id in hybas_ids if hybas_id in stale]
 
     print('hybas_ids')
     print(hybas_ids)
     print(f'{len(hybas_ids)} basins to be generted ...')
 
-    for idx, hybas_id in enumerate(tqdm(hybas_ids)): # 6050068100, 6050000740
-    # for idx, hybas_id in enumerate(tqdm(hydroBASIN.HYBAS_ID.unique())): #  6050069460, 6050001940, 6050266740
+    dem_cache = get_worker_cache(maxsize=16, cachemax_mb=1024, max_dataset_pool_size=500)
+    # work buffers kept across basins (and across calls in a distributed worker), sized to the largest basin
+    pool = get_worker_pool()
+    global_vrt = None
+    if use_global_vrt:
+        global_vrt = build_global_vrt(output_dir / 'vrt' / 'fabdem_global.vrt', fabdem_path)
 
+    for idx, hybas_id in enumerate(tqdm(hybas_ids)): # 6050068100, 6050000740
         # if (idx >= 288) and (idx < 388): # 288 -> 387
 
-        basin = hydroBASIN[hydroBASIN.HYBAS_ID==hybas_id] # 6050069460
+        basin = basins.loc[[hybas_id]] # 6050069460
 
         print(f"=============================== idx: {idx}, hybas_id: {hybas_id} ===================================")
         print('basin SUB_AREA', basin.SUB_AREA)
@@ -127,20 +171,91 @@ if __name__ == "__main__":
         basin_geo = GeometryCollection([basin.geometry])[0]
 
         start_time = time.time()
+        # inputs recorded before the geometry is shifted for the antimeridian
+        manifest_geo = basin_geo
+
+        # basins crossing the antimeridian are processed in a [0, 360) longitude frame and split afterwards
+        is_antimeridian = crosses_antimeridian(basin_geo)
+        if is_antimeridian:
+            fabdem_vrt = output_dir / 'vrt' / f'fabdem_basin5_id_{hybas_id}_360.vrt'
+            basin_geo = prepare_fabdem_vrt_antimeridian(vrt=fabdem_vrt, geometry=basin_geo, fabdem_path=fabdem_path)
+        elif use_global_vrt:
+            fabdem_vrt = global_vrt
+        else:
+            fabdem_vrt = output_dir / 'vrt' / f'fabdem_basin5_id_{hybas_id}.vrt'
+            prepare_fabdem_vrt(vrt=fabdem_vrt, geometry=basin_geo, dem='fabdem', fabdem_path=fabdem_path)
 
-        fabdem_vrt = Path("outputs") / 'vrt' / f'fabdem_basin5_id_{hybas_id}.vrt'
-        prepare_fabdem_vrt(vrt=fabdem_vrt, geometry=basin_geo, dem='fabdem', fabdem_path=fabdem_path)
-
-        from calculate import calculate_hand_for_basins
         hand_raster =  hand_path / f'hand_{acc_thresh}_basin5_id_{hybas_id}.tif'
+        flow_acc_raster = output_dir / "flow_acc" / f"flow_acc_basin5_id_{hybas_id}.tif"
+
+        if should_stop is not None and should_stop():
+            print(f'stopped before basin {hybas_id}')
+            break
 
         try:
-            calculate_hand_for_basins(hand_raster, basin_geo, fabdem_vrt, acc_thresh=acc_thresh)
+            calculate_hand_for_basins(hand_raster, basin_geo, dem_cache.get(fabdem_vrt), acc_thresh=acc_thresh,
+                                      n_threads=n_threads, conditioning=conditioning,
+                                      routing_engine=routing_engine, pool=pool, overwrite_flow_acc=only_changed,
+                                      output_dir=output_dir, cog_profile=cog_profile, network_dir=network_dir)
+            if is_antimeridian:
+                # only the parts that were written, a basin may not reach across 180°
+                # the HAND sidecar is split along with the flow accumulation, before that is split itself
+                outputs = split_antimeridian_output(hand_raster, cog_profile=cog_profile,
+                                                    acc_raster=flow_acc_raster) + \
+                    split_antimeridian_output(flow_acc_raster, cog_profile=cog_profile)
+            else:
+                outputs = [hand_raster, flow_acc_raster]
+            if network_dir is not None:
+                network_file = network_file_name(hand_raster, network_dir)
+                if is_antimeridian:
+                    wrap_antimeridian_network(network_file)
+                outputs.append(network_file)
+            if should_stop is not None and should_stop():
+                print(f'stopped after basin {hybas_id}, its manifest is not written')
+                break
+            write_manifest(hand_raster, build_manifest(hybas_id, manifest_geo, acc_thresh, fabdem_path,
+                                                       outputs=outputs, conditioning=conditioning,
+                                                       routing_engine=routing_engine))
         except np.core._exceptions._ArrayMemoryError as e:
             print(f"Exception message: {e}")
-            log_error_ids(hybas_id)
+            log_error_ids(hybas_id, output_dir)
+            if raise_errors:
+                raise
+
+        if fabdem_vrt != global_vrt:
+            dem_cache.evict(fabdem_vrt)
+            if not keep_basin_vrt:
+                fabdem_vrt.unlink(missing_ok=True)
+                for tile_vrt in fabdem_vrt.parent.glob(f'{fabdem_vrt.stem}_*_360.vrt'):
+                    tile_vrt.unlink(missing_ok=True)
 
         end_time = time.time()
         elapsed_time = end_time - start_time
 
-        print(f'elapsed_time (minutes): {elapsed_time / 60 :.2f}')
\ No newline at end of file
+        print(f'elapsed_time (minutes): {elapsed_time / 60 :.2f}')
+
+    report = pool.report()
+    print(f"buffer pool: {report['hits']} hits, {report['misses']} misses ({report['hit_rate']:.0%} hit rate), "
+          f"{report['nbytes'] / 2 ** 20:.0f} MB")
+    dem_cache.close()
+    return hybas_ids
+
+
+if __name__ == "__main__":
+
+    import os
+    from basin_store import open_basins
+
+    acc_thresh = 100 # accumulation threshold
+    fabdem_path = Path("data/FABDEM/tiles")
+
+    # TODO: change basin source!
+    # Italy, northern Algeria, Kenya, Uganda, South Africa / East Africa, Australia 
+    hydroBASIN = open_basins("data/hydroBASIN/hybas_eu_lev05_v1c.zip", columns=['SUB_AREA', 'UP_AREA'])
+
+    # from constant import missing_ids
+    from step1_download_fabdem_by_country import query_by_country
+    _, hybas_ids = query_by_country(country_name='Italy')
+
+    process_basins(hydroBASIN, hybas_ids, acc_thresh=acc_thresh, fabdem_path=fabdem_path,
+                   use_global_vrt=True, keep_basin_vrt=False, only_changed=False, n_threads=os.cpu_count())
\ No newline at end of file
@@ -18,12 +18,13 @@ ee.Initialize()
 
 
 # Function to upload a GeoTIFF file to GEE and set properties
-def upload_geotiff_with_properties(filepath, acc_thresh=1000, basin_level=5):
+def upload_geotiff_with_properties(filepath, acc_thresh=1000, basin_level=5, ee_img_col=None):
+    # ee_img_col: ImageCollection asset of the upload, defaults to the module level eeImgCol of the script
     # Extract the filename without extension for asset name
     filename = os.path.basename(filepath).split('.')[0]
     
     # Set the asset ID (where the asset will be stored in your GEE account)
-    asset_id = f"{eeImgCol}/{filename}"
+    asset_id = f"{ee_img_col or eeImgCol}/{filename}"
     
     cur_time = int(time.time() * 1000)
     # Define properties to set on the asset
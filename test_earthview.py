@@ -0,0 +1,24 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from earthview import stream_parquet
+
+
+def write_table(path, n=1000):
+    table = pa.table({'id': list(range(n)), 'x': [i * 2 for i in range(n)], 'y': ['a'] * n})
+    pq.write_table(table, path, row_group_size=128)
+    return path
+
+
+def test_stream_parquet_columns(tmp_path):
+    filename = str(write_table(tmp_path / 'sample.parquet'))
+    rows = list(stream_parquet(filename, columns=['id', 'x']))
+    assert len(rows) == 1000
+    assert rows[10] == {'id': 10, 'x': 20}
+
+
+def test_stream_parquet_columns_and_filter(tmp_path):
+    filename = str(write_table(tmp_path / 'sample.parquet'))
+    rows = list(stream_parquet(filename, columns=['id', 'x'], row_filter=pc.field('id') > 990))
+    assert rows == [{'id': i, 'x': 2 * i} for i in range(991, 1000)]
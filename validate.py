@@ -0,0 +1,322 @@
+"""Offline validation of the per-basin HAND and flow_acc COGs
+
+Checks every COG of a folder block by block in a process pool, before the outputs are ingested into Earth Engine:
+    * nodata fraction inside the basin polygon, only if the HydroBASINS file is given: the outputs are nodata
+      outside of the basin, so the fraction over the whole raster says nothing
+    * negative values (float outputs of older runs) and saturated values (uint16 outputs clipped at 65534, or
+      float flow_acc beyond the uint16 range); flow_acc saturates on the large rivers of every big basin, so a
+      small fraction is allowed there (`MAX_SATURATED_FRACTION`)
+    * histogram of the valid values, HAND in meters
+    * differences against the same file of a reference run
+    * seams: differences in the overlap of neighbouring basins (the basin windows overlap by the padding and the
+      `all_touched` boundary pixels)
+
+Example:
+    python validate.py outputs/hand_acc100 --basins data/hydroBASIN/hybas_eu_lev05_v1c.zip --reference old/hand_acc100
+"""
+import argparse
+import json
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import rasterio
+import rasterio.features
+import rasterio.windows
+from tqdm import tqdm
+
+NODATA_VALUE = 65535
+SATURATED_VALUE = NODATA_VALUE - 1  # `calculate.encode_uint16` clips valid values below the nodata value
+
+HAND_SCALE = 10  # HAND is stored x 10
+HAND_BINS = [0, 1, 2, 5, 10, 20, 50, 100, 200, np.inf]  # meters
+FLOW_ACC_BINS = [0, 10, 100, 1000, 10000, SATURATED_VALUE, np.inf]  # cells
+# default saturated fraction allowed among the valid values; HAND saturates only at 6553.4 m
+MAX_SATURATED_FRACTION = {'hand': 0.0, 'flow_acc': 0.01}
+
+
+def raster_kind(filename):
+    """`hand` or `flow_acc`, from the output naming of `calculate_hand_for_basins`"""
+    return 'flow_acc' if Path(filename).name.startswith('flow_acc') else 'hand'
+
+
+def basin_id(filename):
+    # hand_100_basin5_id_2050012730.tif, flow_acc_basin5e_id_2050012730.tif -> 2050012730
+    return int(Path(filename).stem.split('_')[-1])
+
+
+def _valid_mask(data, nodata):
+    if np.issubdtype(data.dtype, np.floating):
+        valid = ~np.isnan(data)
+        if nodata is not None and not np.isnan(nodata):
+            valid &= data != nodata
+        return valid
+    return data != (NODATA_VALUE if nodata is None else nodata)
+
+
+def _decode(data, kind):
+    """Values in meters for HAND (uint16 outputs are stored x 10), cells for flow_acc"""
+    if kind == 'hand' and not np.issubdtype(data.dtype, np.floating):
+        return data.astype(np.float64) / HAND_SCALE
+    return data.astype(np.float64)
+
+
+def validate_raster(filename, reference=None, geometry_wkb=None, bins=None):
+    """Statistics of one COG, read block by block
+
+    Args:
+        filename: HAND or flow_acc COG
+        reference: the same COG of a reference run, compared pixel by pixel
+        geometry_wkb: WKB of the basin polygon (EPSG:4326) for the nodata fraction inside it; without it, the
+            nodata fraction is None
+        bins: histogram bin edges, default `HAND_BINS` (meters) or `FLOW_ACC_BINS`
+
+    Returns:
+        report: dict of counts, fractions, histogram and reference differences
+    """
+    import shapely
+
+    kind = raster_kind(filename)
+    bins = np.asarray(bins if bins is not None else (HAND_BINS if kind == 'hand' else FLOW_ACC_BINS), dtype=float)
+    geometry = shapely.from_wkb(geometry_wkb) if geometry_wkb is not None else None
+
+    counts = {'pixels': 0, 'inside': 0, 'valid': 0, 'nodata_inside': 0, 'negative': 0, 'saturated': 0}
+    histogram = np.zeros(len(bins) - 1, dtype=np.int64)
+    value_sum, value_max = 0.0, -np.inf
+    diff = {'compared': 0, 'different': 0, 'nodata_mismatch': 0, 'abs_sum': 0.0, 'abs_max': 0.0}
+
+    with rasterio.open(filename) as src:
+        ref = rasterio.open(reference) if reference is not None else None
+        try:
+            if ref is not None and (ref.shape != src.shape or ref.transform != src.transform):
+                diff['grid_mismatch'] = True
+                ref.close()
+                ref = None
+
+            dtype = src.dtypes[0]
+            floating = np.issubdtype(np.dtype(dtype), np.floating)
+            for _, window in src.block_windows(1):
+                data = src.read(1, window=window)
+                valid = _valid_mask(data, src.nodata)
+
+                counts['pixels'] += data.size
+                counts['valid'] += int(valid.sum())
+                if geometry is not None:
+                    inside = rasterio.features.geometry_mask([geometry], out_shape=data.shape, invert=True,
+                                                             all_touched=True,
+                                                             transform=src.window_transform(window))
+                    counts['inside'] += int(inside.sum())
+                    counts['nodata_inside'] += int((inside & ~valid).sum())
+
+                values = data[valid]
+                if floating:
+                    counts['negative'] += int((values < 0).sum())
+                    counts['saturated'] += int((values >= SATURATED_VALUE).sum()) if kind == 'flow_acc' else 0
+                else:
+                    counts['saturated'] += int((values == SATURATED_VALUE).sum())
+
+                decoded = _decode(values, kind)
+                histogram += np.histogram(decoded, bins=bins)[0]
+                value_sum += float(decoded.sum())
+                if decoded.size:
+                    value_max = max(value_max, float(decoded.max()))
+
+                if ref is not None:
+                    ref_data = ref.read(1, window=window)
+                    ref_valid = _valid_mask(ref_data, ref.nodata)
+                    both = valid & ref_valid
+                    abs_diff = np.abs(data[both].astype(np.float64) - ref_data[both].astype(np.float64))
+                    diff['compared'] += int(both.sum())
+                    diff['different'] += int((abs_diff > 0).sum())
+                    diff['nodata_mismatch'] += int((valid != ref_valid).sum())
+                    diff['abs_sum'] += float(abs_diff.sum())
+                    if abs_diff.size:
+                        diff['abs_max'] = max(diff['abs_max'], float(abs_diff.max()))
+        finally:
+            if ref is not None:
+                ref.close()
+
+    report = {
+        'file': str(filename),
+        'kind': kind,
+        'hybas_id': basin_id(filename),
+        'dtype': dtype,
+        **counts,
+        'nodata_fraction': (counts['nodata_inside'] / counts['inside'] if counts['inside'] else 1.0)
+        if geometry is not None else None,
+        'saturated_fraction': counts['saturated'] / counts['valid'] if counts['valid'] else 0.0,
+        'mean': value_sum / counts['valid'] if counts['valid'] else None,
+        'max': value_max if counts['valid'] else None,
+        'histogram': {'bins': [float(edge) for edge in bins], 'counts': histogram.tolist()},
+    }
+    if reference is not None:
+        diff['abs_mean'] = diff.pop('abs_sum') / diff['compared'] if diff['compared'] else None
+        report['reference'] = diff
+    return report
+
+
+def compare_overlap(filename_a, filename_b):
+    """Differences of two neighbouring basins' COGs where both have valid values"""
+    with rasterio.open(filename_a) as a, rasterio.open(filename_b) as b:
+        left, bottom = max(a.bounds.left, b.bounds.left), max(a.bounds.bottom, b.bounds.bottom)
+        right, top = min(a.bounds.right, b.bounds.right), min(a.bounds.top, b.bounds.top)
+        result = {'files': [str(filename_a), str(filename_b)], 'overlap': 0, 'abs_mean': None, 'abs_max': None}
+        if right <= left or top <= bottom:
+            return result
+
+        # both grids are FABDEM-aligned, rounding the windows gives the same pixels
+        window_a = rasterio.windows.from_bounds(left, bottom, right, top, a.transform).round_offsets().round_lengths()
+        window_b = rasterio.windows.from_bounds(left, bottom, right, top, b.transform).round_offsets().round_lengths()
+        height, width = min(window_a.height, window_b.height), min(window_a.width, window_b.width)
+        if height <= 0 or width <= 0:
+            return result
+        data_a = a.read(1, window=rasterio.windows.Window(window_a.col_off, window_a.row_off, width, height))
+        data_b = b.read(1, window=rasterio.windows.Window(window_b.col_off, window_b.row_off, width, height))
+
+    both = _valid_mask(data_a, a.nodata) & _valid_mask(data_b, b.nodata)
+    kind = raster_kind(filename_a)
+    abs_diff = np.abs(_decode(data_a[both], kind) - _decode(data_b[both], kind))
+    result['overlap'] = int(both.sum())
+    if abs_diff.size:
+        result['abs_mean'] = float(abs_diff.mean())
+        result['abs_max'] = float(abs_diff.max())
+    return result
+
+
+def neighbour_pairs(files):
+    """Pairs of files of different basins whose bounds intersect"""
+    import shapely
+    from shapely import STRtree
+
+    bounds = []
+    for filename in files:
+        with rasterio.open(filename) as src:
+            bounds.append(tuple(src.bounds))
+    boxes = shapely.box(*np.asarray(bounds, dtype=float).reshape(-1, 4).T)
+    left, right = STRtree(boxes).query(boxes, predicate='intersects')
+    return [(files[i], files[j]) for i, j in zip(left, right)
+            if i < j and basin_id(files[i]) != basin_id(files[j])]
+
+
+def validate_folder(folder, reference_dir=None, basins=None, pattern='*.tif', seams=True, max_workers=None):
+    """Validates all COGs of a folder in a process pool
+
+    Args:
+        folder: folder with the HAND or flow_acc COGs
+        reference_dir: folder of a reference run with the same file names
+        basins: GeoDataFrame of the HydroBASINS polygons, for the nodata fraction inside the basins
+        seams: also compare the overlaps of neighbouring basins
+        max_workers: number of processes, defaults to the number of CPUs
+
+    Returns:
+        report: {'files': [per-file reports], 'seams': [per-pair reports]}
+    """
+    files = sorted(Path(folder).glob(pattern))
+    geometries = {}
+    if basins is not None:
+        geometries = dict(zip(basins.HYBAS_ID.astype(int), basins.geometry.to_wkb()))
+
+    reports, seam_reports = [], []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for filename in files:
+            reference = Path(reference_dir) / filename.name if reference_dir is not None else None
+            if reference is not None and not reference.exists():
+                reference = None
+            futures.append(executor.submit(validate_raster, filename, reference, geometries.get(basin_id(filename))))
+        for future in tqdm(futures, desc='files'):
+            reports.append(future.result())
+
+        if seams:
+            pairs = neighbour_pairs(files)
+            for future in tqdm([executor.submit(compare_overlap, a, b) for a, b in pairs], desc='seams'):
+                seam_reports.append(future.result())
+
+    return {'files': reports, 'seams': seam_reports}
+
+
+def flag_issues(report, max_nodata_fraction=0.01, max_saturated_fraction=None, max_seam_diff=1.0,
+                max_reference_diff=0.0):
+    """(file, issue) of the files and seams that fail the checks
+
+    Args:
+        max_nodata_fraction: nodata pixels allowed inside the basin, only checked for files validated with their
+            basin polygon
+        max_saturated_fraction: saturated values allowed among the valid ones, defaults to
+            `MAX_SATURATED_FRACTION` of the file kind
+        max_seam_diff: mean absolute difference allowed in the overlap of neighbouring basins (HAND in meters)
+        max_reference_diff: absolute difference allowed against the reference run (stored units)
+    """
+    issues = []
+    for file_report in report['files']:
+        filename = file_report['file']
+        nodata_fraction = file_report['nodata_fraction']
+        if nodata_fraction is not None and nodata_fraction > max_nodata_fraction:
+            issues.append((filename, f"nodata fraction {nodata_fraction:.4f}"))
+        if file_report['negative']:
+            issues.append((filename, f"{file_report['negative']} negative values"))
+        max_saturated = max_saturated_fraction if max_saturated_fraction is not None \
+            else MAX_SATURATED_FRACTION[file_report['kind']]
+        if file_report['saturated_fraction'] > max_saturated:
+            issues.append((filename, f"{file_report['saturated']} saturated values "
+                                     f"({file_report['saturated_fraction']:.4f})"))
+        reference = file_report.get('reference')
+        if reference is not None:
+            if reference.get('grid_mismatch'):
+                issues.append((filename, 'grid differs from the reference'))
+            elif reference['abs_max'] > max_reference_diff or reference['nodata_mismatch']:
+                issues.append((filename, f"differs from the reference: max {reference['abs_max']}, "
+                                         f"{reference['nodata_mismatch']} nodata mismatches"))
+    for seam in report['seams']:
+        if seam['abs_mean'] is not None and seam['abs_mean'] > max_seam_diff:
+            issues.append((' | '.join(seam['files']), f"seam mean difference {seam['abs_mean']:.2f}"))
+    return issues
+
+
+def print_summary(report):
+    files = report['files']
+    print(f"{len(files)} files, {len(report['seams'])} neighbouring pairs")
+    if not files:
+        return
+    bins = files[0]['histogram']['bins']
+    histogram = np.sum([f['histogram']['counts'] for f in files if f['histogram']['bins'] == bins], axis=0)
+    total = max(histogram.sum(), 1)
+    for low, high, count in zip(bins[:-1], bins[1:], histogram):
+        print(f"    [{low:g}, {high:g}): {count / total:7.2%}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Validate a folder of HAND or flow_acc COGs')
+    parser.add_argument('folder')
+    parser.add_argument('--reference', help='folder of a reference run with the same file names')
+    parser.add_argument('--basins', help='HydroBASINS file, for the nodata fraction inside the basins '
+                                         '(not checked without it)')
+    parser.add_argument('--pattern', default='*.tif')
+    parser.add_argument('--no-seams', action='store_true')
+    parser.add_argument('--max-workers', type=int)
+    parser.add_argument('--max-nodata-fraction', type=float, default=0.01)
+    parser.add_argument('--max-saturated-fraction', type=float,
+                        help=f'default {MAX_SATURATED_FRACTION["hand"]} for HAND, '
+                             f'{MAX_SATURATED_FRACTION["flow_acc"]} for flow_acc')
+    parser.add_argument('--max-seam-diff', type=float, default=1.0)
+    parser.add_argument('--output', help='JSON report')
+    args = parser.parse_args()
+
+    basins = None
+    if args.basins:
+        import geopandas as gpd
+        basins = gpd.read_file(args.basins)
+
+    report = validate_folder(args.folder, reference_dir=args.reference, basins=basins, pattern=args.pattern,
+                             seams=not args.no_seams, max_workers=args.max_workers)
+    print_summary(report)
+
+    issues = flag_issues(report, max_nodata_fraction=args.max_nodata_fraction,
+                         max_saturated_fraction=args.max_saturated_fraction, max_seam_diff=args.max_seam_diff)
+    for filename, issue in issues:
+        print(f"{filename}: {issue}")
+    print(f"{len(issues)} issues")
+
+    if args.output:
+        Path(args.output).write_text(json.dumps({**report, 'issues': issues}, indent=1))